@@ -1,7 +1,9 @@
-import sqlite3
 import time
 import logging
 import argparse
+from rollups import AggregationEngine, Rollup, register_rollup
+from storage.connection import connect_writer
+from storage.schema import migrate
 from utils.logger import get_logger
 
 DB_FILE = "ecommerce.db"
@@ -22,48 +24,79 @@ def create_event_counts_table(conn):
     """)
     conn.commit()
 
-def update_event_counts(conn):
-    cur = conn.cursor()
-    
-    # Compute per-product, per-event-type counts from the raw events table
-    cur.execute("""
-    SELECT 
-        product_id,
-        product_name,
-        event_type,
-        COUNT(*) as event_count
-    FROM events
-    GROUP BY product_id, product_name, event_type
-    """)
-    
-    rows = cur.fetchall()
-    
-    # Upsert the computed counts
-    for product_id, product_name, event_type, count in rows:
-        cur.execute("""
+@register_rollup
+class EventCountsRollup(Rollup):
+    """Number of events per product and event type, folded in as deltas."""
+
+    name = "event_counts"
+
+    def __init__(self, **options):
+        self.deltas = {}
+
+    def load(self, conn, last_event_id):
+        self.deltas = {}
+
+    def create_table(self, conn):
+        create_event_counts_table(conn)
+
+    def fold(self, event):
+        key = (event["product_id"], event["event_type"])
+        delta = self.deltas.get(key)
+        if delta is None:
+            self.deltas[key] = [event["product_name"], 1]
+        else:
+            delta[0] = event["product_name"]
+            delta[1] += 1
+
+    def fold_daily(self, totals):
+        key = (totals["product_id"], totals["event_type"])
+        delta = self.deltas.setdefault(key, [totals["product_name"], 0])
+        delta[0] = totals["product_name"]
+        delta[1] += totals["events"]
+
+    def flush(self, conn):
+        # Add the deltas onto the stored counts
+        conn.executemany("""
         INSERT INTO event_counts (product_id, product_name, event_type, count)
         VALUES (?, ?, ?, ?)
         ON CONFLICT(product_id, event_type) DO UPDATE SET
-            count=excluded.count,
+            count=count + excluded.count,
             product_name=excluded.product_name
-        """, (product_id, product_name, event_type, count))
-        logger.info(f"Product {product_name} (ID: {product_id}) -> {event_type}: {count}")
-    
-    conn.commit()
-    logger.info(f"Event counts updated for {len(rows)} product-event combinations.")
+        """, [(product_id, product_name, event_type, count)
+              for (product_id, event_type), (product_name, count) in self.deltas.items()])
+        if logger.isEnabledFor(logging.DEBUG):
+            for (product_id, event_type), (product_name, count) in self.deltas.items():
+                logger.debug("Product %s (ID: %s) -> %s: +%d", product_name, product_id, event_type, count)
+        self.deltas = {}
+
+    def backfill(self, conn, history):
+        # Each count ends up with the product name seen last
+        for totals in history.products(order="last"):
+            self.fold_daily(totals)
+        self.flush(conn)
+
+def update_event_counts(conn):
+    """Fold events added since the last run into the event_counts table."""
+    AggregationEngine(conn, [EventCountsRollup()]).run_pass()
 
 def main():
     parser = argparse.ArgumentParser(description="Update event counts from events table")
     parser.add_argument("--once", action="store_true", help="Run a single update and exit")
     parser.add_argument("--interval", type=int, default=AGGREGATION_INTERVAL, help="Seconds between updates in loop mode")
+    parser.add_argument("--rebuild", action="store_true", help="Recompute event counts from all events before updating incrementally")
     args = parser.parse_args()
 
     # Allow concurrent reading while consumer writes
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-    conn.execute("PRAGMA journal_mode=WAL;")
+    conn = connect_writer(DB_FILE, check_same_thread=False)
+    migrate(conn)
     create_event_counts_table(conn)
     
     try:
+        if args.rebuild:
+            engine = AggregationEngine(conn, [EventCountsRollup()])
+            engine.rebuild()
+            engine.run_pass()
+
         if args.once:
             update_event_counts(conn)
             return
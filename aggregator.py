@@ -0,0 +1,63 @@
+import time
+import argparse
+from rollups import AggregationEngine, load_rollups, CHUNK_SIZE, DEFAULT_ROLLUP_MODULES
+from storage.connection import connect_writer, start_checkpointer
+from storage.schema import migrate
+from storage.store import DEFAULT_RETENTION_DAYS, run_maintenance
+from track_top_users import parse_window
+from utils.logger import get_logger
+from utils.metrics import serve as serve_metrics
+
+DB_FILE = "ecommerce.db"
+AGGREGATION_INTERVAL = 15  # seconds
+MAINTENANCE_INTERVAL = 3600  # seconds between archiving/compaction runs
+
+logger = get_logger(__name__)
+
+def main():
+    parser = argparse.ArgumentParser(description="Update all rollup tables from a single pass over new events")
+    parser.add_argument("--once", action="store_true", help="Run a single update and exit")
+    parser.add_argument("--interval", type=int, default=AGGREGATION_INTERVAL, help="Seconds between updates in loop mode")
+    parser.add_argument("--rollups", nargs="+", default=[], help="Rollups to maintain (default: all registered)")
+    parser.add_argument("--plugin", action="append", default=[], help="Extra module to import for its registered rollups")
+    parser.add_argument("--window", type=parse_window, help="Recent purchases considered by top_users: a count (1000) or a duration (30m, 1h, 7d)")
+    parser.add_argument("--top-k", type=int, help="Number of users kept in the top_users table")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="Events read and committed per transaction")
+    parser.add_argument("--rebuild", action="store_true", help="Recompute the rollups from all events before updating incrementally")
+    parser.add_argument("--retention-days", type=int, default=DEFAULT_RETENTION_DAYS, help="Days of raw events kept in partitions before compacting into daily rollups")
+    parser.add_argument("--maintenance-interval", type=int, default=MAINTENANCE_INTERVAL, help="Seconds between archiving and compaction runs (0 disables them)")
+    parser.add_argument("--metrics-port", type=int, help="Serve Prometheus metrics on this port at /metrics")
+    args = parser.parse_args()
+    if args.metrics_port:
+        serve_metrics(args.metrics_port)
+
+    # Allow concurrent reading while consumer writes
+    conn = connect_writer(DB_FILE, check_same_thread=False)
+    start_checkpointer(DB_FILE)
+    migrate(conn)
+
+    try:
+        options = {name: value for name, value in [("window", args.window), ("top_k", args.top_k)] if value}
+        rollups = load_rollups(args.rollups, DEFAULT_ROLLUP_MODULES + args.plugin, **options)
+        engine = AggregationEngine(conn, rollups, args.chunk_size)
+        if args.rebuild:
+            engine.rebuild()
+
+        if args.once:
+            engine.run_pass()
+            return
+
+        next_maintenance = time.monotonic()
+        while True:
+            engine.run_pass()
+            if args.maintenance_interval and time.monotonic() >= next_maintenance:
+                run_maintenance(conn, args.retention_days)
+                next_maintenance = time.monotonic() + args.maintenance_interval
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        logger.info("Stopping aggregation engine...")
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,344 @@
+"""Recompute the rollup tables from the whole event history in bulk.
+
+``aggregator.py --rebuild`` replays history through every rollup's ``fold``,
+one ``sqlite3.Row`` at a time. This script instead reads the integer columns
+of every event table in large id ranges into NumPy arrays, groups them by
+event type and product key (plus the distinct users per event type, the
+totals per event type and minute, and the events per user and per product
+each hour), merges in the compacted daily rollups, and hands the totals to
+each rollup's ``Rollup.backfill``, which writes its table with one
+``executemany``. Scans can be split across processes by user key.
+
+Rollups without a ``backfill`` (plugins), and every rollup when NumPy is not
+installed, are rebuilt by the aggregation engine instead.
+"""
+import time
+import argparse
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from bucket_events import HOUR, MINUTE
+from rollups import (
+    AggregationEngine, Rollup, DEFAULT_ROLLUP_MODULES, create_aggregation_state_table, load_rollups, set_high_water_mark,
+)
+from storage.connection import connect_reader, connect_writer
+from storage.schema import PURCHASE, migrate
+from storage.store import event_tables, last_event_id
+from track_top_users import parse_window
+from utils.logger import get_logger
+
+try:
+    import numpy as np
+except ImportError:  # optional; without it every rollup is rebuilt by folding events
+    np = None
+
+DB_FILE = "ecommerce.db"
+CHUNK_IDS = 1000000  # event ids read per query
+PENDING_CHUNKS = 16  # per-chunk user sets and hourly counts merged into one after this many
+KEY_BITS = 40  # group keys hold the event type code (or hour) above a product or user key, or a minute
+KEY_MASK = (1 << KEY_BITS) - 1
+
+logger = get_logger(__name__)
+
+SCAN_EVENTS_SQL = """
+SELECT id, event_type, user_key, product_key, price, ts
+FROM {table}
+WHERE id > ? AND id <= ?{shard}
+"""
+
+SCAN_DAILY_SQL = """
+SELECT event_type, product_key, events, revenue
+FROM daily_rollups
+ORDER BY day
+"""
+
+EVENT_DTYPE = [("id", "i8"), ("event_type", "i8"), ("user_key", "i8"), ("product_key", "i8"), ("price", "f8"), ("ts", "i8")]
+DAILY_DTYPE = [("event_type", "i8"), ("product_key", "i8"), ("events", "i8"), ("revenue", "f8")]
+
+
+# What one scan_events call gathered; see there
+Scan = namedtuple("Scan", ["groups", "users", "minutes", "hour_users", "hour_products", "read"])
+
+
+class HistoryMovedError(Exception):
+    """Events were archived or compacted while the backfill was reading them."""
+
+
+def group_totals(keys, events, revenue, first, last):
+    """Add up ``events`` and ``revenue`` per key and keep the first and last position seen.
+
+    Returns the same five arrays with one entry per distinct key, sorted by key.
+    """
+    if not len(keys):
+        return keys, events, revenue, first, last
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    return (keys[starts],
+            np.add.reduceat(events[order], starts),
+            np.add.reduceat(revenue[order], starts),
+            np.minimum.reduceat(first[order], starts),
+            np.maximum.reduceat(last[order], starts))
+
+def merge_groups(*groups):
+    """Combine several ``group_totals`` results (e.g. from different shards) into one."""
+    return group_totals(*(np.concatenate(columns) for columns in zip(*groups)))
+
+def count_keys(keys, counts):
+    """Add up ``counts`` per distinct key; returns (keys, counts) sorted by key."""
+    keys, inverse = np.unique(keys, return_inverse=True)
+    return keys, np.bincount(inverse, weights=counts, minlength=len(keys)).astype("i8")
+
+def merge_counts(counted):
+    """Combine several ``count_keys`` results into one."""
+    if not counted:
+        return np.empty(0, "i8"), np.empty(0, "i8")
+    return count_keys(*(np.concatenate(columns) for columns in zip(*counted)))
+
+def hour_keys(rows):
+    """``(hour << 1 | is purchase) << KEY_BITS`` for every row, to add a user or product key to."""
+    return (rows["ts"] // HOUR << 1 | (rows["event_type"] == PURCHASE)) << KEY_BITS
+
+def empty_groups():
+    return (np.empty(0, "i8"), np.empty(0, "i8"), np.empty(0, "f8"), np.empty(0, "i8"), np.empty(0, "i8"))
+
+def scan_events(db_file, tables, up_to_id, shard=0, shards=1, chunk_ids=CHUNK_IDS):
+    """Group the raw events with ``id <= up_to_id`` and ``user_key % shards == shard``.
+
+    Runs in a worker process when sharded, so it opens its own read-only
+    connection and reads every table in one snapshot. The position of an
+    event is its id. Returns a ``Scan`` of the groups per event type and
+    product, the user pairs (the distinct ``event_type << KEY_BITS | user_key``
+    values), the groups per ``event_type << KEY_BITS | minute``, the events
+    per ``hour_keys | user_key`` and per ``hour_keys | product_key`` (see
+    ``count_keys``) and the number of events read.
+    """
+    conn = connect_reader(db_file)
+    groups = empty_groups()
+    minutes = empty_groups()
+    users = []
+    hour_users = []
+    hour_products = []
+    read = 0
+    try:
+        conn.execute("BEGIN")
+        for table in tables:
+            low, high = conn.execute(f"SELECT MIN(id) - 1, MAX(id) FROM {table} WHERE id <= ?", (up_to_id,)).fetchone()
+            if high is None:
+                continue
+            sql = SCAN_EVENTS_SQL.format(table=table, shard=" AND user_key % ? = ?" if shards > 1 else "")
+            for start in range(low, high, chunk_ids):
+                params = (start, min(start + chunk_ids, high)) + ((shards, shard) if shards > 1 else ())
+                rows = np.fromiter(conn.execute(sql, params), dtype=EVENT_DTYPE)
+                if not len(rows):
+                    continue
+                read += len(rows)
+                types = rows["event_type"] << KEY_BITS
+                ones = np.ones(len(rows), "i8")
+                ids = rows["id"]
+                groups = merge_groups(groups, group_totals(types | rows["product_key"], ones, rows["price"], ids, ids))
+                minutes = merge_groups(minutes, group_totals(types | rows["ts"] // MINUTE, ones, rows["price"], ids, ids))
+                users.append(np.unique(types | rows["user_key"]))
+                hours = hour_keys(rows)
+                hour_users.append(count_keys(hours | rows["user_key"], ones))
+                hour_products.append(count_keys(hours | rows["product_key"], ones))
+                if len(users) >= PENDING_CHUNKS:
+                    users = [np.unique(np.concatenate(users))]
+                    hour_users = [merge_counts(hour_users)]
+                    hour_products = [merge_counts(hour_products)]
+        conn.rollback()
+    finally:
+        conn.close()
+    return Scan(groups, np.unique(np.concatenate(users)) if users else np.empty(0, "i8"), minutes,
+                merge_counts(hour_users), merge_counts(hour_products), read)
+
+def scan_daily(conn):
+    """Group the compacted daily rollups, positioned before every raw event like in a replay."""
+    rows = np.fromiter(conn.execute(SCAN_DAILY_SQL), dtype=DAILY_DTYPE)
+    positions = np.arange(len(rows), dtype="i8") - len(rows)
+    keys = rows["event_type"] << KEY_BITS | rows["product_key"]
+    return group_totals(keys, rows["events"], rows["revenue"], positions, positions)
+
+def history_fingerprint(conn, up_to_id):
+    """What archiving and compaction change about the events with ``id <= up_to_id``."""
+    return (
+        conn.execute("SELECT MIN(id) FROM events WHERE id <= ?", (up_to_id,)).fetchone()[0],
+        conn.execute("SELECT COUNT(*), TOTAL(events) FROM daily_rollups").fetchone(),
+        conn.execute("SELECT name, row_count FROM event_partitions ORDER BY day").fetchall(),
+    )
+
+def split_hours(counted, name):
+    """Yield (hour bucket start, {name: purchases}) from ``count_keys`` results over ``hour_keys``."""
+    keys, counts = counted
+    hours = keys >> (KEY_BITS + 1)
+    starts = np.flatnonzero(np.concatenate(([True], hours[1:] != hours[:-1]))).tolist() if len(keys) else []
+    for start, end in zip(starts, starts[1:] + [len(keys)]):
+        purchases = {}
+        for key, count in zip(keys[start:end].tolist(), counts[start:end].tolist()):
+            item = name(key & KEY_MASK)
+            purchases[item] = purchases.get(item, 0) + (count if key >> KEY_BITS & 1 else 0)
+        yield int(hours[start]) * HOUR, purchases
+
+
+class History:
+    """Every event up to ``up_to_id`` grouped for ``Rollup.backfill``.
+
+    Raw events (hot and archived) and compacted days are grouped by event type
+    and product, keeping where each group was first and last seen; compacted
+    days come before every raw event, as when the engine replays history.
+    Distinct users, per-minute totals and hourly events per user and product
+    are only known for raw events; the compacted days themselves are in
+    ``storage.store.iter_daily_rollups``.
+    """
+
+    def __init__(self, conn, up_to_id, groups, users, minutes, hour_users, hour_products):
+        self.conn = conn
+        self.up_to_id = up_to_id
+        self.groups = groups
+        self.user_pairs = users
+        self.minute_groups = minutes
+        self.hour_users = hour_users
+        self.hour_products = hour_products
+        self.event_types = dict(conn.execute("SELECT code, name FROM event_types"))
+        self.product_names = {key: (product_id, product_name) for key, product_id, product_name in conn.execute(
+            "SELECT id, product_id, product_name FROM products"
+        )}
+
+    def products(self, order="first"):
+        """Totals per event type and product, shaped like ``storage.store.iter_daily_rollups`` rows.
+
+        ``order`` is "first" or "last": groups come in the order they were
+        first or last seen, so a rollup that keeps the first (or latest)
+        product name can fold them with ``fold_daily`` as they come.
+        """
+        keys, events, revenue, first, last = self.groups
+        positions = first if order == "first" else last
+        order = np.argsort(positions, kind="stable")
+        for key, count, total in zip(keys[order].tolist(), events[order].tolist(), revenue[order].tolist()):
+            product_id, product_name = self.product_names[key & KEY_MASK]
+            yield {"event_type": self.event_types[key >> KEY_BITS], "product_id": product_id,
+                   "product_name": product_name, "events": count, "revenue": total}
+
+    def users(self):
+        """(event_type, user ids) for every event type seen in raw events."""
+        user_ids = dict(self.conn.execute("SELECT id, user_id FROM users"))
+        types = self.user_pairs >> KEY_BITS
+        for code in np.unique(types).tolist():
+            keys = (self.user_pairs[types == code] & KEY_MASK).tolist()
+            yield self.event_types[code], [user_ids[key] for key in keys]
+
+    def minutes(self):
+        """(minute bucket start, event type, events, price total) of raw events per minute, oldest first."""
+        keys, events, revenue, _, _ = self.minute_groups
+        order = np.argsort(keys & KEY_MASK, kind="stable")
+        for key, count, total in zip(keys[order].tolist(), events[order].tolist(), revenue[order].tolist()):
+            yield (key & KEY_MASK) * MINUTE, self.event_types[key >> KEY_BITS], count, total
+
+    def hours(self):
+        """(hour bucket start, users, products) of raw events per hour, oldest first.
+
+        ``users`` and ``products`` map the ids seen in the hour to their
+        number of purchases in it, 0 for ids with other events only.
+        """
+        user_ids = dict(self.conn.execute("SELECT id, user_id FROM users"))
+        users = split_hours(self.hour_users, user_ids.__getitem__)
+        products = split_hours(self.hour_products, lambda key: self.product_names[key][0])
+        # Every event counts for a user and a product, so both have the same hours
+        for (hour, hour_users), (_, hour_products) in zip(users, products):
+            yield hour, hour_users, hour_products
+
+
+def can_backfill(rollup):
+    return type(rollup).backfill is not Rollup.backfill
+
+def read_history(conn, db_file, shards=1, chunk_ids=CHUNK_IDS):
+    """Group every event up to the newest id; returns (History, fingerprint, events read)."""
+    with conn:
+        conn.execute("BEGIN")
+        up_to_id = last_event_id(conn)
+        fingerprint = history_fingerprint(conn, up_to_id)
+        tables = event_tables(conn)
+        daily = scan_daily(conn)
+    if shards > 1:
+        with ProcessPoolExecutor(shards) as pool:
+            results = list(pool.map(scan_events, [db_file] * shards, [tables] * shards, [up_to_id] * shards,
+                                    range(shards), [shards] * shards, [chunk_ids] * shards))
+    else:
+        results = [scan_events(db_file, tables, up_to_id, chunk_ids=chunk_ids)]
+    groups = merge_groups(daily, *(scan.groups for scan in results))
+    users = np.unique(np.concatenate([scan.users for scan in results]))
+    minutes = merge_groups(*(scan.minutes for scan in results))
+    hour_users = merge_counts([scan.hour_users for scan in results])
+    hour_products = merge_counts([scan.hour_products for scan in results])
+    read = sum(scan.read for scan in results)
+    return History(conn, up_to_id, groups, users, minutes, hour_users, hour_products), fingerprint, read
+
+def backfill(conn, rollups, db_file=DB_FILE, shards=1, chunk_ids=CHUNK_IDS):
+    """Recompute ``rollups`` up to the newest event and set their marks to it.
+
+    The tables are replaced in one transaction, so readers see either the old
+    or the new totals. Raises HistoryMovedError if events were archived or
+    compacted while they were being read; running again is then safe.
+    """
+    create_aggregation_state_table(conn)
+    for rollup in rollups:
+        rollup.create_table(conn)
+
+    started = time.perf_counter()
+    history, fingerprint, read = read_history(conn, db_file, shards, chunk_ids)
+    scanned = time.perf_counter()
+    logger.info(f"Read {read} events and {len(history.groups[0])} product groups up to event {history.up_to_id} "
+                f"in {scanned - started:.1f}s ({read / max(scanned - started, 1e-9):.0f} events/s)")
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if history_fingerprint(conn, history.up_to_id) != fingerprint:
+            raise HistoryMovedError("events were archived or compacted during the backfill; run it again")
+        for rollup in rollups:
+            rollup.reset(conn)
+            rollup.load(conn, 0)
+            rollup.backfill(conn, history)
+            set_high_water_mark(conn, rollup.name, history.up_to_id)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    logger.info(f"Backfilled {', '.join(r.name for r in rollups)} up to event {history.up_to_id} "
+                f"in {time.perf_counter() - scanned:.1f}s")
+
+def main():
+    parser = argparse.ArgumentParser(description="Recompute the rollup tables from all events in bulk")
+    parser.add_argument("--rollups", nargs="+", default=[], help="Rollups to recompute (default: all registered)")
+    parser.add_argument("--plugin", action="append", default=[], help="Extra module to import for its registered rollups")
+    parser.add_argument("--window", type=parse_window,
+                        help="Recent purchases considered by top_users: a count (1000) or a duration (30m, 1h, 7d)")
+    parser.add_argument("--top-k", type=int, help="Number of users kept in the top_users table")
+    parser.add_argument("--shards", type=int, default=1, help="Processes scanning the events, each taking a share of the users")
+    parser.add_argument("--chunk-ids", type=int, default=CHUNK_IDS, help="Event ids read per query")
+    args = parser.parse_args()
+
+    conn = connect_writer(DB_FILE, check_same_thread=False)
+    migrate(conn)
+
+    try:
+        options = {name: value for name, value in [("window", args.window), ("top_k", args.top_k)] if value}
+        rollups = load_rollups(args.rollups, DEFAULT_ROLLUP_MODULES + args.plugin, **options)
+        if np is None:
+            logger.warning("NumPy is not installed; rebuilding every rollup by folding events")
+            bulk, folded = [], rollups
+        else:
+            bulk = [rollup for rollup in rollups if can_backfill(rollup)]
+            folded = [rollup for rollup in rollups if not can_backfill(rollup)]
+        if bulk:
+            backfill(conn, bulk, DB_FILE, args.shards, args.chunk_ids)
+        if folded:
+            engine = AggregationEngine(conn, folded)
+            engine.rebuild()
+            engine.run_pass()
+    except HistoryMovedError as e:
+        logger.error(str(e))
+        raise SystemExit(1)
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Measure events/sec through the consumer's parse + validate stage.
+
+Compares the previous path (json.loads, then a loop over the required keys
+and a separate timestamp conversion) with utils.schema.parse_event on every
+available decoder, and with decoding the same events from columnar frames
+(storage/columnar.py). Run from the repository root:
+
+    python -m benchmarks.bench_decode --events 200000
+"""
+import argparse
+import json
+import time
+
+from event_generator import LoadGenerator
+from storage.columnar import MAX_FRAME_EVENTS, FrameBuilder, read_frame
+from storage.schema import iso_to_micros
+from utils.schema import DECODERS, get_decoder, parse_event
+
+REQUIRED_KEYS = ["event_type", "user_id", "product_id", "product_name", "price", "timestamp"]
+
+
+def baseline(line):
+    """The consumer's parse path before utils.schema, minus logging."""
+    event = json.loads(line)
+    for key in REQUIRED_KEYS:
+        if key not in event or event[key] is None:
+            return None
+    event["ts"] = iso_to_micros(event["timestamp"])
+    return event
+
+
+def bench(parse, lines):
+    start = time.perf_counter()
+    for line in lines:
+        parse(line)
+    return time.perf_counter() - start
+
+
+def encode_frames(lines):
+    frames = []
+    for start in range(0, len(lines), MAX_FRAME_EVENTS):
+        builder = FrameBuilder()
+        for line in lines[start:start + MAX_FRAME_EVENTS]:
+            builder.add_event(parse_event(line))
+        frames.append(builder.encode())
+    return frames
+
+def bench_frames(frames):
+    start = time.perf_counter()
+    for data in frames:
+        read_frame(data, 0).events()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark JSON decoding and schema validation of event lines")
+    parser.add_argument("--events", type=int, default=200000, help="Number of event lines to parse per run")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per mode; the fastest is reported")
+    args = parser.parse_args()
+
+    lines = LoadGenerator(seed=1, rate=0).batch(args.events).encode().splitlines(keepends=True)
+    runs = [("json + key loop (old)", baseline)]
+    for name in sorted(DECODERS):
+        loads = get_decoder(name)
+        runs.append((f"{name} + schema", lambda line, loads=loads: parse_event(line, loads)))
+
+    print(f"{'mode':<24} {'seconds':>10} {'events/sec':>12} {'bytes/event':>12}")
+    line_bytes = sum(map(len, lines)) / len(lines)
+    for label, parse in runs:
+        elapsed = min(bench(parse, lines) for _ in range(args.repeat))
+        print(f"{label:<24} {elapsed:>10.3f} {len(lines) / elapsed:>12.0f} {line_bytes:>12.1f}")
+    frames = encode_frames(lines)
+    elapsed = min(bench_frames(frames) for _ in range(args.repeat))
+    frame_bytes = sum(map(len, frames)) / len(lines)
+    print(f"{'columnar frames':<24} {elapsed:>10.3f} {len(lines) / elapsed:>12.0f} {frame_bytes:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""Compare per-row commits with batched commits on the consumer insert path.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_ingest --events 20000 --batch-sizes 1 100 500 2000
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+
+from consumer.consumer import create_events_table, save_event, save_events
+from event_generator import generate_event
+
+
+def bench_per_row(db_file, events):
+    conn = sqlite3.connect(db_file)
+    create_events_table(conn)
+    start = time.perf_counter()
+    for event in events:
+        save_event(conn, event)
+    elapsed = time.perf_counter() - start
+    conn.close()
+    return elapsed
+
+
+def bench_batched(db_file, events, batch_size):
+    conn = sqlite3.connect(db_file)
+    create_events_table(conn)
+    start = time.perf_counter()
+    for i in range(0, len(events), batch_size):
+        save_events(conn, events[i:i + batch_size])
+    elapsed = time.perf_counter() - start
+    conn.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark per-row vs batched event ingestion")
+    parser.add_argument("--events", type=int, default=20000, help="Number of events to insert per run")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[100, 500, 2000], help="Batch sizes to compare against per-row commits")
+    args = parser.parse_args()
+
+    events = [generate_event() for _ in range(args.events)]
+    runs = [("per-row commit", None)] + [(f"batch of {size}", size) for size in args.batch_sizes]
+
+    print(f"{'mode':<20} {'seconds':>10} {'events/sec':>12}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for i, (label, batch_size) in enumerate(runs):
+            db_file = os.path.join(tmp, f"bench_{i}.db")
+            if batch_size is None:
+                elapsed = bench_per_row(db_file, events)
+            else:
+                elapsed = bench_batched(db_file, events, batch_size)
+            print(f"{label:<20} {elapsed:>10.3f} {len(events) / elapsed:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
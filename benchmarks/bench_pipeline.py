@@ -0,0 +1,305 @@
+"""End-to-end pipeline benchmarks at several table sizes, reported as JSON.
+
+For every size the harness seeds a database with that many events (stored
+rows, not JSON, so 10^8 is feasible), then measures:
+
+- consumer.ingest: the EventTailer draining a file of new events
+- consumer.ingest_parallel.<workers>: the same file through consumer.worker (with --workers)
+- consumer.save_events: commit latency of one consumer batch
+- <module>.<function>.build: the first aggregator run, which folds every event
+- <module>.<function>: an aggregator tick after each batch of new events
+- report: report.print_report
+- dashboard: the Django dashboard view, rendered through a RequestFactory
+
+Each result has throughput and p50/p95/p99 latency. Save one run per commit
+and compare them:
+
+    python -m benchmarks.bench_pipeline --sizes 10000 100000 1000000 --output before.json
+    python -m benchmarks.bench_pipeline --sizes 10000 100000 1000000 --output after.json --compare before.json
+
+Seeded databases are kept in --data-dir (default: a temporary directory)
+and reused by later runs, since seeding 10^8 events takes a while.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from aggregate_event_counts import update_event_counts
+from consumer.consumer import DEFAULT_BATCH_SIZE, EventTailer, create_offsets_table, file_id, save_events
+from consumer.worker import ParallelTailer
+from event_generator import EVENT_TYPES, EVENT_TYPE_WEIGHTS, LoadGenerator, product_info, zipf_cum_weights
+from report import print_report
+from storage.connection import connect_reader, connect_writer
+from storage.schema import EVENT_TYPE_CODES, iso_to_micros, migrate
+from track_top_users import DEFAULT_EVENT_WINDOW, update_top_users
+from transform_events import update_aggregates
+
+SEED_CHUNK = 100000  # rows per executemany while seeding
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+AGGREGATORS = [
+    ("transform_events.update_aggregates", update_aggregates),
+    ("aggregate_event_counts.update_event_counts", update_event_counts),
+    ("track_top_users.update_top_users", lambda conn: update_top_users(conn, DEFAULT_EVENT_WINDOW)),
+]
+BENCHMARKS = ["consumer", "aggregators", "report", "dashboard"]
+
+
+def percentile(samples, p):
+    """Nearest-rank percentile of a list of samples."""
+    ordered = sorted(samples)
+    return ordered[max(0, min(len(ordered) - 1, round(p / 100 * len(ordered) + 0.5) - 1))]
+
+def summarize(name, size, samples, items_per_sample=1, unit="ops/s"):
+    """One JSON result from per-operation latencies in seconds."""
+    total = sum(samples)
+    return {
+        "name": name,
+        "events_in_db": size,
+        "samples": len(samples),
+        "throughput": round(items_per_sample * len(samples) / total, 1) if total else None,
+        "throughput_unit": unit,
+        "mean_ms": round(total / len(samples) * 1000, 3),
+        "p50_ms": round(percentile(samples, 50) * 1000, 3),
+        "p95_ms": round(percentile(samples, 95) * 1000, 3),
+        "p99_ms": round(percentile(samples, 99) * 1000, 3),
+        "max_ms": round(max(samples) * 1000, 3),
+    }
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def seed_database(db_file, size, users, products, days, seed):
+    """Insert ``size`` events straight into the compact events table.
+
+    Popularity and event mix follow event_generator; timestamps are spread
+    evenly over the ``days`` before now.
+    """
+    conn = sqlite3.connect(db_file)
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=OFF;")
+    migrate(conn)
+    rng = random.Random(seed)
+    with conn:
+        conn.executemany("INSERT INTO users (id, user_id) VALUES (?, ?)",
+                         ((i + 1, f"user_{i + 1}") for i in range(users)))
+        conn.executemany("INSERT INTO products (id, product_id, product_name) VALUES (?, ?, ?)",
+                         ((i + 1, *product_info(i)[:2]) for i in range(products)))
+        # Building the indexes once at the end is much faster than maintaining them per row
+        conn.execute("DROP INDEX idx_events_type")
+        conn.execute("DROP INDEX idx_events_type_product")
+    prices = [product_info(i)[2] for i in range(products)]
+    codes = [EVENT_TYPE_CODES[name] for name in EVENT_TYPES]
+    user_weights = zipf_cum_weights(users, 1.1)
+    product_weights = zipf_cum_weights(products, 1.1)
+    end = iso_to_micros(datetime.utcnow().isoformat())
+    step = days * 86400 * 1000000 // max(size, 1)
+    start = end - step * size
+    for first in range(0, size, SEED_CHUNK):
+        n = min(SEED_CHUNK, size - first)
+        event_types = rng.choices(codes, weights=EVENT_TYPE_WEIGHTS, k=n)
+        user_keys = rng.choices(range(1, users + 1), cum_weights=user_weights, k=n)
+        product_keys = rng.choices(range(1, products + 1), cum_weights=product_weights, k=n)
+        with conn:
+            conn.executemany(
+                "INSERT INTO events (event_type, user_key, product_key, price, ts) VALUES (?, ?, ?, ?, ?)",
+                ((code, user_key, product_key, prices[product_key - 1], start + (first + i) * step)
+                 for i, (code, user_key, product_key) in enumerate(zip(event_types, user_keys, product_keys))),
+            )
+        print(f"  seeded {first + n}/{size} events", file=sys.stderr, end="\r")
+    print(file=sys.stderr)
+    with conn:
+        conn.execute("CREATE INDEX idx_events_type ON events (event_type)")
+        conn.execute("CREATE INDEX idx_events_type_product ON events (event_type, product_key, price)")
+    conn.execute("PRAGMA synchronous=FULL;")
+    conn.close()
+
+def prepare_database(data_dir, work_dir, size, args):
+    """Copy of a seeded database for one run, seeding it first if it is not cached."""
+    cached = os.path.join(data_dir, f"events_{size}_{args.users}u_{args.products}p_seed{args.seed}.db")
+    if not os.path.exists(cached):
+        print(f"Seeding {size} events into {cached}", file=sys.stderr)
+        seed_database(cached + ".tmp", size, args.users, args.products, args.days, args.seed)
+        os.replace(cached + ".tmp", cached)
+    db_file = os.path.join(work_dir, f"bench_{size}.db")
+    shutil.copyfile(cached, db_file)
+    return db_file
+
+
+def bench_consumer(db_file, size, generator, args):
+    """Ingest a file of new events with the real tailer, then time single batch commits."""
+    results = []
+    event_file = os.path.join(os.path.dirname(db_file), "events.jsonl")
+    with open(event_file, "w") as f:
+        f.write(generator.batch(args.ingest_events))
+    conn = connect_writer(db_file, check_same_thread=False)  # ParallelTailer writes from its own thread
+    create_offsets_table(conn)
+    # Point the checkpoint at the start of the file so the tailer treats it as backlog
+    save_events(conn, [], (event_file, file_id(os.stat(event_file)), 0))
+    tailer = EventTailer(conn, event_file, batch_size=DEFAULT_BATCH_SIZE)
+    tailer.open()
+    elapsed = timed(tailer.run, True)
+    tailer.close()
+    results.append(summarize("consumer.ingest", size, [elapsed], args.ingest_events, "events/s"))
+
+    if args.workers:
+        # Ingest the same file again with parsing spread over worker processes
+        save_events(conn, [], (event_file, file_id(os.stat(event_file)), 0))
+        tailer = ParallelTailer(conn, event_file, args.workers)
+        tailer.open()
+        elapsed = timed(tailer.run, True)
+        tailer.close()
+        results.append(summarize(f"consumer.ingest_parallel.{args.workers}", size, [elapsed], args.ingest_events, "events/s"))
+
+    samples = []
+    for _ in range(args.repeat):
+        events = [json.loads(line) for line in generator.batch(DEFAULT_BATCH_SIZE).splitlines()]
+        samples.append(timed(save_events, conn, events))
+    results.append(summarize("consumer.save_events", size, samples, DEFAULT_BATCH_SIZE, "events/s"))
+    conn.close()
+    return results
+
+def bench_aggregators(db_file, size, generator, args):
+    """Time each aggregator's first (full) run, then its ticks after each new batch."""
+    results = []
+    conn = connect_writer(db_file)
+    for name, update in AGGREGATORS:
+        results.append(summarize(f"{name}.build", size, [timed(update, conn)], size, "events/s"))
+    samples = {name: [] for name, _ in AGGREGATORS}
+    for _ in range(args.repeat):
+        save_events(conn, [json.loads(line) for line in generator.batch(args.tick_events).splitlines()])
+        for name, update in AGGREGATORS:
+            samples[name].append(timed(update, conn))
+    for name, _ in AGGREGATORS:
+        results.append(summarize(name, size, samples[name], args.tick_events, "events/s"))
+    conn.close()
+    return results
+
+def bench_report(db_file, size, args):
+    conn = connect_reader(db_file)
+    samples = []
+    for _ in range(args.repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            samples.append(timed(print_report, conn))
+    conn.close()
+    return [summarize("report", size, samples)]
+
+def bench_dashboard(db_file, size, args):
+    """Render the dashboard view against ``db_file`` without starting a server."""
+    sys.path.insert(0, os.path.join(REPO_ROOT, "dashboard"))
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "dashboard.settings")
+    import django
+    from django.db import connections
+    from django.test import RequestFactory
+    django.setup()
+    from analytics.views import dashboard
+
+    connection = connections["default"]
+    connection.close()
+    connection.settings_dict["NAME"] = db_file
+    request = RequestFactory().get("/")
+    samples = []
+    for _ in range(args.repeat):
+        samples.append(timed(dashboard, request))
+    connection.close()
+    return [summarize("dashboard", size, samples)]
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline, tolerance):
+    """Print p95 changes against a baseline run; returns the regressed results."""
+    previous = {(r["name"], r["events_in_db"]): r for r in baseline["results"]}
+    regressions = []
+    print(f"{'benchmark':<50} {'events':>10} {'p95 before':>12} {'p95 after':>12} {'ratio':>7}")
+    for result in results:
+        before = previous.get((result["name"], result["events_in_db"]))
+        if before is None or not before["p95_ms"]:
+            continue
+        ratio = result["p95_ms"] / before["p95_ms"]
+        flag = "  REGRESSION" if ratio > tolerance else ""
+        print(f"{result['name']:<50} {result['events_in_db']:>10} {before['p95_ms']:>12.3f} {result['p95_ms']:>12.3f} {ratio:>7.2f}{flag}")
+        if ratio > tolerance:
+            regressions.append(result)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the consumer, aggregators, report and dashboard at several table sizes")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10 ** 4, 10 ** 5], help="Events in the seeded table, e.g. 10000 ... 100000000")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, default=BENCHMARKS, help="Benchmarks to run")
+    parser.add_argument("--repeat", type=int, default=20, help="Samples per latency benchmark")
+    parser.add_argument("--ingest-events", type=int, default=20000, help="Events written to the file the consumer ingests")
+    parser.add_argument("--workers", type=int, default=0, help="Also ingest with consumer.worker using this many parser processes")
+    parser.add_argument("--tick-events", type=int, default=1000, help="New events inserted before each aggregator tick")
+    parser.add_argument("--users", type=int, default=100000, help="Users in the seeded catalog")
+    parser.add_argument("--products", type=int, default=10000, help="Products in the seeded catalog")
+    parser.add_argument("--days", type=int, default=1, help="Days of history the seeded events are spread over")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed for seeding and generated events")
+    parser.add_argument("--data-dir", help="Directory to keep seeded databases in for reuse")
+    parser.add_argument("--output", help="Write the JSON results here instead of stdout")
+    parser.add_argument("--compare", metavar="BASELINE", help="JSON results of an earlier run to compare p95 latencies with")
+    parser.add_argument("--tolerance", type=float, default=1.2, help="p95 ratio above which --compare reports a regression")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        data_dir = args.data_dir or tmp
+        os.makedirs(data_dir, exist_ok=True)
+        for size in args.sizes:
+            work_dir = tempfile.mkdtemp(dir=tmp)
+            db_file = prepare_database(data_dir, work_dir, size, args)
+            generator = LoadGenerator(users=args.users, products=args.products, seed=args.seed, rate=0)
+            print(f"Benchmarking {size} events", file=sys.stderr)
+            if "consumer" in args.only:
+                results += bench_consumer(db_file, size, generator, args)
+            if "aggregators" in args.only:
+                results += bench_aggregators(db_file, size, generator, args)
+            if "report" in args.only:
+                results += bench_report(db_file, size, args)
+            if "dashboard" in args.only:
+                results += bench_dashboard(db_file, size, args)
+            shutil.rmtree(work_dir)
+
+    run = {
+        "commit": git_commit(),
+        "started_at": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(run, f, indent=2)
+    else:
+        json.dump(run, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(results, json.load(f), args.tolerance):
+                raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
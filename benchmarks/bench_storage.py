@@ -0,0 +1,91 @@
+"""Report on-disk bytes per event for each events table layout.
+
+Builds one database per schema version with the same generated events,
+migrating the older layout forward, and reports table plus index bytes per
+event. With --db it reports the bytes per event of an existing database.
+Run from the repository root:
+
+    python -m benchmarks.bench_storage --events 100000
+    python -m benchmarks.bench_storage --db ecommerce.db
+"""
+import argparse
+import json
+import os
+import sqlite3
+import tempfile
+
+from consumer.consumer import save_events
+from event_generator import generate_event
+from storage.schema import migrate, schema_version
+
+EVENT_TABLES = ("events", "event_types", "users", "products")
+LEGACY_INSERT_SQL = """
+    INSERT INTO events (event_type, user_id, product_id, product_name, price, timestamp, raw)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+def bytes_per_event(conn):
+    """Bytes used by the events table, its indexes and lookup tables, per stored event."""
+    events = conn.execute("SELECT COUNT(*) FROM events").fetchone()[0]
+    names = [name for name, in conn.execute(
+        f"SELECT name FROM sqlite_schema WHERE tbl_name IN ({', '.join('?' * len(EVENT_TABLES))})",
+        EVENT_TABLES,
+    )]
+    total = conn.execute(
+        f"SELECT SUM(pgsize) FROM dbstat WHERE name IN ({', '.join('?' * len(names))})", names
+    ).fetchone()[0]
+    return events, total / events if events else 0.0
+
+
+def build_legacy(db_file, events, version):
+    """Fill a database at an older schema version the way its consumer did."""
+    conn = sqlite3.connect(db_file)
+    migrate(conn, target=version)
+    with conn:
+        conn.executemany(LEGACY_INSERT_SQL, [
+            (e["event_type"], e["user_id"], e["product_id"], e["product_name"], e["price"], e["timestamp"], json.dumps(e))
+            for e in events
+        ])
+    return conn
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report bytes per event before and after compact storage")
+    parser.add_argument("--events", type=int, default=100000, help="Number of generated events per layout")
+    parser.add_argument("--db", help="Report an existing database instead of generated ones")
+    args = parser.parse_args()
+
+    if args.db:
+        conn = sqlite3.connect(args.db)
+        events, per_event = bytes_per_event(conn)
+        print(f"{args.db}: schema version {schema_version(conn)}, {events} events, {per_event:.1f} bytes/event")
+        conn.close()
+        return
+
+    events = [generate_event() for _ in range(args.events)]
+    print(f"{'layout':<36} {'bytes/event':>12}")
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy = build_legacy(os.path.join(tmp, "legacy.db"), events, 1)
+        print(f"{'v1 text columns + raw':<36} {bytes_per_event(legacy)[1]:>12.1f}")
+        legacy.close()
+
+        indexed = build_legacy(os.path.join(tmp, "indexed.db"), events, 1)
+        migrate(indexed, target=3)
+        indexed.execute("VACUUM")
+        print(f"{'v3 type codes + indexes + raw':<36} {bytes_per_event(indexed)[1]:>12.1f}")
+        migrate(indexed)
+        indexed.execute("VACUUM")
+        print(f"{'v3 migrated to compact':<36} {bytes_per_event(indexed)[1]:>12.1f}")
+        indexed.close()
+
+        compact = sqlite3.connect(os.path.join(tmp, "compact.db"))
+        migrate(compact)
+        for start in range(0, len(events), 1000):
+            save_events(compact, events[start:start + 1000])
+        print(f"{'compact, written by consumer':<36} {bytes_per_event(compact)[1]:>12.1f}")
+        compact.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+from rollups import Rollup, register_rollup
+from storage.schema import PURCHASE_TYPE, iso_to_micros
+from storage.store import MAX_TS, MIN_TS, iter_daily_rollups, newest_event_ts
+from utils.logger import get_logger
+
+MINUTE = 60 * 1000000  # bucket widths in epoch micros
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+# Finest first: name, bucket width, and how far behind the newest event buckets are kept (None: forever)
+RESOLUTIONS = [("minute", MINUTE, 2 * DAY), ("hour", HOUR, 90 * DAY), ("day", DAY, None)]
+BUCKET_WIDTHS = {name: width for name, width, _ in RESOLUTIONS}
+
+logger = get_logger(__name__)
+
+UPSERT_BUCKETS_SQL = """
+INSERT INTO event_buckets (resolution, bucket_ts, event_type, events, revenue)
+VALUES (?, ?, ?, ?, ?)
+ON CONFLICT(resolution, bucket_ts, event_type) DO UPDATE SET
+    events=events + excluded.events,
+    revenue=revenue + excluded.revenue
+"""
+
+SELECT_SERIES_SQL = """
+SELECT bucket_ts, event_type, events, revenue
+FROM event_buckets
+WHERE resolution = ? AND bucket_ts >= ? AND bucket_ts < ?{types}
+ORDER BY bucket_ts, event_type
+"""
+
+SELECT_TOTALS_SQL = """
+SELECT event_type, SUM(events), SUM(revenue)
+FROM event_buckets
+WHERE resolution = ? AND bucket_ts >= ? AND bucket_ts < ?{types}
+GROUP BY event_type
+ORDER BY event_type
+"""
+
+def create_event_buckets_table(conn):
+    # bucket_ts is the start of the bucket in epoch micros (UTC), like events.ts
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS event_buckets (
+        resolution TEXT,
+        bucket_ts INTEGER,
+        event_type TEXT,
+        events INTEGER NOT NULL,
+        revenue REAL NOT NULL,
+        PRIMARY KEY (resolution, bucket_ts, event_type)
+    ) WITHOUT ROWID
+    """)
+    conn.commit()
+
+def bucket_start(ts, width):
+    return ts - ts % width
+
+def bucket_end(ts, width):
+    """The first bucket boundary at or after ``ts``."""
+    return ts + -ts % width
+
+@register_rollup
+class EventBucketsRollup(Rollup):
+    """Events and purchase revenue per event type in minute, hour and day buckets.
+
+    Events are folded into minute buckets; ``flush`` rolls the minute deltas
+    up into their hour buckets and those into day buckets, then drops buckets
+    older than their resolution keeps (measured from the newest event
+    folded, so replaying history prunes the way it did live). Compacted
+    history only has daily totals, so it only lands in day buckets.
+    Maintained by ``aggregator.py``; ``--rollups event_buckets`` runs it alone.
+    """
+
+    name = "event_buckets"
+
+    def __init__(self, **options):
+        self.deltas = {}  # (minute bucket, event_type) -> [events, revenue]
+        self.daily = {}  # (day bucket, event_type) -> [events, revenue], from compacted days
+        self.now = None
+
+    def create_table(self, conn):
+        create_event_buckets_table(conn)
+
+    def load(self, conn, last_event_id):
+        self.deltas = {}
+        self.daily = {}
+        self.now = newest_event_ts(conn, last_event_id)
+
+    def fold(self, event):
+        ts = event["ts"]
+        key = (ts - ts % MINUTE, event["event_type"])
+        delta = self.deltas.get(key)
+        if delta is None:
+            delta = self.deltas[key] = [0, 0.0]
+        delta[0] += 1
+        if key[1] == PURCHASE_TYPE:
+            delta[1] += event["price"]
+        if self.now is None or ts > self.now:
+            self.now = ts
+
+    def fold_daily(self, totals):
+        delta = self.daily.setdefault((iso_to_micros(totals["day"]), totals["event_type"]), [0, 0.0])
+        delta[0] += totals["events"]
+        if totals["event_type"] == PURCHASE_TYPE:
+            delta[1] += totals["revenue"]
+
+    def backfill(self, conn, history):
+        # Retention is measured from the newest event, as after a replay
+        self.load(conn, history.up_to_id)
+        for ts, event_type, events, revenue in history.minutes():
+            self.deltas[(ts, event_type)] = [events, revenue if event_type == PURCHASE_TYPE else 0.0]
+        for totals in iter_daily_rollups(conn):
+            self.fold_daily(totals)
+        self.flush(conn)
+
+    def cutoff(self, width, retention):
+        """Start of the oldest bucket a resolution keeps."""
+        if retention is None or self.now is None:
+            return MIN_TS
+        return bucket_start(self.now, width) - retention
+
+    def flush(self, conn):
+        rows = []
+        buckets = self.deltas
+        for resolution, width, retention in RESOLUTIONS:
+            if width != MINUTE:
+                # Each resolution is summed from the one below it
+                coarser = {}
+                for (ts, event_type), (events, revenue) in buckets.items():
+                    delta = coarser.setdefault((bucket_start(ts, width), event_type), [0, 0.0])
+                    delta[0] += events
+                    delta[1] += revenue
+                buckets = coarser
+            cutoff = self.cutoff(width, retention)
+            rows += [(resolution, ts, event_type, events, revenue)
+                     for (ts, event_type), (events, revenue) in buckets.items() if ts >= cutoff]
+            if retention is not None:
+                conn.execute("DELETE FROM event_buckets WHERE resolution = ? AND bucket_ts < ?", (resolution, cutoff))
+        rows += [("day", ts, event_type, events, revenue) for (ts, event_type), (events, revenue) in self.daily.items()]
+        conn.executemany(UPSERT_BUCKETS_SQL, rows)
+        self.deltas = {}
+        self.daily = {}
+
+def oldest_buckets(conn):
+    """Start of the oldest bucket kept per resolution; resolutions without buckets are missing."""
+    oldest = {}
+    for resolution, _, _ in RESOLUTIONS:
+        ts = conn.execute("SELECT MIN(bucket_ts) FROM event_buckets WHERE resolution = ?", (resolution,)).fetchone()[0]
+        if ts is not None:
+            oldest[resolution] = ts
+    return oldest
+
+def pick_resolution(conn, start_ts=None, end_ts=None):
+    """The coarsest resolution that answers ``start_ts <= ts < end_ts`` exactly.
+
+    A resolution can answer a range when both ends fall on its bucket
+    boundaries and its buckets reach back to ``start_ts`` (or to the oldest
+    event, if that is later). When none can, the finest one that reaches
+    back far enough is used and the range is widened to its buckets. Day
+    buckets are never pruned, so they always reach back far enough.
+    """
+    oldest = oldest_buckets(conn)
+    if not oldest:
+        return RESOLUTIONS[-1][0]
+    start_ts = max(MIN_TS if start_ts is None else start_ts, min(oldest.values()))
+    reaching = [(resolution, width) for resolution, width, _ in RESOLUTIONS
+                if resolution in oldest and oldest[resolution] <= start_ts]
+    for resolution, width in reversed(reaching):
+        if start_ts % width == 0 and (end_ts is None or end_ts % width == 0):
+            return resolution
+    return reaching[0][0]
+
+def bucket_query(conn, sql, start_ts, end_ts, resolution, event_types):
+    resolution = resolution or pick_resolution(conn, start_ts, end_ts)
+    width = BUCKET_WIDTHS[resolution]
+    params = [
+        resolution,
+        MIN_TS if start_ts is None else bucket_start(start_ts, width),
+        MAX_TS if end_ts is None else bucket_end(end_ts, width),
+    ]
+    types = ""
+    if event_types:
+        types = f" AND event_type IN ({', '.join('?' * len(event_types))})"
+        params += event_types
+    return resolution, conn.execute(sql.format(types=types), params).fetchall()
+
+def read_series(conn, start_ts=None, end_ts=None, resolution=None, event_types=None):
+    """``(resolution, rows)`` of (bucket_ts, event_type, events, revenue) for buckets in the range, oldest first.
+
+    ``resolution`` defaults to ``pick_resolution``; the range is widened to
+    whole buckets of it. Revenue only counts purchases, so "sales" are the
+    events of the purchase rows.
+    """
+    return bucket_query(conn, SELECT_SERIES_SQL, start_ts, end_ts, resolution, event_types)
+
+def read_totals(conn, start_ts=None, end_ts=None, resolution=None, event_types=None):
+    """``(resolution, rows)`` of (event_type, events, revenue) over the range, like ``read_series`` summed."""
+    return bucket_query(conn, SELECT_TOTALS_SQL, start_ts, end_ts, resolution, event_types)
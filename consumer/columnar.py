@@ -0,0 +1,49 @@
+from consumer.consumer import EventTailer
+from storage.columnar import FrameError, SegmentFile
+
+
+class ColumnarTailer(EventTailer):
+    """Tails a columnar event file (see storage/columnar.py) frame by frame.
+
+    Frames are decoded straight from a memory map of the file. A batch holds
+    whole frames and is committed with the offset just past the last one, so
+    a frame larger than ``batch_size`` is committed on its own. A corrupt
+    frame goes to dead_letters whole, and reading resumes at the next frame.
+    Only ``read`` differs from ``EventTailer``; checkpoints, linger,
+    catch-up, rotation and truncation work the same.
+    """
+
+    def __init__(self, conn, path, **options):
+        super().__init__(conn, path, **options)
+        self.segment = None
+
+    def open(self, skip_backlog=False):
+        super().open(skip_backlog)
+        self.segment = SegmentFile(self.f)
+
+    def close(self):
+        if self.segment is not None:
+            self.segment.close()
+            self.segment = None
+        super().close()
+
+    def read(self):
+        """Read the next frame into the batch, or into dead_letters if it is corrupt.
+
+        Returns False when no complete frame has been written yet.
+        """
+        if self.segment.f is not self.f:
+            self.segment.close()  # check_file switched to a rotated file
+            self.segment = SegmentFile(self.f)
+        self.segment.refresh()
+        try:
+            frame = self.segment.frame(self.offset)
+        except FrameError as e:
+            self.dead_letters.add(self.segment.view[self.offset:e.end].tobytes(), self.offset, e)
+            self.offset = e.end
+            return True
+        if frame is None:
+            return False
+        self.offset = frame.end
+        self.batch.extend(frame.events())
+        return True
@@ -1,92 +1,373 @@
 import sqlite3
-import json
 import time
-import logging
+import os
+import argparse
+from datetime import datetime
 from pathlib import Path
-from utils.logger import get_logger
+from consumer.dead_letters import DeadLetterQueue
+from rollups import AggregationEngine, StaleMarkError, load_rollups
+from storage.columnar import COLUMNAR_FILE
+from storage.connection import connect_writer, start_checkpointer
+from storage.schema import INSERT_EVENT_SQL, encode_events, migrate
+from track_top_users import parse_window
+from transport.base import DEFAULT_TRANSPORT, get_transport, transport_names
+from transport.segment_log import DEFAULT_GROUP, DEFAULT_TOPIC, LOG_DIR
+from utils.logger import fields, get_logger, sampled
+from utils.metrics import counter, gauge, histogram, serve as serve_metrics
+from utils.schema import DECODERS, SchemaError, get_decoder, parse_event, validate_event as coerce_event
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='[%(asctime)s] [%(levelname)s] %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
-logger = logging.getLogger(__name__)
+logger = get_logger(__name__)
+
+EVENTS_COMMITTED = counter("consumer_events_total", "Events committed to the events table")
+BATCH_SECONDS = histogram("consumer_batch_seconds", "Time to commit one batch with its offset")
+COMMIT_FAILURES = counter("consumer_commit_failures_total", "Batch commits that were rolled back and retried")
+COMMITTED_OFFSET = gauge("consumer_committed_offset_bytes", "Byte offset committed for each source file", ["source"])
+LAG_BYTES = gauge("consumer_lag_bytes", "Bytes written to each source file but not committed yet", ["source"])
+LAST_COMMIT = gauge("consumer_last_commit_timestamp_seconds", "Unix time of the last committed batch", ["source"])
 
 
 DB_FILE = "ecommerce.db"
 EVENT_FILE = "events.jsonl"
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_MAX_LINGER = 0.5  # seconds a partial batch may wait before it is flushed
+POLL_INTERVAL = 0.5  # seconds
+CATCH_UP_BATCH_SIZE = 10000  # events per transaction while replaying the backlog
+
+def create_events_table(conn):
+    # The events schema is versioned in storage/schema.py
+    migrate(conn)
 
-# Ensure DB connection is thread-safe
-conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-cur = conn.cursor()
-
-# Make sure the events table exists
-cur.execute("""
-CREATE TABLE IF NOT EXISTS events (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    event_type TEXT,
-    user_id TEXT,
-    product_id TEXT,
-    product_name TEXT,
-    price REAL,
-    timestamp TEXT,
-    raw TEXT
-)
-""")
-conn.commit()
+def invalid_reason(event):
+    """Why an event can't be stored, or None if it is valid (coerces it in place)."""
+    try:
+        coerce_event(event)
+    except SchemaError as e:
+        return str(e)
+    return None
 
 def validate_event(event):
-    required_keys = ["event_type", "user_id", "product_id", "product_name", "price", "timestamp"]
-    for key in required_keys:
-        if key not in event:
-            logger.warning(f"Invalid event missing '{key}': {event}")
-            return False
+    reason = invalid_reason(event)
+    if reason is not None:
+        logger.warning("Invalid event %s: %r", reason, event, extra=sampled(100))
+        return False
     return True
 
-def save_event(event):
+def save_event(conn, event, store_raw=False):
+    """Insert a single event and commit it on its own (one fsync per event)."""
     try:
-        cur.execute("""
-            INSERT INTO events (event_type, user_id, product_id, product_name, price, timestamp, raw)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (
-            event["event_type"],
-            event["user_id"],
-            event["product_id"],
-            event["product_name"],
-            event["price"],
-            event["timestamp"],
-            json.dumps(event)
-        ))
-        conn.commit()  # Important: commit after every insert
-        logger.debug(f"Saved event to database: {event['event_type']}")
+        conn.execute(INSERT_EVENT_SQL, encode_events(conn, [event], store_raw)[0])
+        conn.commit()
+        logger.debug("Saved event to database: %s", event["event_type"], extra=sampled(1000))
     except Exception as e:
+        conn.rollback()
         logger.exception("Failed to save event")
 
-def tail_and_consume():
-    logger.info("Tailing events.jsonl ...")
-    path = Path(EVENT_FILE)
-    path.touch(exist_ok=True)
-    with path.open("r") as f:
-        f.seek(0, 2)  # Go to end of file
-        while True:
-            line = f.readline()
-            if not line:
-                time.sleep(0.5)
-                continue
-            try:
-                event = json.loads(line.strip())
-                if validate_event(event):
-                    save_event(event)
-                    logger.info(f"Consumed event: {event}")
-                else:
-                    logger.warning(f"Skipped invalid event: {event}")
-            except Exception as e:
-                logger.exception("Failed to process line")
+def create_offsets_table(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS consumer_offsets (
+        source TEXT PRIMARY KEY,
+        file_id TEXT,
+        byte_offset INTEGER,
+        updated_at TEXT
+    )
+    """)
+    conn.commit()
+
+def file_id(stat_result):
+    """Identify a file across renames so rotation can be told apart from appends."""
+    return f"{stat_result.st_dev}:{stat_result.st_ino}"
+
+def load_checkpoint(conn, source):
+    row = conn.execute(
+        "SELECT file_id, byte_offset FROM consumer_offsets WHERE source = ?", (source,)
+    ).fetchone()
+    return row
+
+def save_checkpoint(conn, checkpoint):
+    """Store a ``(source, file_id, offset)`` checkpoint; call inside the batch's transaction."""
+    conn.execute("""
+        INSERT INTO consumer_offsets (source, file_id, byte_offset, updated_at)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(source) DO UPDATE SET
+            file_id=excluded.file_id,
+            byte_offset=excluded.byte_offset,
+            updated_at=excluded.updated_at
+    """, (*checkpoint, datetime.utcnow().isoformat()))
+
+def as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+def save_events(conn, events, checkpoint=None, engine=None, store_raw=False, dead_letters=None):
+    """Insert a batch of events in a single transaction.
+
+    ``checkpoint`` is an optional ``(source, file_id, offset)`` tuple, or a
+    list of them for a batch read from several partitions, that is written in
+    the same transaction, so the stored offset always points just past the
+    last committed event. With an ``engine`` (a
+    ``rollups.AggregationEngine``) the batch is also folded into the rollup
+    tables from memory in that transaction. ``store_raw`` keeps every JSON
+    payload instead of only those with fields beyond the typed columns.
+    ``dead_letters`` (a ``DeadLetterQueue`` or a list of them) writes the
+    batch's rejected lines.
+    Either the whole batch, its offset, dead letters and rollup deltas are
+    committed or none of them is; the caller retries the batch if this raises.
+    """
+    with conn:
+        if events:
+            conn.executemany(INSERT_EVENT_SQL, encode_events(conn, events, store_raw))
+            if engine is not None:
+                # Ids of one executemany inside a single write transaction are consecutive
+                last_event_id = conn.execute("SELECT MAX(id) FROM events").fetchone()[0]
+                engine.apply(events, last_event_id)
+        for queue in as_list(dead_letters):
+            queue.write(conn)
+        for offset in as_list(checkpoint):
+            save_checkpoint(conn, offset)
+    if engine is not None and events:
+        engine.committed(events[-1]["ts"])
+
+class EventTailer:
+    """Tails events.jsonl into the events table with a durable byte offset.
+
+    Lines are committed in micro-batches that flush on ``batch_size`` events or
+    after ``max_linger`` seconds, together with the offset just past the last
+    line of the batch. On startup the tailer resumes from that checkpoint and
+    ingests the backlog in batches of ``catch_up_batch_size`` without waiting
+    for the linger timer, then switches to live tailing. Truncation (the file
+    shrinks below the offset) and rotation (the path points to a new inode)
+    restart reading at the beginning of the current file. Lines that fail to
+    parse or validate go to the dead_letters table with the batch they were
+    read in (see consumer/dead_letters.py).
+    """
+
+    def __init__(self, conn, path, batch_size=DEFAULT_BATCH_SIZE, max_linger=DEFAULT_MAX_LINGER,
+                 catch_up_batch_size=CATCH_UP_BATCH_SIZE, engine=None, store_raw=False, decoder=None):
+        self.conn = conn
+        self.decoder = get_decoder(decoder)
+        self.engine = engine
+        self.store_raw = store_raw
+        self.path = Path(path)
+        self.source = str(path)
+        self.dead_letters = DeadLetterQueue(self.source)
+        self.batch_size = batch_size
+        self.max_linger = max_linger
+        self.catch_up_batch_size = catch_up_batch_size
+        self.f = None
+        self.file_id = None
+        self.offset = 0
+        self.committed_offset = 0
+        self.backlog_end = 0
+        self.batch = []
+        self.batch_started = None
+
+    def open(self, skip_backlog=False):
+        self.path.touch(exist_ok=True)
+        self.f = self.path.open("rb")
+        st = os.fstat(self.f.fileno())
+        self.file_id = file_id(st)
+        checkpoint = load_checkpoint(self.conn, self.source)
+        if checkpoint is None or skip_backlog:
+            offset = st.st_size  # No history to resume from: start with new events only
+        elif checkpoint[0] != self.file_id:
+            logger.warning(f"{self.source} was rotated while the consumer was stopped; reading the new file from the start")
+            offset = 0
+        elif checkpoint[1] > st.st_size:
+            logger.warning(f"{self.source} was truncated while the consumer was stopped; reading from the start")
+            offset = 0
+        else:
+            offset = checkpoint[1]
+        self.f.seek(offset)
+        self.offset = self.committed_offset = offset
+        self.backlog_end = st.st_size if offset < st.st_size else 0
+        if checkpoint is None or offset != checkpoint[1]:
+            self.flush()  # Anything appended from here on survives a crash before the first batch
+        if self.catching_up:
+            logger.info(f"Catching up on {self.backlog_end - offset} bytes of backlog from offset {offset}")
+        COMMITTED_OFFSET.labels(self.source).set_function(lambda: self.committed_offset)
+        LAG_BYTES.labels(self.source).set_function(self.lag_bytes)
+
+    def lag_bytes(self):
+        """Bytes written to the source and not committed, including a file it was rotated to."""
+        lag = max(os.fstat(self.f.fileno()).st_size - self.committed_offset, 0)
+        try:
+            path_stat = self.path.stat()
+        except FileNotFoundError:
+            return lag
+        if file_id(path_stat) != self.file_id:
+            lag += path_stat.st_size
+        return lag
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    @property
+    def catching_up(self):
+        return self.backlog_end > 0
+
+    def caught_up(self):
+        self.flush()
+        self.backlog_end = 0
+        logger.info("Caught up with backlog; switching to live tailing")
+
+    def flush(self):
+        try:
+            start = time.perf_counter()
+            save_events(self.conn, self.batch, (self.source, self.file_id, self.offset), self.engine, self.store_raw,
+                        self.dead_letters)
+            elapsed = time.perf_counter() - start
+            BATCH_SECONDS.observe(elapsed)
+            if self.batch:
+                EVENTS_COMMITTED.inc(len(self.batch))
+                logger.info("Committed batch", extra=fields(events=len(self.batch), offset=self.offset, ms=round(elapsed * 1000, 1)))
+            self.committed_offset = self.offset
+            LAST_COMMIT.labels(self.source).set(time.time())
+            self.dead_letters.committed()
+        except (sqlite3.Error, StaleMarkError):
+            COMMIT_FAILURES.inc()
+            if self.engine is not None:
+                self.engine.discard()
+            self.dead_letters.discard()
+            logger.exception(f"Failed to commit batch of {len(self.batch)} events, retrying from offset {self.committed_offset}")
+            self.f.seek(self.committed_offset)
+            self.offset = self.committed_offset
+            time.sleep(POLL_INTERVAL)
+        self.batch = []
+        self.batch_started = None
+
+    def check_file(self):
+        """Handle truncation or rotation once the current file has been read to EOF."""
+        try:
+            path_stat = self.path.stat()
+        except FileNotFoundError:
+            return  # Rotated away and not yet recreated; keep the old file until it is
+        if file_id(path_stat) != self.file_id:
+            logger.warning(f"{self.source} was rotated; switching to the new file")
+            self.flush()
+            self.f.close()
+            self.f = self.path.open("rb")
+            self.file_id = file_id(os.fstat(self.f.fileno()))
+        elif os.fstat(self.f.fileno()).st_size < self.offset:
+            logger.warning(f"{self.source} was truncated; reading from the start")
+            self.flush()
+            self.f.seek(0)
+        else:
+            return
+        self.offset = self.committed_offset = 0
+        self.flush()  # Persist the new position even before any event arrives
+
+    def read(self):
+        """Read the next line into the batch, or into dead_letters if it is invalid.
+
+        Returns False, leaving ``offset`` where it was, when no complete line
+        has been written yet. Tailers of other formats override this to read
+        their own records (see consumer/columnar.py).
+        """
+        line = self.f.readline()
+        if not line.endswith(b"\n"):
+            # EOF, or a line the producer has not finished writing yet
+            self.f.seek(self.offset)
+            return False
+        self.offset += len(line)
+        try:
+            self.batch.append(parse_event(line, self.decoder))
+        except ValueError as e:
+            # Malformed or invalid: kept with the batch, reported in periodic summaries
+            self.dead_letters.add(line, self.offset - len(line), e)
+        return True
+
+    def run(self, once=False):
+        """Tail the file until interrupted, or with ``once`` until everything written so far is committed."""
+        logger.info(f"Tailing {self.source} (batch size {self.batch_size}, max linger {self.max_linger}s) ...")
+        try:
+            while True:
+                if not self.read():
+                    if self.catching_up:
+                        self.caught_up()  # The backlog ended in a partial record
+                    if self.batch or self.offset != self.committed_offset:
+                        if self.catching_up or once or time.monotonic() - self.batch_started >= self.max_linger:
+                            self.flush()
+                            continue
+                    elif once:
+                        return
+                    elif os.fstat(self.f.fileno()).st_size <= self.offset:
+                        self.check_file()  # Nothing partial left to wait for
+                    time.sleep(POLL_INTERVAL if not self.batch else min(POLL_INTERVAL, self.max_linger))
+                    continue
+                if self.batch_started is None:
+                    self.batch_started = time.monotonic()
+                pending = len(self.batch) + len(self.dead_letters)
+                if self.catching_up:
+                    if self.offset >= self.backlog_end:
+                        self.caught_up()
+                    elif pending >= self.catch_up_batch_size:
+                        self.flush()
+                elif pending >= self.batch_size or time.monotonic() - self.batch_started >= self.max_linger:
+                    self.flush()
+        finally:
+            # Don't drop events that were read but not yet committed on shutdown
+            if self.offset != self.committed_offset:
+                self.flush()
+            self.dead_letters.log_summary(force=True)
+
+def tail_and_consume(conn, batch_size=DEFAULT_BATCH_SIZE, max_linger=DEFAULT_MAX_LINGER,
+                     catch_up_batch_size=CATCH_UP_BATCH_SIZE, skip_backlog=False, engine=None, store_raw=False,
+                     once=False, decoder=None, transport=None):
+    """Consume from ``transport`` (a ``transport.base.Transport``; events.jsonl by default) until done."""
+    transport = transport or get_transport(DEFAULT_TRANSPORT, path=EVENT_FILE)
+    tailer = transport.consumer(conn, batch_size=batch_size, max_linger=max_linger,
+                                catch_up_batch_size=catch_up_batch_size, engine=engine, store_raw=store_raw,
+                                decoder=decoder)
+    tailer.open(skip_backlog)
+    try:
+        tailer.run(once)
+    finally:
+        tailer.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Consume events.jsonl, or a segment log topic, into the events table")
+    parser.add_argument("--transport", choices=transport_names(), default=DEFAULT_TRANSPORT, help="Where to read events from: events.jsonl, a partitioned segment log or a columnar file")
+    parser.add_argument("--log-dir", default=LOG_DIR, help="Segment log directory (log transport)")
+    parser.add_argument("--topic", default=DEFAULT_TOPIC, help="Segment log topic (log transport)")
+    parser.add_argument("--columnar-file", default=COLUMNAR_FILE, help="File of binary event frames (columnar transport)")
+    parser.add_argument("--group", default=DEFAULT_GROUP, help="Consumer group; consumers in one group split the topic's partitions (log transport)")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Maximum events per committed batch (1 commits every event)")
+    parser.add_argument("--max-linger", type=float, default=DEFAULT_MAX_LINGER, help="Maximum seconds a partial batch waits before it is committed")
+    parser.add_argument("--catch-up-batch-size", type=int, default=CATCH_UP_BATCH_SIZE, help="Events per transaction while replaying the backlog after a restart")
+    parser.add_argument("--skip-backlog", action="store_true", help="Ignore the stored offset and start at the end of the file")
+    parser.add_argument("--push-rollups", nargs="*", metavar="ROLLUP", help="Update these rollups (all when none are named) from memory on every batch commit")
+    parser.add_argument("--window", type=parse_window, help="Recent purchases considered by top_users in push mode: a count or a duration (1h)")
+    parser.add_argument("--top-k", type=int, help="Number of users kept in top_users in push mode")
+    parser.add_argument("--store-raw", action="store_true", help="Keep every raw JSON payload, not only those with extra fields")
+    parser.add_argument("--once", action="store_true", help="Ingest everything written so far and exit instead of tailing")
+    parser.add_argument("--decoder", choices=sorted(DECODERS), help="JSON decoder for event lines (default: fastest available, or $EVENT_DECODER)")
+    parser.add_argument("--metrics-port", type=int, help="Serve Prometheus metrics on this port at /metrics")
+    args = parser.parse_args()
+    if args.metrics_port:
+        serve_metrics(args.metrics_port)
+
+    # Ensure DB connection is thread-safe
+    conn = connect_writer(DB_FILE, check_same_thread=False)
+    start_checkpointer(DB_FILE)
+    create_events_table(conn)
+    create_offsets_table(conn)
 
-if __name__ == "__main__":
     try:
-        tail_and_consume()
+        engine = None
+        if args.push_rollups is not None:
+            options = {name: value for name, value in [("window", args.window), ("top_k", args.top_k)] if value}
+            engine = AggregationEngine(conn, load_rollups(args.push_rollups, **options))
+            engine.run_pass()  # Catch up on events stored before push mode started
+        transport = get_transport(args.transport, path=EVENT_FILE, log_dir=args.log_dir, topic=args.topic, group=args.group,
+                                  columnar_file=args.columnar_file)
+        tail_and_consume(conn, args.batch_size, args.max_linger, args.catch_up_batch_size, args.skip_backlog, engine, args.store_raw, args.once, args.decoder, transport)
     except KeyboardInterrupt:
         logger.info("Stopping consumer...")
     finally:
         conn.close()
+
+if __name__ == "__main__":
+    main()
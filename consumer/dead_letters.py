@@ -0,0 +1,219 @@
+import sys
+import time
+import argparse
+from collections import Counter
+from storage.connection import connect_writer
+from storage.schema import INSERT_EVENT_SQL, encode_events, micros_to_iso, migrate
+from utils.logger import get_logger
+from utils.metrics import counter
+from utils.schema import error_reason, get_decoder, parse_event
+
+DB_FILE = "ecommerce.db"
+DEFAULT_LOG_INTERVAL = 10  # seconds between dead-letter summaries in the log
+REDRIVE_CHUNK_SIZE = 1000  # dead letters re-parsed per transaction
+LOGGED_LINE_BYTES = 200  # how much of the example line a summary shows
+
+logger = get_logger(__name__)
+
+DEAD_LETTERS = counter("consumer_dead_letters_total", "Lines routed to the dead_letters table", ["reason"])
+
+INSERT_DEAD_LETTER_SQL = """
+    INSERT INTO dead_letters (source, byte_offset, reason, detail, line, received_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+
+def dead_letter(line, offset, error):
+    """The ``(byte_offset, reason, detail, line, received_at)`` record for a line parse_event rejected."""
+    return offset, error_reason(error), str(error), line, time.time_ns() // 1000
+
+
+class DeadLetterQueue:
+    """Collects the lines of one source that could not be stored.
+
+    Records wait in memory until ``write`` is called inside the transaction
+    of the batch they were read with, so a dead letter is committed exactly
+    when the offset past it is, and is re-read with the batch if that
+    transaction is rolled back. ``counts`` holds the lines dead-lettered per
+    reason since start. Rather than a log record per line, a summary of the
+    counts with the latest example is logged at most every ``log_interval``
+    seconds, so dirty input costs little more than clean input.
+    """
+
+    def __init__(self, source, log_interval=DEFAULT_LOG_INTERVAL):
+        self.source = source
+        self.log_interval = log_interval
+        self.pending = []
+        self.counts = Counter()
+        self.unlogged = Counter()  # per reason since the last summary
+        self.example = None
+        self.last_log = None
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, line, offset, error):
+        self.pending.append(dead_letter(line, offset, error))
+
+    def extend(self, records):
+        self.pending.extend(records)
+
+    def write(self, conn):
+        """Insert the pending records; call inside the batch's transaction."""
+        if self.pending:
+            conn.executemany(INSERT_DEAD_LETTER_SQL, [(self.source, *record) for record in self.pending])
+
+    def committed(self):
+        """The batch transaction committed: count the records and maybe log a summary."""
+        if not self.pending:
+            return
+        reasons = Counter(record[1] for record in self.pending)
+        self.counts.update(reasons)
+        for reason, count in reasons.items():
+            DEAD_LETTERS.labels(reason).inc(count)
+        self.unlogged.update(reasons)
+        self.example = self.pending[-1]
+        self.pending = []
+        self.log_summary()
+
+    def discard(self):
+        """The batch transaction was rolled back; its lines are read again."""
+        self.pending = []
+
+    def log_summary(self, force=False):
+        now = time.monotonic()
+        if not self.unlogged or (not force and self.last_log is not None and now - self.last_log < self.log_interval):
+            return
+        offset, reason, detail, line, _ = self.example
+        breakdown = ", ".join(f"{reason}={count}" for reason, count in self.unlogged.most_common())
+        logger.warning(f"Dead-lettered {sum(self.unlogged.values())} lines from {self.source} ({breakdown}); "
+                       f"latest at offset {offset}: {reason} {detail}: {bytes(line[:LOGGED_LINE_BYTES])!r}")
+        self.unlogged.clear()
+        self.last_log = now
+
+
+def select_dead_letters(reason=None, ids=None):
+    """WHERE clause and parameters picking dead letters by reason and/or id."""
+    clauses, params = [], []
+    if reason:
+        clauses.append("reason = ?")
+        params.append(reason)
+    if ids:
+        clauses.append(f"id IN ({', '.join('?' * len(ids))})")
+        params.extend(ids)
+    return (" AND ".join(clauses) or "1"), params
+
+def summarize(conn):
+    return conn.execute("""
+        SELECT reason, COUNT(*), MIN(received_at), MAX(received_at)
+        FROM dead_letters
+        GROUP BY reason
+        ORDER BY COUNT(*) DESC
+    """).fetchall()
+
+def redrive(conn, reason=None, ids=None, store_raw=False, decoder=None, chunk_size=REDRIVE_CHUNK_SIZE):
+    """Parse dead letters again and move the ones that are now valid into events.
+
+    Meant for after the schema or a decoder was fixed; each chunk of stored
+    events and deleted dead letters is committed together. Lines that still
+    fail stay, with their reason and detail updated. Returns the number of
+    lines stored and still rejected.
+    """
+    where, params = select_dead_letters(reason, ids)
+    loads = get_decoder(decoder)
+    stored = rejected = 0
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            f"SELECT id, line FROM dead_letters WHERE {where} AND id > ? ORDER BY id LIMIT ?",
+            [*params, last_id, chunk_size],
+        ).fetchall()
+        if not rows:
+            break
+        events, done, failed = [], [], []
+        for dead_letter_id, line in rows:
+            try:
+                events.append(parse_event(bytes(line), loads))
+                done.append((dead_letter_id,))
+            except ValueError as e:
+                failed.append((error_reason(e), str(e), dead_letter_id))
+        with conn:
+            if events:
+                conn.executemany(INSERT_EVENT_SQL, encode_events(conn, events, store_raw))
+            conn.executemany("DELETE FROM dead_letters WHERE id = ?", done)
+            conn.executemany("UPDATE dead_letters SET reason = ?, detail = ? WHERE id = ?", failed)
+        stored += len(events)
+        rejected += len(failed)
+        last_id = rows[-1][0]
+    return stored, rejected
+
+def export(conn, output, reason=None, ids=None):
+    """Write the selected lines, one per line, e.g. to fix them by hand and replay them."""
+    where, params = select_dead_letters(reason, ids)
+    exported = 0
+    for (line,) in conn.execute(f"SELECT line FROM dead_letters WHERE {where} ORDER BY id", params):
+        line = bytes(line)
+        output.write(line if line.endswith(b"\n") else line + b"\n")
+        exported += 1
+    return exported
+
+def purge(conn, reason=None, ids=None):
+    where, params = select_dead_letters(reason, ids)
+    with conn:
+        return conn.execute(f"DELETE FROM dead_letters WHERE {where}", params).rowcount
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Inspect and re-drive lines the consumer dead-lettered",
+        epilog="To fix lines by hand: --export FILE, edit FILE, append it with "
+               "`python event_generator.py --replay FILE --keep-timestamps --speed 0`, then --purge.",
+    )
+    action = parser.add_mutually_exclusive_group()
+    action.add_argument("--show", type=int, metavar="N", help="Print the N most recent dead letters")
+    action.add_argument("--redrive", action="store_true", help="Parse the selected lines again and store those that are now valid")
+    action.add_argument("--export", metavar="FILE", help="Write the selected lines to FILE ('-' for stdout)")
+    action.add_argument("--purge", action="store_true", help="Delete the selected dead letters")
+    parser.add_argument("--reason", help="Only dead letters with this reason code")
+    parser.add_argument("--ids", type=int, nargs="+", help="Only these dead letter ids")
+    parser.add_argument("--store-raw", action="store_true", help="Keep the raw payload of re-driven events")
+    parser.add_argument("--decoder", help="JSON decoder used to re-parse lines")
+    args = parser.parse_args()
+
+    conn = connect_writer(DB_FILE)
+    migrate(conn)
+    try:
+        if args.redrive:
+            stored, rejected = redrive(conn, args.reason, args.ids, args.store_raw, args.decoder)
+            logger.info(f"Re-drove {stored} dead letters into events; {rejected} are still invalid")
+        elif args.export:
+            if args.export == "-":
+                exported = export(conn, sys.stdout.buffer, args.reason, args.ids)
+            else:
+                with open(args.export, "wb") as f:
+                    exported = export(conn, f, args.reason, args.ids)
+            logger.info(f"Exported {exported} dead letters")
+        elif args.purge:
+            logger.info(f"Deleted {purge(conn, args.reason, args.ids)} dead letters")
+        elif args.show:
+            where, params = select_dead_letters(args.reason, args.ids)
+            rows = conn.execute(
+                f"SELECT id, source, byte_offset, reason, detail, line, received_at FROM dead_letters "
+                f"WHERE {where} ORDER BY id DESC LIMIT ?", [*params, args.show],
+            ).fetchall()
+            for dead_letter_id, source, offset, reason, detail, line, received_at in reversed(rows):
+                print(f"#{dead_letter_id} {micros_to_iso(received_at)} {source}@{offset} {reason}: {detail}")
+                print("    " + bytes(line).rstrip(b"\r\n").decode(errors="replace"))
+        else:
+            rows = summarize(conn)
+            if not rows:
+                print("No dead letters.")
+                return
+            print(f"{'Reason':<20} {'Lines':>8}  {'First':<26} {'Last':<26}")
+            for reason, count, first, last in rows:
+                print(f"{reason:<20} {count:>8}  {micros_to_iso(first):<26} {micros_to_iso(last):<26}")
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+import time
+import sqlite3
+from consumer.consumer import (
+    BATCH_SECONDS, CATCH_UP_BATCH_SIZE, COMMIT_FAILURES, COMMITTED_OFFSET, DEFAULT_BATCH_SIZE, DEFAULT_MAX_LINGER,
+    EVENTS_COMMITTED, LAG_BYTES, LAST_COMMIT, POLL_INTERVAL, load_checkpoint, save_events,
+)
+from consumer.dead_letters import DeadLetterQueue
+from rollups import StaleMarkError
+from transport.segment_log import DEFAULT_GROUP, GroupMembership, PartitionReader
+from utils.logger import fields, get_logger
+from utils.schema import get_decoder, parse_event
+
+REBALANCE_INTERVAL = 5  # seconds between checks of the group's members
+
+logger = get_logger(__name__)
+
+
+class GroupTailer:
+    """Consumes a segment log topic as one member of a consumer group.
+
+    Each partition the member owns is read from the offset committed for
+    it in consumer_offsets (one row per group and partition). Events from
+    all owned partitions are committed in micro-batches, together with
+    every partition's new offset, its dead letters and the rollup deltas,
+    so a batch is stored exactly once whichever member reads it next.
+    Batching, linger, catch-up and push-mode rollups work as in
+    ``EventTailer``.
+
+    Every ``REBALANCE_INTERVAL`` seconds the member looks at the group again.
+    It commits and releases the partitions it no longer owns, and claims the
+    newly assigned ones once their previous owner has let go.
+    """
+
+    def __init__(self, conn, log, group=DEFAULT_GROUP, batch_size=DEFAULT_BATCH_SIZE, max_linger=DEFAULT_MAX_LINGER,
+                 catch_up_batch_size=CATCH_UP_BATCH_SIZE, engine=None, store_raw=False, decoder=None):
+        self.conn = conn
+        self.log = log
+        self.group = group
+        self.decoder = get_decoder(decoder)
+        self.engine = engine
+        self.store_raw = store_raw
+        self.batch_size = batch_size
+        self.max_linger = max_linger
+        self.catch_up_batch_size = catch_up_batch_size
+        self.membership = None
+        self.skip_backlog = False
+        self.readers = {}  # partition -> PartitionReader
+        self.committed = {}  # partition -> committed offset, None until the first commit
+        self.rewind = {}  # partition -> offset the uncommitted events were read from
+        self.backlog_end = {}  # partition -> end of the backlog found when it was claimed
+        self.dead_letters = {}  # partition -> DeadLetterQueue
+        self.batch = []
+        self.batch_started = None
+        self.next_rebalance = 0
+        self.turn = 0
+
+    def source(self, partition):
+        return f"{self.log.path}/{partition}@{self.group}"
+
+    def open(self, skip_backlog=False):
+        self.membership = GroupMembership(self.log, self.group)
+        self.skip_backlog = skip_backlog
+        self.rebalance()
+        self.skip_backlog = False  # Partitions taken over later continue from their offsets
+
+    def close(self):
+        for partition in list(self.readers):
+            self.release(partition)
+        if self.membership is not None:
+            self.membership.leave()
+            self.membership = None
+        self.log.close()
+
+    def rebalance(self):
+        assigned = set(self.membership.assignment())
+        revoked = [partition for partition in self.readers if partition not in assigned]
+        if revoked:
+            if self.uncommitted():
+                self.flush()  # Hand over the partitions with everything read from them committed
+            for partition in revoked:
+                self.release(partition)
+        claimed = [partition for partition in sorted(assigned - self.readers.keys()) if self.membership.claim(partition)]
+        for partition in claimed:
+            self.claim(partition)
+        if revoked or claimed:
+            logger.info(f"{self.membership.member_id} of group {self.group} reads partitions "
+                        f"{sorted(self.readers)} of {self.log.partitions}")
+            if self.uncommitted():
+                self.flush()  # Persist new starting positions before any event arrives
+        self.next_rebalance = time.monotonic() + REBALANCE_INTERVAL
+
+    def claim(self, partition):
+        source = self.source(partition)
+        end = self.log.end_offset(partition)
+        checkpoint = load_checkpoint(self.conn, source)
+        committed = None
+        if checkpoint is None or self.skip_backlog:
+            offset = end  # No history to resume from: start with new events only
+        elif checkpoint[0] != self.log.id:
+            logger.warning(f"{self.log.path} was recreated since {source} was committed; reading it from the start")
+            offset = 0
+        else:
+            offset = committed = checkpoint[1]
+        reader = self.readers[partition] = PartitionReader(self.log, partition, offset)
+        self.committed[partition] = committed if reader.offset == committed else None
+        self.rewind[partition] = reader.offset
+        self.backlog_end[partition] = end if reader.offset < end else 0
+        self.dead_letters[partition] = DeadLetterQueue(source)
+        if self.backlog_end[partition]:
+            logger.info(f"Catching up on {end - reader.offset} bytes of {source} from offset {reader.offset}")
+        COMMITTED_OFFSET.labels(source).set_function(lambda: self.committed.get(partition) or 0)
+        LAG_BYTES.labels(source).set_function(lambda: max(reader.end_offset() - (self.committed.get(partition) or 0), 0))
+
+    def release(self, partition):
+        source = self.source(partition)
+        self.readers.pop(partition).close()
+        del self.committed[partition], self.rewind[partition], self.backlog_end[partition]
+        self.dead_letters.pop(partition).log_summary(force=True)
+        self.membership.release(partition)
+        # Lag on this partition is now reported by its new owner
+        for gauge in (COMMITTED_OFFSET, LAG_BYTES):
+            gauge.labels(source).set_function(None)
+            gauge.labels(source).set(0)
+
+    @property
+    def catching_up(self):
+        return any(self.backlog_end.values())
+
+    def pending(self):
+        return len(self.batch) + sum(len(queue) for queue in self.dead_letters.values())
+
+    def uncommitted(self):
+        return self.pending() or any(reader.offset != self.committed[p] for p, reader in self.readers.items())
+
+    def read(self, limit):
+        """Parse up to ``limit`` lines, taking turns over the owned partitions; returns the number read."""
+        partitions = sorted(self.readers)
+        if not partitions:
+            return 0
+        read = 0
+        self.turn = (self.turn + 1) % len(partitions)
+        for partition in partitions[self.turn:] + partitions[:self.turn]:
+            reader = self.readers[partition]
+            while read < limit:
+                line = reader.readline()
+                if not line:
+                    break
+                read += 1
+                try:
+                    self.batch.append(parse_event(line, self.decoder))
+                except ValueError as e:
+                    self.dead_letters[partition].add(line, reader.offset - len(line), e)
+            if reader.offset >= self.backlog_end[partition]:
+                self.backlog_end[partition] = 0
+        if read and self.batch_started is None:
+            self.batch_started = time.monotonic()
+        return read
+
+    def flush(self):
+        checkpoints = [
+            (self.source(partition), self.log.id, reader.offset)
+            for partition, reader in self.readers.items() if reader.offset != self.committed[partition]
+        ]
+        queues = list(self.dead_letters.values())
+        try:
+            start = time.perf_counter()
+            save_events(self.conn, self.batch, checkpoints, self.engine, self.store_raw, queues)
+            elapsed = time.perf_counter() - start
+            BATCH_SECONDS.observe(elapsed)
+            if self.batch:
+                EVENTS_COMMITTED.inc(len(self.batch))
+                logger.info("Committed batch", extra=fields(events=len(self.batch), partitions=len(checkpoints),
+                                                            ms=round(elapsed * 1000, 1)))
+            now = time.time()
+            for source, _, offset in checkpoints:
+                LAST_COMMIT.labels(source).set(now)
+            for partition, reader in self.readers.items():
+                self.committed[partition] = self.rewind[partition] = reader.offset
+            for queue in queues:
+                queue.committed()
+        except (sqlite3.Error, StaleMarkError):
+            COMMIT_FAILURES.inc()
+            if self.engine is not None:
+                self.engine.discard()
+            for queue in queues:
+                queue.discard()
+            logger.exception(f"Failed to commit batch of {len(self.batch)} events, retrying from the committed offsets")
+            # Also partitions never committed yet go back to where they were claimed
+            for partition, reader in self.readers.items():
+                reader.seek(self.rewind[partition])
+            time.sleep(POLL_INTERVAL)
+        self.batch = []
+        self.batch_started = None
+
+    def run(self, once=False):
+        """Consume until interrupted, or with ``once`` until the owned partitions are committed to their end."""
+        logger.info(f"Consuming {self.log.path} as group {self.group} (batch size {self.batch_size}, "
+                    f"max linger {self.max_linger}s) ...")
+        try:
+            while True:
+                if time.monotonic() >= self.next_rebalance:
+                    self.rebalance()
+                limit = self.catch_up_batch_size if self.catching_up else self.batch_size
+                read = self.read(limit - self.pending())
+                if self.pending() >= limit:
+                    self.flush()
+                elif read:
+                    if not self.catching_up and time.monotonic() - self.batch_started >= self.max_linger:
+                        self.flush()
+                elif self.uncommitted():
+                    # Nothing more to read right now
+                    if once or self.batch_started is None or time.monotonic() - self.batch_started >= self.max_linger:
+                        self.flush()
+                    else:
+                        time.sleep(min(POLL_INTERVAL, self.max_linger))
+                elif once:
+                    return
+                else:
+                    time.sleep(POLL_INTERVAL)
+        finally:
+            # Don't drop events that were read but not yet committed on shutdown
+            if self.uncommitted():
+                self.flush()
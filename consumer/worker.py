@@ -0,0 +1,216 @@
+import os
+import sqlite3
+import time
+import queue
+import signal
+import argparse
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from consumer.consumer import (
+    BATCH_SECONDS, COMMIT_FAILURES, DB_FILE, EVENT_FILE, EVENTS_COMMITTED, LAST_COMMIT, POLL_INTERVAL, EventTailer,
+    create_events_table, create_offsets_table, file_id, save_checkpoint,
+)
+from consumer.dead_letters import dead_letter
+from storage.connection import connect_writer, start_checkpointer
+from storage.schema import INSERT_EVENT_SQL, encode_rows, event_fields
+from utils.logger import fields, get_logger
+from utils.metrics import serve as serve_metrics
+from utils.schema import DECODERS, get_decoder, parse_event
+
+DEFAULT_WORKERS = os.cpu_count() or 1
+DEFAULT_CHUNK_BYTES = 1 << 20  # about 5000 events per chunk
+QUEUE_CHUNKS_PER_WORKER = 2  # chunks in flight per worker before the reader blocks
+
+logger = get_logger(__name__)
+
+
+def parse_chunk(data, store_raw=False, decoder=None, offset=0):
+    """Parse, validate and encode a block of complete lines in a worker process.
+
+    ``offset`` is the file position of ``data``. Returns the ``event_fields``
+    tuples of the valid events, in file order, and the ``dead_letter`` records
+    of the other lines. Nothing is logged per event.
+    """
+    loads = get_decoder(decoder)
+    rows, invalid = [], []
+    for line in data.splitlines(keepends=True):
+        if line.strip():
+            try:
+                rows.append(event_fields(parse_event(line, loads), store_raw))
+            except ValueError as e:
+                invalid.append(dead_letter(line, offset, e))
+        offset += len(line)
+    return rows, invalid
+
+def ignore_interrupts():
+    # Ctrl+C reaches the whole process group; let the main process shut the pool down in order
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class ParallelTailer(EventTailer):
+    """Tails events.jsonl with parsing spread over a process pool.
+
+    Three stages: the reader (the calling thread) cuts the file into
+    line-aligned chunks of about ``chunk_bytes`` and submits each to the
+    pool; workers parse, validate and encode the lines (``parse_chunk``); a
+    single writer thread takes the results in file order, resolves user and
+    product keys, and commits each chunk's rows together with the offset just
+    past it. Chunks in flight are bounded by ``queue_size``, so a slow writer
+    stalls the reader instead of buffering the file in memory.
+
+    Checkpoints, dead letters, rotation and truncation behave as in ``EventTailer``.
+    Rollups are not pushed from this mode; run the aggregator alongside it.
+    """
+
+    def __init__(self, conn, path, workers=DEFAULT_WORKERS, chunk_bytes=DEFAULT_CHUNK_BYTES,
+                 queue_size=None, store_raw=False, decoder=None):
+        super().__init__(conn, path, store_raw=store_raw, decoder=decoder)
+        self.decoder_name = decoder
+        self.workers = workers
+        self.chunk_bytes = chunk_bytes
+        self.queue_size = queue_size or workers * QUEUE_CHUNKS_PER_WORKER
+        self.writer_error = None
+
+    def read_chunk(self):
+        """Read up to ``chunk_bytes`` ending at a line boundary; b"" at EOF or a partial line."""
+        data = self.f.read(self.chunk_bytes)
+        if data and not data.endswith(b"\n"):
+            data += self.f.readline()  # Finish the line the chunk cut through, if it is complete
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            self.f.seek(self.offset + end)  # Leave a partial line for the next read
+        return data[:end]
+
+    def reopen_if_rotated(self):
+        """Like ``check_file``, but the new position is committed by the writer, in order."""
+        try:
+            path_stat = self.path.stat()
+        except FileNotFoundError:
+            return False
+        if file_id(path_stat) != self.file_id:
+            logger.warning(f"{self.source} was rotated; switching to the new file")
+            self.f.close()
+            self.f = self.path.open("rb")
+            self.file_id = file_id(os.fstat(self.f.fileno()))
+        elif os.fstat(self.f.fileno()).st_size < self.offset:
+            logger.warning(f"{self.source} was truncated; reading from the start")
+            self.f.seek(0)
+        else:
+            return False
+        self.offset = 0
+        return True
+
+    def enqueue(self, pending, item):
+        """Block until the writer has room, giving up if it has died."""
+        while True:
+            try:
+                pending.put(item, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                if self.writer_error is not None:
+                    return False
+
+    def write_chunks(self, pending):
+        keys = {}  # user and product keys already looked up or added
+        try:
+            while True:
+                item = pending.get()
+                if item is None:
+                    return
+                future, chunk_file_id, end = item
+                rows, invalid = future.result() if future is not None else ([], [])
+                self.dead_letters.extend(invalid)
+                while True:
+                    start = time.perf_counter()
+                    try:
+                        with self.conn:
+                            if rows:
+                                self.conn.executemany(INSERT_EVENT_SQL, encode_rows(self.conn, rows, keys))
+                            self.dead_letters.write(self.conn)
+                            save_checkpoint(self.conn, (self.source, chunk_file_id, end))
+                        break
+                    except sqlite3.OperationalError:
+                        # Locked or busy: retry the same rows; anything else stops the writer
+                        COMMIT_FAILURES.inc()
+                        keys.clear()  # Keys added by the rolled-back transaction are gone
+                        logger.exception(f"Failed to commit {len(rows)} events, retrying")
+                        time.sleep(POLL_INTERVAL)
+                elapsed = time.perf_counter() - start
+                BATCH_SECONDS.observe(elapsed)
+                EVENTS_COMMITTED.inc(len(rows))
+                self.committed_offset = end
+                LAST_COMMIT.labels(self.source).set(time.time())
+                self.dead_letters.committed()
+                logger.info("Committed batch", extra=fields(events=len(rows), offset=end, ms=round(elapsed * 1000, 1)))
+        except BaseException as e:
+            self.writer_error = e
+            logger.exception("Writer stopped")
+        finally:
+            self.dead_letters.log_summary(force=True)
+
+    def run(self, once=False):
+        logger.info(f"Tailing {self.source} with {self.workers} parser processes "
+                    f"({self.chunk_bytes} byte chunks, {self.queue_size} in flight) ...")
+        pending = queue.Queue(maxsize=self.queue_size)
+        writer = threading.Thread(target=self.write_chunks, args=(pending,), name="writer")
+        with ProcessPoolExecutor(self.workers, initializer=ignore_interrupts) as pool:
+            writer.start()
+            try:
+                while self.writer_error is None:
+                    data = self.read_chunk()
+                    if data:
+                        future = pool.submit(parse_chunk, data, self.store_raw, self.decoder_name, self.offset)
+                        self.offset += len(data)
+                        if not self.enqueue(pending, (future, self.file_id, self.offset)):
+                            break
+                        continue
+                    if self.catching_up:
+                        self.backlog_end = 0
+                        logger.info("Caught up with backlog; switching to live tailing")
+                    if once:
+                        break
+                    if self.reopen_if_rotated():
+                        # Persist the new position even before any event arrives
+                        self.enqueue(pending, (None, self.file_id, 0))
+                        continue
+                    time.sleep(POLL_INTERVAL)
+            finally:
+                # Let the writer commit everything already read before shutting down
+                self.enqueue(pending, None)
+                writer.join()
+        if self.writer_error is not None:
+            raise self.writer_error
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Consume events.jsonl into the events table with parallel parsing")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Parser processes")
+    parser.add_argument("--chunk-bytes", type=int, default=DEFAULT_CHUNK_BYTES, help="Bytes of input per chunk handed to a worker and committed together")
+    parser.add_argument("--queue-size", type=int, help="Chunks in flight before the reader waits for the writer (default: 2 per worker)")
+    parser.add_argument("--skip-backlog", action="store_true", help="Ignore the stored offset and start at the end of the file")
+    parser.add_argument("--store-raw", action="store_true", help="Keep every raw JSON payload, not only those with extra fields")
+    parser.add_argument("--once", action="store_true", help="Ingest everything written so far and exit instead of tailing")
+    parser.add_argument("--decoder", choices=sorted(DECODERS), help="JSON decoder for event lines (default: fastest available, or $EVENT_DECODER)")
+    parser.add_argument("--metrics-port", type=int, help="Serve Prometheus metrics on this port at /metrics")
+    args = parser.parse_args()
+    if args.metrics_port:
+        serve_metrics(args.metrics_port)
+
+    # The writer thread uses the connection opened here
+    conn = connect_writer(DB_FILE, check_same_thread=False)
+    start_checkpointer(DB_FILE)
+    create_events_table(conn)
+    create_offsets_table(conn)
+
+    tailer = ParallelTailer(conn, EVENT_FILE, args.workers, args.chunk_bytes, args.queue_size, args.store_raw, args.decoder)
+    tailer.open(args.skip_backlog)
+    try:
+        tailer.run(args.once)
+    except KeyboardInterrupt:
+        logger.info("Stopping consumer...")
+    finally:
+        tailer.close()
+        conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+import json
+import sqlite3
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DatabaseError, connection, transaction
+from bucket_events import EventBucketsRollup, read_series, read_totals
+from summarize_events import summary_totals
+from .models import Aggregate, EventCount, Summary, TopUser
+
+SNAPSHOT_TIMEOUT = 600  # seconds a version's rows stay cached to answer "changed since version N"
+VERSIONS_TIMEOUT = 1  # seconds concurrent requests share one read of the rollup versions
+VERSIONS_KEY = "rollups:versions"
+
+
+class Dataset:
+    """One rollup table served as versioned snapshots and deltas.
+
+    The version is the rollup's commit counter in ``aggregation_state``, so
+    it only changes when the aggregator commits. Everything derived from a
+    version (its rows, and each payload serialized from them) is kept in the
+    Django cache under that version, so however many viewers ask, the table
+    is read once per aggregation tick. A client that sends a version still
+    cached gets only the rows that changed and the keys that disappeared,
+    anyone else gets the full table.
+
+    ``totals``, if given, computes figures over all the rows of a version;
+    payloads that carry rows also carry them, so clients don't recompute them.
+    """
+
+    def __init__(self, name, model, columns, key, order, totals=None):
+        self.name = name
+        self.model = model
+        self.columns = columns
+        self.key = [columns.index(column) for column in key]
+        self.order = order
+        self.totals = totals
+
+    def row_key(self, row):
+        return tuple(row[i] for i in self.key)
+
+    def cache_key(self, kind, *versions):
+        return ":".join(["rollups", self.name, kind, *map(str, versions)])
+
+    def read(self):
+        return {
+            self.row_key(row): row
+            for row in map(list, self.model.objects.order_by(*self.order).values_list(*self.columns))
+        }
+
+    def snapshot(self, version):
+        """``(version, rows by key)``, from the cache if ``version`` was read before."""
+        rows = cache.get(self.cache_key("rows", version))
+        if rows is None:
+            with transaction.atomic():  # the version and rows come from the same snapshot
+                version = query_versions().get(self.name, 0)
+                rows = self.read()
+            cache.set(self.cache_key("rows", version), rows, SNAPSHOT_TIMEOUT)
+        return version, rows
+
+    def payload(self, since=None):
+        """The rows changed since version ``since``, or all of them, as a JSON-ready dict."""
+        version = read_versions().get(self.name, 0)
+        if since == version:
+            return {"version": version, "full": False, "columns": self.columns, "rows": [], "deleted": []}
+        version, rows = self.snapshot(version)
+        old = cache.get(self.cache_key("rows", since)) if since is not None else None
+        if old is None:
+            payload = {"version": version, "full": True, "columns": self.columns, "rows": list(rows.values()), "deleted": []}
+        else:
+            payload = {
+                "version": version,
+                "full": False,
+                "columns": self.columns,
+                "rows": [row for key, row in rows.items() if old.get(key) != row],
+                "deleted": [list(key) for key in old if key not in rows],
+            }
+        if self.totals is not None:
+            payload["totals"] = self.totals(rows.values())
+        return payload
+
+    def serialized(self, since=None):
+        """``(version, JSON text)`` of ``payload(since)``, serialized once per version."""
+        version = read_versions().get(self.name, 0)
+        key = self.cache_key("json", since, version)
+        data = cache.get(key)
+        if data is None:
+            payload = self.payload(since)
+            version = payload["version"]
+            data = json.dumps(payload, cls=DjangoJSONEncoder, separators=(",", ":"))
+            cache.set(self.cache_key("json", since, version), data, SNAPSHOT_TIMEOUT)
+        return version, data
+
+
+DATASETS = {
+    dataset.name: dataset for dataset in [
+        Dataset("aggregates", Aggregate, ["product_id", "product_name", "total_sales", "total_revenue"],
+                key=["product_id"], order=["-total_sales", "product_id"]),
+        Dataset("event_counts", EventCount, ["product_id", "product_name", "event_type", "count"],
+                key=["product_id", "event_type"], order=["product_name", "event_type"]),
+        Dataset("top_users", TopUser, ["user_id", "total_purchases", "total_spent", "last_purchase_time"],
+                key=["user_id"], order=["-total_purchases", "-total_spent", "user_id"]),
+        Dataset("summary", Summary, ["event_type", "events", "revenue", "users"],
+                key=["event_type"], order=["event_type"], totals=summary_totals),
+    ]
+}
+
+BUCKET_READERS = {
+    "series": (read_series, ["bucket_ts", "event_type", "events", "revenue"]),
+    "totals": (read_totals, ["event_type", "events", "revenue"]),
+}
+
+def serialized_buckets(kind, start_ts=None, end_ts=None, resolution=None, event_types=()):
+    """``(version, JSON text)`` of ``bucket_events.read_series`` or ``read_totals``, cached per version.
+
+    The queries use qmark parameters, which Django's own sqlite cursor can't
+    log, so they run on the underlying DB-API connection.
+    """
+    version = read_versions().get(EventBucketsRollup.name, 0)
+    key = ":".join(["rollups", EventBucketsRollup.name, kind, str(version), str(start_ts), str(end_ts),
+                    resolution or "", ",".join(event_types)])
+    data = cache.get(key)
+    if data is None:
+        read, columns = BUCKET_READERS[kind]
+        connection.ensure_connection()
+        try:
+            resolution, rows = read(connection.connection, start_ts, end_ts, resolution, list(event_types))
+        except sqlite3.OperationalError:
+            rows = []  # The aggregator hasn't created the table yet
+        payload = {"version": version, "kind": kind, "resolution": resolution, "columns": columns, "rows": rows}
+        data = json.dumps(payload, separators=(",", ":"))
+        cache.set(key, data, SNAPSHOT_TIMEOUT)
+    return version, data
+
+def query_versions():
+    """Current version of every rollup; rollups that never committed are missing."""
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT name, version FROM aggregation_state")
+            return dict(cursor.fetchall())
+    except DatabaseError:
+        return {}  # The aggregator hasn't created its state yet
+
+def read_versions():
+    """``query_versions``, shared through the cache for ``VERSIONS_TIMEOUT`` seconds."""
+    versions = cache.get(VERSIONS_KEY)
+    if versions is None:
+        versions = query_versions()
+        cache.set(VERSIONS_KEY, versions, VERSIONS_TIMEOUT)
+    return versions
+
+def records(payload, limit=None):
+    """Payload rows as dicts, for templates."""
+    rows = payload["rows"][:limit] if limit else payload["rows"]
+    return [dict(zip(payload["columns"], row)) for row in rows]
@@ -35,4 +35,18 @@ class TopUser(models.Model):
         db_table = "top_users"
 
     def __str__(self):
-        return f"{self.user_id} ({self.total_purchases} purchases)"
\ No newline at end of file
+        return f"{self.user_id} ({self.total_purchases} purchases)"
+
+
+class Summary(models.Model):
+    # Maintained by the summary rollup (summarize_events.py); one row per event type
+    event_type = models.CharField(max_length=50, primary_key=True)
+    events = models.IntegerField()
+    revenue = models.FloatField()
+    users = models.IntegerField()
+
+    class Meta:
+        db_table = "summary"
+
+    def __str__(self):
+        return f"{self.event_type}: {self.events}"
@@ -1,3 +1,645 @@
-from django.test import TestCase
+import os
+import sys
+import json
+import queue
+import logging
+import shutil
+import signal
+import sqlite3
+import tempfile
+import subprocess
+from datetime import date, datetime, timedelta
+from unittest import mock, skipIf
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from backfill import backfill, can_backfill, np
+from bucket_events import HOUR, EventBucketsRollup, pick_resolution, read_series, read_totals
+from consumer.consumer import create_events_table, create_offsets_table, load_checkpoint, save_events, tail_and_consume
+from consumer.group import GroupTailer
+from event_generator import LoadGenerator, replay
+from rollups import ROLLUPS, AggregationEngine, load_rollups, set_high_water_mark
+from storage.connection import connect_writer
+from storage.schema import MIGRATIONS, PURCHASE, UNKNOWN, check_query_plans, iso_to_micros, migrate, schema_version
+from storage.store import archive_events, compact_partitions, recent_events
+from summarize_events import read_summary
+from track_top_users import RECENT_PURCHASES_SQL, TopUsersRollup
+from transform_events import (
+    create_aggregates_table, create_aggregation_state_table, rebuild_aggregates, update_aggregates, verify_aggregates,
+)
+from transport.base import get_transport
+from transport.segment_log import LogProducer, PartitionReader, SegmentLog
+from utils.logger import DeferredQueueHandler
+from utils.schema import BAD_TIMESTAMP, parse_event
+from .datasets import VERSIONS_KEY
+from .models import Aggregate
 
-# Create your tests here.
+FIXTURE_EVENTS = 2000
+FIXTURE_START = datetime(2024, 1, 1)
+FIXTURE_BATCH_SIZE = 500
+FIXTURE_DAYS = 5
+
+# The tables as the original consumer and aggregation scripts created them, before user_version was set
+BASELINE_TABLES_SQL = [
+    """
+    CREATE TABLE IF NOT EXISTS events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        event_type TEXT,
+        user_id TEXT,
+        product_id TEXT,
+        product_name TEXT,
+        price REAL,
+        timestamp TEXT,
+        raw TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS aggregates (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        product_id TEXT UNIQUE,
+        product_name TEXT,
+        total_sales INTEGER,
+        total_revenue REAL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS event_counts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        product_id TEXT,
+        product_name TEXT,
+        event_type TEXT,
+        count INTEGER,
+        UNIQUE(product_id, event_type)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS top_users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT UNIQUE,
+        total_purchases INTEGER,
+        total_spent REAL,
+        last_purchase_time TEXT
+    )
+    """,
+]
+
+
+def generated_lines(count=FIXTURE_EVENTS, seed=1, start_time=FIXTURE_START, rate=10):
+    """``count`` reproducible generator events, ``1 / rate`` seconds apart, as JSON lines."""
+    return LoadGenerator(users=50, products=20, seed=seed, start_time=start_time, rate=rate).batch(count).splitlines()
+
+def fill_events(conn, count=FIXTURE_EVENTS, seed=1, start_time=FIXTURE_START, rate=10, engine=None):
+    """Insert generated events the way the consumer does, with ``engine`` in push mode."""
+    lines = generated_lines(count, seed, start_time, rate)
+    for start in range(0, count, FIXTURE_BATCH_SIZE):
+        save_events(conn, [parse_event(line) for line in lines[start:start + FIXTURE_BATCH_SIZE]], engine=engine)
+
+
+def fill_baseline_events(conn, events):
+    """Store event dicts the way the original consumer did, which only checked that the keys exist."""
+    for sql in BASELINE_TABLES_SQL:
+        conn.execute(sql)
+    conn.executemany("""
+        INSERT INTO events (event_type, user_id, product_id, product_name, price, timestamp, raw)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, [(event["event_type"], event["user_id"], event["product_id"], event["product_name"],
+           event["price"], event["timestamp"], json.dumps(event)) for event in events])
+    conn.commit()
+
+def baseline_event(event_type="purchase", user_id="user_1", product_id="p1", product_name="Laptop",
+                   price=1200, timestamp="2024-01-01T12:00:00"):
+    return {"event_type": event_type, "user_id": user_id, "product_id": product_id,
+            "product_name": product_name, "price": price, "timestamp": timestamp}
+
+
+def fill_history(conn):
+    """Five days of events: two compacted into daily_rollups, two in partitions and one hot."""
+    migrate(conn)
+    fill_events(conn, rate=FIXTURE_EVENTS / (FIXTURE_DAYS * 86400))
+    AggregationEngine(conn, load_rollups([])).run_pass()  # Only aggregated events are archived
+    archive_events(conn, before=date(2024, 1, 5))
+    compact_partitions(conn, retention_days=2, today=date(2024, 1, 5))
+
+def table_rows(conn, table):
+    """A table's rows without its id column, sorted, with floats to the cent."""
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})") if row[1] != "id"]
+    rows = conn.execute(f"SELECT {', '.join(columns)} FROM {table}").fetchall()
+    return sorted(tuple(round(value, 2) if isinstance(value, float) else value for value in row) for row in rows)
+
+
+class PipelineTestCase(TestCase):
+    """Tests against a pipeline database of their own, not Django's test database."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.db_file = os.path.join(self.tmpdir, "ecommerce.db")
+        self.conn = connect_writer(self.db_file)
+        self.addCleanup(self.conn.close)
+
+
+class IncrementalTests(PipelineTestCase):
+    def test_incremental_matches_full_recompute(self):
+        create_events_table(self.conn)
+        create_aggregates_table(self.conn)
+        create_aggregation_state_table(self.conn)
+        # The first update has no high-water mark and rebuilds; the others only fold new events
+        for seed in range(1, 5):
+            fill_events(self.conn, FIXTURE_EVENTS // 4, seed)
+            update_aggregates(self.conn)
+        self.assertEqual(verify_aggregates(self.conn), [])
+        incremental = table_rows(self.conn, "aggregates")
+
+        rebuild_aggregates(self.conn)
+        self.assertTrue(incremental)
+        self.assertEqual(table_rows(self.conn, "aggregates"), incremental)
+
+    def test_rollups_match_full_recompute(self):
+        migrate(self.conn)
+        rollups = load_rollups([])
+        # One rollup runs first, so the others are added later and catch up while it is ahead
+        engine = AggregationEngine(self.conn, rollups[:1], chunk_size=300)
+        for day in range(FIXTURE_DAYS):
+            if day == 2:
+                engine = AggregationEngine(self.conn, rollups, chunk_size=300)
+            start_time = FIXTURE_START + timedelta(days=day)
+            rate = FIXTURE_EVENTS / (FIXTURE_DAYS * 86400)
+            count = FIXTURE_EVENTS // FIXTURE_DAYS
+            # Alternate the consumer pushing batches into the rollups with the aggregator polling
+            if day % 2:
+                fill_events(self.conn, count, seed=day, start_time=start_time, rate=rate, engine=engine)
+            else:
+                fill_events(self.conn, count, seed=day, start_time=start_time, rate=rate)
+                engine.run_pass()
+            # Rollups added later replay these partitions when they catch up
+            archive_events(self.conn, before=start_time.date())
+        engine.run_pass()
+        self.assertEqual(self.conn.execute("SELECT COUNT(*) FROM event_partitions").fetchone()[0], FIXTURE_DAYS - 1)
+        incremental = {rollup.name: table_rows(self.conn, rollup.name) for rollup in rollups}
+
+        engine.rebuild()
+        engine.run_pass()
+        for rollup in rollups:
+            with self.subTest(rollup=rollup.name):
+                self.assertTrue(incremental[rollup.name])
+                self.assertEqual(table_rows(self.conn, rollup.name), incremental[rollup.name])
+
+        # Compacted days keep only per-product totals, which is all the aggregates need
+        compact_partitions(self.conn, retention_days=2, today=date(2024, 1, 5))
+        self.assertEqual(verify_aggregates(self.conn), [])
+
+
+class MigrationTests(PipelineTestCase):
+    def test_baseline_database(self):
+        events = [json.loads(line) for line in generated_lines()]
+        fill_baseline_events(self.conn, events)
+        # The original transform_events counted every event as a sale
+        self.conn.execute("""
+            INSERT INTO aggregates (product_id, product_name, total_sales, total_revenue)
+            SELECT product_id, product_name, COUNT(*), SUM(price) FROM events GROUP BY product_id
+        """)
+        self.conn.commit()
+        self.assertEqual(schema_version(self.conn), 0)
+
+        for version in range(1, len(MIGRATIONS) + 1):
+            with self.subTest(version=version):
+                migrate(self.conn, version)
+                self.assertEqual(schema_version(self.conn), version)
+                self.assertEqual(self.conn.execute("SELECT COUNT(*) FROM events").fetchone()[0], len(events))
+
+        self.assertEqual([(*row[:5], iso_to_micros(row[5])) for row in self.conn.execute("""
+            SELECT event_type, user_id, product_id, product_name, price, timestamp FROM events_expanded ORDER BY id
+        """)], [(event["event_type"], event["user_id"], event["product_id"], event["product_name"],
+                 event["price"], iso_to_micros(event["timestamp"])) for event in events])
+        self.assertEqual(check_query_plans(self.conn), [])
+        # The stale baseline aggregates have no high-water mark, so the first update rebuilds them
+        update_aggregates(self.conn)
+        self.assertEqual(verify_aggregates(self.conn), [])
+
+    def test_rows_with_nulls_or_bad_timestamps_are_not_lost(self):
+        bad_timestamp = baseline_event(user_id="user_5", timestamp="yesterday")
+        fill_baseline_events(self.conn, [
+            baseline_event(),
+            baseline_event(event_type=None),
+            baseline_event(user_id=None),
+            baseline_event(product_id=None, product_name=None),
+            bad_timestamp,
+        ])
+        migrate(self.conn)
+
+        self.assertEqual(self.conn.execute("""
+            SELECT event_type, user_id, product_id, product_name FROM events_expanded ORDER BY id
+        """).fetchall(), [
+            ("purchase", "user_1", "p1", "Laptop"),
+            (UNKNOWN, "user_1", "p1", "Laptop"),
+            ("purchase", UNKNOWN, "p1", "Laptop"),
+            ("purchase", "user_1", UNKNOWN, UNKNOWN),
+        ])
+        reason, line = self.conn.execute("SELECT reason, line FROM dead_letters").fetchone()
+        self.assertEqual(reason, BAD_TIMESTAMP)
+        self.assertEqual(json.loads(line), bad_timestamp)
+        self.assertEqual(schema_version(self.conn), len(MIGRATIONS))
+
+
+class ArchiveTests(PipelineTestCase):
+    def setUp(self):
+        super().setUp()
+        migrate(self.conn)
+        fill_events(self.conn, rate=FIXTURE_EVENTS / (3 * 86400))
+
+    def test_days_are_archived_whole(self):
+        AggregationEngine(self.conn, load_rollups([])).run_pass()
+        cutoff = iso_to_micros("2024-01-03")
+        old_events = self.conn.execute("SELECT COUNT(*) FROM events WHERE ts < ?", (cutoff,)).fetchone()[0]
+        self.assertEqual(archive_events(self.conn, before=date(2024, 1, 3)), old_events)
+        partitions = self.conn.execute("SELECT day, row_count FROM event_partitions ORDER BY day").fetchall()
+        self.assertEqual([day for day, row_count in partitions], ["2024-01-01", "2024-01-02"])
+        self.assertEqual(sum(row_count for day, row_count in partitions), old_events)
+        self.assertGreaterEqual(self.conn.execute("SELECT MIN(ts) FROM events").fetchone()[0], cutoff)
+
+    def test_unregistered_rollup_does_not_hold_archiving_back(self):
+        with mock.patch.dict(ROLLUPS):
+            del ROLLUPS["aggregates"]
+            AggregationEngine(self.conn, load_rollups([])).run_pass()
+            self.conn.execute("INSERT INTO aggregation_state (name, last_event_id) VALUES ('aggregates', 100)")
+            self.assertGreater(archive_events(self.conn, before=date(2024, 1, 3)), 100)
+        # Registered again, it can't read on from its mark and is rebuilt from the partitions
+        AggregationEngine(self.conn, load_rollups([])).run_pass()
+        self.assertEqual(verify_aggregates(self.conn), [])
+
+
+class QueryPlanTests(PipelineTestCase):
+    def setUp(self):
+        super().setUp()
+        migrate(self.conn)
+        fill_events(self.conn)
+        self.conn.execute("ANALYZE")
+
+    def test_aggregator_queries_do_not_scan_events(self):
+        self.assertEqual(check_query_plans(self.conn), [])
+
+    def test_full_scan_is_reported(self):
+        # raw is in no index, so this can only scan the table
+        queries = [("unindexed", "SELECT COUNT(*) FROM events WHERE raw LIKE ?", ("%coupon%",))]
+        with mock.patch("storage.schema.aggregator_queries", return_value=queries):
+            self.assertEqual([name for name, scans in check_query_plans(self.conn)], ["unindexed"])
+
+
+class RecentEventsTests(PipelineTestCase):
+    def test_since_ts_with_timestamps_out_of_id_order(self):
+        migrate(self.conn)
+        # A replayed hour lands after a live event, with older timestamps and higher ids
+        timestamps = ["2024-01-02T10:00:00", "2024-01-01T09:00:00", "2024-01-02T09:30:00", "2024-01-01T08:00:00"]
+        save_events(self.conn, [parse_event(json.dumps(baseline_event(user_id=f"user_{i}", timestamp=timestamp)))
+                                for i, timestamp in enumerate(timestamps)])
+        since_ts = iso_to_micros("2024-01-02T00:00:00")
+        rows = recent_events(self.conn, RECENT_PURCHASES_SQL, PURCHASE, 4, since_ts=since_ts)
+        self.assertEqual([user_id for user_id, price, ts in rows], ["user_2", "user_0"])
+        rows = recent_events(self.conn, RECENT_PURCHASES_SQL, PURCHASE, 4, limit=1, since_ts=since_ts)
+        self.assertEqual([user_id for user_id, price, ts in rows], ["user_2"])
+
+
+class TopUsersTests(PipelineTestCase):
+    def test_time_window_with_timestamps_out_of_id_order(self):
+        migrate(self.conn)
+        # user_1's replayed purchase is older than the window when it arrives, behind user_2's newer one
+        purchases = [("user_1", "2024-01-01T10:00:00"), ("user_2", "2024-01-01T12:00:00"),
+                     ("user_1", "2024-01-01T09:00:00"), ("user_3", "2024-01-01T12:30:00")]
+        save_events(self.conn, [parse_event(json.dumps(baseline_event(user_id=user_id, timestamp=timestamp)))
+                                for user_id, timestamp in purchases])
+        AggregationEngine(self.conn, [TopUsersRollup(window=timedelta(hours=1))]).run_pass()
+        self.assertEqual(table_rows(self.conn, "top_users"), [
+            ("user_2", 1, 1200.0, "2024-01-01T12:00:00"),
+            ("user_3", 1, 1200.0, "2024-01-01T12:30:00"),
+        ])
+
+
+class ReplayTests(PipelineTestCase):
+    def test_invalid_lines_are_skipped(self):
+        captured = os.path.join(self.tmpdir, "captured.jsonl")
+        output = os.path.join(self.tmpdir, "events.jsonl")
+        good = [json.dumps(baseline_event(timestamp=f"2024-01-01T12:00:0{i}")) + "\n" for i in range(3)]
+        with open(captured, "w") as f:
+            f.write(good[0] + "not json\n" + "[1, 2]\n" + good[1] + json.dumps({"event_type": "purchase"}) + "\n"
+                    + json.dumps(baseline_event(timestamp="yesterday")) + "\n" + good[2])
+        self.assertEqual(replay(captured, output, speed=0, keep_timestamps=True), 3)
+        with open(output) as f:
+            self.assertEqual(f.readlines(), good)
+
+
+class TailerTests(PipelineTestCase):
+    def consume(self, transport, lines):
+        migrate(self.conn)
+        create_offsets_table(self.conn)
+        # The first run stores offset 0, as a consumer started before the producer does
+        tail_and_consume(self.conn, once=True, transport=transport)
+        producer = transport.producer()
+        producer.send(lines)
+        producer.close()
+        tail_and_consume(self.conn, batch_size=100, once=True, transport=transport)
+        return self.conn.execute("SELECT COUNT(*) FROM events").fetchone()[0]
+
+    def test_jsonl(self):
+        path = os.path.join(self.tmpdir, "events.jsonl")
+        lines = LoadGenerator(seed=1, start_time=FIXTURE_START).batch(250)
+        # A line that can't be stored, then one the producer is still writing
+        stored = self.consume(get_transport("jsonl", path=path), lines + "not json\n" + '{"event_type": "purch')
+        self.assertEqual(stored, 250)
+        self.assertEqual(self.conn.execute("SELECT reason FROM dead_letters").fetchall(), [("malformed",)])
+        self.assertEqual(load_checkpoint(self.conn, path)[1], len(lines) + len("not json\n"))
+
+    def test_columnar(self):
+        path = os.path.join(self.tmpdir, "events.bin")
+        stored = self.consume(get_transport("columnar", columnar_file=path), LoadGenerator(seed=1, start_time=FIXTURE_START).batch(250))
+        self.assertEqual(stored, 250)
+        self.assertEqual(load_checkpoint(self.conn, path)[1], os.path.getsize(path))
+
+
+# One event every 200 seconds from FIXTURE_START, so minute buckets only
+# cover the last two of the almost five days
+BUCKET_FIXTURE_EVENTS = 2000
+BUCKET_FIXTURE_RATE = 0.005
+
+
+def fill_buckets(conn):
+    fill_events(conn, BUCKET_FIXTURE_EVENTS, rate=BUCKET_FIXTURE_RATE)
+    AggregationEngine(conn, [EventBucketsRollup()]).run_pass()
+
+def events_between(conn, start, end):
+    return conn.execute("SELECT COUNT(*) FROM events WHERE ts >= ? AND ts < ?",
+                        (iso_to_micros(start), iso_to_micros(end))).fetchone()[0]
+
+
+class BucketTests(PipelineTestCase):
+    def setUp(self):
+        super().setUp()
+        migrate(self.conn)
+        fill_buckets(self.conn)
+
+    def pick(self, start, end):
+        return pick_resolution(self.conn, iso_to_micros(start), iso_to_micros(end))
+
+    def test_coarsest_exact_resolution_is_picked(self):
+        self.assertEqual(pick_resolution(self.conn), "day")
+        self.assertEqual(self.pick("2024-01-02T00:00", "2024-01-04T00:00"), "day")
+        self.assertEqual(self.pick("2024-01-04T03:00", "2024-01-04T09:00"), "hour")
+        self.assertEqual(self.pick("2024-01-04T03:10", "2024-01-04T03:50"), "minute")
+
+    def test_exact_range_matches_the_events(self):
+        start, end = "2024-01-04T03:10", "2024-01-04T09:50"
+        resolution, rows = read_totals(self.conn, iso_to_micros(start), iso_to_micros(end))
+        self.assertEqual(resolution, "minute")
+        self.assertEqual(sum(events for _, events, _ in rows), events_between(self.conn, start, end))
+
+    def test_range_older_than_the_minutes_kept_is_widened(self):
+        start, end = "2024-01-02T03:10", "2024-01-02T03:50"
+        self.assertEqual(self.pick(start, end), "hour")
+        resolution, rows = read_series(self.conn, iso_to_micros(start), iso_to_micros(end))
+        self.assertEqual({bucket_ts for bucket_ts, _, _, _ in rows}, {iso_to_micros("2024-01-02T03:00")})
+        self.assertEqual(sum(events for _, _, events, _ in rows), events_between(self.conn, "2024-01-02T03:00", "2024-01-02T04:00"))
+
+
+# A second group member in its own process: joins, then on "go" takes its
+# partitions, commits one batch, reads another and waits to be killed
+GROUP_MEMBER_SCRIPT = """
+import sys
+from consumer.group import GroupTailer
+from storage.connection import connect_writer
+from transport.segment_log import SegmentLog
+tailer = GroupTailer(connect_writer(sys.argv[1]), SegmentLog(sys.argv[2]))
+tailer.open()
+print("joined", flush=True)
+sys.stdin.readline()
+tailer.rebalance()
+tailer.read(100)
+tailer.flush()
+tailer.read(100)
+print(" ".join(map(str, sorted(tailer.readers))), flush=True)
+sys.stdin.readline()
+"""
+
+
+class SegmentLogTests(PipelineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.log_dir = os.path.join(self.tmpdir, "eventlog")
+        migrate(self.conn)
+        create_offsets_table(self.conn)
+
+    def append_batches(self, log, batches, size=20):
+        """Append ``batches`` of ``size`` events to partition 0, one write each; returns the bytes written."""
+        generator = LoadGenerator(seed=1, start_time=FIXTURE_START)
+        data = b"".join(generator.batch(size).encode() for _ in range(batches))
+        for line_batch in (data.splitlines(keepends=True)[i:i + size] for i in range(0, batches * size, size)):
+            log.append(0, b"".join(line_batch))
+        return data
+
+    def read_all(self, reader):
+        lines = []
+        while line := reader.readline():
+            lines.append(line)
+        return b"".join(lines)
+
+    def stored(self):
+        return self.conn.execute("SELECT COUNT(*) FROM events").fetchone()[0]
+
+    def test_segments_roll_over(self):
+        log = SegmentLog(self.log_dir, partitions=1, segment_bytes=4096)
+        data = self.append_batches(log, 30)
+        segments = log.segments(0)
+        self.assertGreater(len(segments), 3)
+        self.assertEqual(log.end_offset(0), len(data))
+        self.assertEqual(self.read_all(PartitionReader(log, 0, 0)), data)
+        # Any offset a line starts at can be resumed from, whichever segment holds it
+        self.assertEqual(self.read_all(PartitionReader(log, 0, segments[2])), data[segments[2]:])
+
+    def test_retention_skips_to_the_oldest_segment_kept(self):
+        log = SegmentLog(self.log_dir, partitions=1, segment_bytes=4096, retention_segments=2)
+        first = self.append_batches(log, 1)
+        reader = PartitionReader(log, 0, 0)
+        first_line = reader.readline()
+        data = first + self.append_batches(log, 30)
+        segments = log.segments(0)
+        self.assertEqual(len(segments), 2)
+        self.assertEqual(self.read_all(PartitionReader(log, 0, 0)), data[segments[0]:])
+        # A reader already in a deleted segment finishes it, then skips to the oldest one kept
+        read = first_line + self.read_all(reader)
+        kept = data[segments[0]:]
+        head = read[:-len(kept)]
+        self.assertGreaterEqual(len(head), 4096)
+        self.assertEqual(read, data[:len(head)] + kept)
+
+    def test_rebalance_hands_over_committed_partitions(self):
+        first = GroupTailer(self.conn, SegmentLog(self.log_dir, partitions=4))
+        first.open()
+        self.addCleanup(first.close)
+        self.assertEqual(sorted(first.readers), [0, 1, 2, 3])
+        producer = LogProducer(SegmentLog(self.log_dir))
+        producer.send(LoadGenerator(seed=1, start_time=FIXTURE_START).batch(400))
+        first.run(once=True)
+
+        second = GroupTailer(self.conn, SegmentLog(self.log_dir))
+        second.open()
+        self.addCleanup(second.close)
+        self.assertEqual(second.readers, {})  # Until the first member lets go
+        first.rebalance()
+        second.rebalance()
+        self.assertEqual((sorted(first.readers), sorted(second.readers)), ([0, 2], [1, 3]))
+        self.assertEqual(second.readers[1].offset, SegmentLog(self.log_dir).end_offset(1))
+
+        producer.send(LoadGenerator(seed=2, start_time=FIXTURE_START).batch(400))
+        first.run(once=True)
+        second.run(once=True)
+        self.assertEqual(self.stored(), 800)
+
+    def test_killed_member_partitions_resume_from_its_commits(self):
+        survivor = GroupTailer(self.conn, SegmentLog(self.log_dir, partitions=4))
+        survivor.open()
+        self.addCleanup(survivor.close)
+        member = subprocess.Popen([sys.executable, "-c", GROUP_MEMBER_SCRIPT, self.db_file, self.log_dir],
+                                  cwd=settings.BASE_DIR.parent, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        self.addCleanup(member.wait)
+        self.addCleanup(member.kill)
+        self.assertEqual(member.stdout.readline(), "joined\n")
+        survivor.rebalance()
+        self.assertEqual(sorted(survivor.readers), [0, 2])
+        LogProducer(SegmentLog(self.log_dir)).send(LoadGenerator(seed=1, start_time=FIXTURE_START).batch(1000))
+        member.stdin.write("go\n")
+        member.stdin.flush()
+        self.assertEqual(member.stdout.readline(), "1 3\n")
+        member.send_signal(signal.SIGKILL)
+        member.wait()
+        self.assertEqual(self.stored(), 100)  # Committed; the next 100 it read were not
+
+        survivor.rebalance()
+        self.assertEqual(sorted(survivor.readers), [0, 1, 2, 3])
+        survivor.run(once=True)
+        self.assertEqual(self.stored(), 1000)  # Each event once: none lost, none read twice
+
+    def test_failed_commit_rereads_partitions_never_committed(self):
+        tailer = GroupTailer(self.conn, SegmentLog(self.log_dir, partitions=2))
+        self.addCleanup(tailer.close)
+        failure = sqlite3.OperationalError("database is locked")
+        with mock.patch("consumer.group.save_events", side_effect=failure), mock.patch("consumer.group.POLL_INTERVAL", 0):
+            tailer.open()  # Its first commit fails, so no partition has a committed offset
+            LogProducer(SegmentLog(self.log_dir)).send(LoadGenerator(seed=1, start_time=FIXTURE_START).batch(300))
+            self.assertEqual(tailer.read(1000), 300)
+            tailer.flush()
+        self.assertEqual([reader.offset for reader in tailer.readers.values()], [0, 0])
+        tailer.run(once=True)
+        self.assertEqual(self.stored(), 300)
+
+
+@skipIf(np is None, "backfill needs NumPy")
+class BackfillTests(PipelineTestCase):
+    def test_backfill_matches_rebuild(self):
+        fill_history(self.conn)
+        self.assertEqual(self.conn.execute("SELECT COUNT(DISTINCT day) FROM daily_rollups").fetchone()[0], 2)
+        rollups = [rollup for rollup in load_rollups([]) if can_backfill(rollup)]
+        engine = AggregationEngine(self.conn, rollups)
+        engine.rebuild()
+        engine.run_pass()
+        rebuilt = {rollup.name: table_rows(self.conn, rollup.name) for rollup in rollups}
+
+        backfill(self.conn, [rollup for rollup in load_rollups([]) if can_backfill(rollup)], self.db_file)
+        for rollup in rollups:
+            with self.subTest(rollup=rollup.name):
+                self.assertTrue(rebuilt[rollup.name])
+                self.assertEqual(table_rows(self.conn, rollup.name), rebuilt[rollup.name])
+
+
+class LoggingTests(TestCase):
+    def test_queued_message_keeps_arguments_as_logged(self):
+        handler = DeferredQueueHandler(queue.SimpleQueue())
+        logger = logging.getLogger("analytics.tests.deferred")
+        logger.addHandler(handler)
+        logger.propagate = False
+        self.addCleanup(logger.removeHandler, handler)
+        event = {"price": "12.5"}
+        logger.warning("Invalid event: %r", event)
+        event["price"] = 12.5  # The validator coerces fields in place after logging
+        self.assertEqual(handler.queue.get_nowait().getMessage(), "Invalid event: {'price': '12.5'}")
+
+
+class DatasetApiTests(TransactionTestCase):
+    """The JSON API over the rollup tables in Django's test database."""
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        # The rollup tables belong to the pipeline, not to Django's migrations
+        connection.ensure_connection()
+        migrate(connection.connection)
+        for rollup in load_rollups([]):
+            rollup.create_table(connection.connection)
+        connection.connection.execute("DELETE FROM aggregation_state")
+
+    def publish(self, **sales):
+        """Replace the aggregates rows and bump their version, as an aggregator commit does."""
+        Aggregate.objects.exclude(product_id__in=sales).delete()
+        for product_id, total_sales in sales.items():
+            Aggregate.objects.update_or_create(product_id=product_id, defaults={
+                "product_name": product_id.upper(), "total_sales": total_sales, "total_revenue": total_sales * 10.0,
+            })
+        set_high_water_mark(connection.connection, "aggregates", 0)
+        cache.delete(VERSIONS_KEY)  # As if the versions had been read a second later
+
+    def test_etag_and_not_modified(self):
+        self.publish(p1=3)
+        response = self.client.get("/api/aggregates/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["ETag"], '"aggregates-1"')
+        self.assertEqual(self.client.get("/api/aggregates/", HTTP_IF_NONE_MATCH='"aggregates-1"').status_code, 304)
+
+        self.publish(p1=4)
+        response = self.client.get("/api/aggregates/", HTTP_IF_NONE_MATCH='"aggregates-1"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["ETag"], '"aggregates-2"')
+        self.assertEqual(response.json()["rows"], [["p1", "P1", 4, 40.0]])
+
+    def test_since_returns_changed_rows_and_deleted_keys(self):
+        self.publish(p1=3, p2=2, p3=1)
+        self.assertTrue(self.client.get("/api/aggregates/").json()["full"])
+        self.publish(p1=4, p2=2, p4=1)
+        payload = self.client.get("/api/aggregates/?since=1").json()
+        self.assertEqual((payload["version"], payload["full"]), (2, False))
+        self.assertEqual(payload["rows"], [["p1", "P1", 4, 40.0], ["p4", "P4", 1, 10.0]])
+        self.assertEqual(payload["deleted"], [["p3"]])
+        self.assertEqual(self.client.get("/api/aggregates/?since=2").json()["rows"], [])
+
+    def test_unknown_version_gets_full_table(self):
+        self.publish(p1=3, p2=2)
+        payload = self.client.get("/api/aggregates/?since=7").json()
+        self.assertEqual((payload["version"], payload["full"]), (1, True))
+        self.assertEqual(len(payload["rows"]), 2)
+        self.assertEqual(self.client.get("/api/aggregates/?since=x").status_code, 400)
+
+    def test_cached_page_follows_the_version(self):
+        self.publish(p1=3)
+        self.assertContains(self.client.get("/"), "P1")
+        self.publish(p2=5)
+        page = self.client.get("/")
+        self.assertContains(page, "P2")
+        self.assertNotContains(page, "P1")
+
+    def test_summary_totals_match_the_report(self):
+        connection.connection.executemany("INSERT INTO summary (event_type, events, revenue, users) VALUES (?, ?, ?, ?)",
+                                          [("purchase", 4, 100.0, 3), ("product_view", 9, 0.0, 5)])
+        set_high_water_mark(connection.connection, "summary", 0)
+        totals = read_summary(connection.connection)
+        self.assertEqual(totals["avg_order_value"], 25.0)
+        self.assertEqual(self.client.get("/api/summary/").json()["totals"], totals)
+        self.assertContains(self.client.get("/"), "$25.00")
+
+    def test_timeseries_resolution_follows_the_range(self):
+        fill_buckets(connection.connection)
+        series = self.client.get("/api/timeseries/?start=2024-01-04T03:00:00&end=2024-01-04T09:00:00").json()
+        self.assertEqual(series["resolution"], "hour")
+        self.assertEqual(sorted({row[0] for row in series["rows"]}),
+                         list(range(iso_to_micros("2024-01-04T03:00"), iso_to_micros("2024-01-04T09:00"), HOUR)))
+        totals = self.client.get("/api/timeseries/totals/?start=2024-01-04T03:10:00&end=2024-01-04T03:50:00").json()
+        self.assertEqual(totals["resolution"], "minute")
+        self.assertEqual(sum(row[1] for row in totals["rows"]),
+                         events_between(connection.connection, "2024-01-04T03:10", "2024-01-04T03:50"))
+        self.assertEqual(self.client.get("/api/timeseries/?resolution=week").status_code, 400)
@@ -3,4 +3,8 @@ from . import views
 
 urlpatterns = [
     path('', views.dashboard, name='dashboard'),
+    path('api/stream/', views.stream, name='stream'),
+    path('api/timeseries/', views.timeseries_api, name='timeseries'),
+    path('api/timeseries/totals/', views.timeseries_api, {'kind': 'totals'}, name='timeseries_totals'),
+    path('api/<str:name>/', views.dataset_api, name='dataset_api'),
 ]
@@ -1,10 +1,145 @@
-from django.shortcuts import render
-from .models import Aggregate, EventCount, TopUser
+import time
+from django.core.cache import cache
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
+from django.template.loader import render_to_string
+from bucket_events import BUCKET_WIDTHS, EventBucketsRollup
+from storage.schema import iso_to_micros
+from .datasets import DATASETS, SNAPSHOT_TIMEOUT, read_versions, records, serialized_buckets
+
+STREAM_POLL_INTERVAL = 1  # seconds between version checks per stream
+STREAM_HEARTBEAT = 15  # seconds of silence before a keep-alive comment
+STREAM_MAX_AGE = 300  # seconds before a stream ends; EventSource reconnects with Last-Event-ID
+STREAM_RETRY_MS = 2000
 
 def dashboard(request):
-    context = {
-        'data': Aggregate.objects.all().order_by('-total_sales'),
-        'event_counts': EventCount.objects.all().order_by('product_name', 'event_type'),
-        'top_users': TopUser.objects.all().order_by('-total_purchases')[:10]  # Top 10 users
-    }
-    return render(request, 'analytics/dashboard.html', context)
\ No newline at end of file
+    # The page only depends on the rollup versions; render it once per version
+    key = "dashboard:" + format_versions(read_versions())
+    page = cache.get(key)
+    if page is None:
+        initial = {name: dataset.payload() for name, dataset in DATASETS.items()}
+        context = {
+            'data': records(initial['aggregates']),
+            'event_counts': records(initial['event_counts']),
+            'top_users': records(initial['top_users'], limit=10),  # Top 10 users
+            'summary': initial['summary']['totals'],
+            'initial': initial,
+        }
+        page = render_to_string('analytics/dashboard.html', context, request)
+        cache.set(key, page, SNAPSHOT_TIMEOUT)
+    return HttpResponse(page)
+
+
+def etag(name, version):
+    return f'"{name}-{version}"'
+
+def parse_version(value):
+    return int(value) if value not in (None, "") else None
+
+def dataset_api(request, name):
+    """Rows of one rollup table as JSON.
+
+    ``?since=N`` returns only the rows changed since version N (and the keys
+    deleted), or everything with ``"full": true`` if N is too old. The ETag
+    is the current version, so ``If-None-Match`` gets a 304 while nothing
+    changed.
+    """
+    dataset = DATASETS.get(name)
+    if dataset is None:
+        raise Http404(f"Unknown dataset {name}")
+    try:
+        since = parse_version(request.GET.get("since"))
+    except ValueError:
+        return HttpResponseBadRequest("since must be a version number")
+    tag = etag(name, read_versions().get(name, 0))
+    if tag in request.headers.get("If-None-Match", ""):
+        response = HttpResponse(status=304)
+    else:
+        version, data = dataset.serialized(since)
+        response = HttpResponse(data, content_type="application/json")
+        tag = etag(name, version)
+    response["ETag"] = tag
+    response["Cache-Control"] = "no-cache"
+    return response
+
+
+def parse_timestamp(value):
+    return iso_to_micros(value) if value else None
+
+def timeseries_api(request, kind="series"):
+    """Event counts and purchase revenue per event type over time, as JSON.
+
+    ``?start=`` and ``?end=`` are ISO timestamps (default: all history),
+    ``?resolution=`` is minute, hour or day (default: the coarsest one that
+    answers the range exactly, see ``bucket_events.pick_resolution``) and
+    ``?event_type=`` can be repeated to keep only some types. The series has
+    one row per bucket and event type with ``bucket_ts`` in epoch
+    microseconds; ``kind="totals"`` sums the range per event type instead.
+    """
+    resolution = request.GET.get("resolution") or None
+    if resolution is not None and resolution not in BUCKET_WIDTHS:
+        return HttpResponseBadRequest(f"resolution must be one of {', '.join(BUCKET_WIDTHS)}")
+    try:
+        start_ts = parse_timestamp(request.GET.get("start"))
+        end_ts = parse_timestamp(request.GET.get("end"))
+    except ValueError:
+        return HttpResponseBadRequest("start and end must be ISO timestamps")
+    event_types = sorted(set(request.GET.getlist("event_type")))
+    name = f"{EventBucketsRollup.name}-{kind}"
+    tag = etag(name, read_versions().get(EventBucketsRollup.name, 0))
+    if tag in request.headers.get("If-None-Match", ""):
+        response = HttpResponse(status=304)
+    else:
+        version, data = serialized_buckets(kind, start_ts, end_ts, resolution, event_types)
+        response = HttpResponse(data, content_type="application/json")
+        tag = etag(name, version)
+    response["ETag"] = tag
+    response["Cache-Control"] = "no-cache"
+    return response
+
+
+def format_versions(versions):
+    return ",".join(f"{name}={version}" for name, version in versions.items() if version is not None)
+
+def parse_versions(value):
+    versions = {}
+    for item in filter(None, (value or "").split(",")):
+        name, _, version = item.partition("=")
+        if name in DATASETS:
+            versions[name] = parse_version(version)
+    return versions
+
+def stream(request):
+    """Server-sent events with the delta of each dataset whenever its version changes.
+
+    Each event is named after its dataset and carries the same payload as
+    ``dataset_api``. Its id lists the versions sent so far, so a client that
+    reconnects resumes from them (``Last-Event-ID``). The starting versions can
+    be given as query parameters, e.g. ``?aggregates=12&top_users=9``; any
+    other dataset starts with its full table.
+    """
+    try:
+        since = parse_versions(request.headers.get("Last-Event-ID"))
+        if not since:
+            since = {name: parse_version(request.GET.get(name)) for name in DATASETS}
+    except ValueError:
+        return HttpResponseBadRequest("versions must be numbers")
+
+    def events():
+        yield f"retry: {STREAM_RETRY_MS}\n\n"
+        started = last_sent = time.monotonic()
+        while time.monotonic() - started < STREAM_MAX_AGE:
+            versions = read_versions()
+            for name, dataset in DATASETS.items():
+                if since.get(name) is None or versions.get(name, 0) != since[name]:
+                    since[name], data = dataset.serialized(since.get(name))
+                    yield f"id: {format_versions(since)}\nevent: {name}\ndata: {data}\n\n"
+                    last_sent = time.monotonic()
+            if time.monotonic() - last_sent >= STREAM_HEARTBEAT:
+                yield ": keep-alive\n\n"
+                last_sent = time.monotonic()
+            time.sleep(STREAM_POLL_INTERVAL)
+
+    response = StreamingHttpResponse(events(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"  # Don't let a proxy hold events back
+    return response
@@ -4,10 +4,15 @@ Django settings for dashboard project.
 
 from pathlib import Path
 import os
+import sys
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
+# The pipeline's modules live one level up; the database settings come from storage.connection
+sys.path.append(str(BASE_DIR.parent))
+from storage.connection import BUSY_TIMEOUT, init_command  # noqa: E402
+
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/5.0/howto/deployment/checklist/
 
@@ -66,9 +71,33 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR.parent / 'ecommerce.db',  # Note: we go up one level to find the DB
+        # Same busy timeout and pragma profile as the pipeline's connections
+        'OPTIONS': {
+            'timeout': BUSY_TIMEOUT,
+            'init_command': init_command(),
+        },
     }
 }
 
+# Cache
+# Rollup snapshots and rendered pages, keyed by rollup version (see analytics.datasets).
+# Local memory serves one process; set DASHBOARD_CACHE_DIR to share one file cache
+# between the processes of a multi-worker server.
+if os.getenv('DASHBOARD_CACHE_DIR'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.environ['DASHBOARD_CACHE_DIR'],
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'analytics',
+        }
+    }
+
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -1,4 +1,4 @@
-import sqlite3
+from storage.connection import connect_writer
 
 DB_FILE = "ecommerce.db"
 
@@ -40,7 +40,7 @@ def compute_and_save_aggregates(conn):
     print(f"Aggregates updated for {len(rows)} products.")
 
 def main():
-    conn = sqlite3.connect(DB_FILE)
+    conn = connect_writer(DB_FILE)
     create_aggregates_table(conn)
     compute_and_save_aggregates(conn)
     conn.close()
@@ -1,12 +1,31 @@
 import json
-import random
 import time
-from datetime import datetime
-from utils.logger import get_logger
+import random
+import argparse
+import itertools
+import multiprocessing
+from datetime import datetime, timedelta
+from storage.columnar import COLUMNAR_FILE, FrameBuilder
+from storage.schema import datetime_to_micros
+from transport.base import DEFAULT_TRANSPORT, get_transport, transport_names
+from transport.segment_log import DEFAULT_TOPIC, LOG_DIR
+from utils.logger import get_logger, sampled
+from utils.metrics import counter
 logger = get_logger(__name__)
 
+EVENTS_WRITTEN = counter("generator_events_total", "Events sent to the transport, generated or replayed")
 
-# Sample data for simulation
+OUTPUT_FILE = "events.jsonl"
+DEFAULT_RATE = 1.0  # events per second; 0 means as fast as possible
+DEFAULT_USERS = 1000
+DEFAULT_PRODUCTS = 100
+DEFAULT_ZIPF_S = 1.1  # popularity skew; 0 is uniform
+MAX_BATCH_SIZE = 10000  # events per write
+WRITES_PER_SECOND = 10  # batch size target when throttled
+PROGRESS_INTERVAL = 10  # seconds between throughput logs
+REPLAY_TICK = 0.01  # seconds of replayed traffic written together
+
+# Sample data for simulation; the first products of every catalog
 USERS = [f"user_{i}" for i in range(1, 6)]
 PRODUCTS = [
     {"id": "p1", "name": "Laptop", "price": 1200},
@@ -17,6 +36,8 @@ PRODUCTS = [
 ]
 
 EVENT_TYPES = ["user_signup", "product_view", "add_to_cart", "purchase"]
+# Browsing dominates real traffic; purchases are a few percent of events
+EVENT_TYPE_WEIGHTS = [3, 70, 20, 7]
 
 
 def generate_event():
@@ -35,19 +56,265 @@ def generate_event():
     }
 
 
-def run_event_stream(output_file="events.jsonl", delay=1):
-    """Continuously write events to a file until stopped."""
-    with open(output_file, "a") as f:  # append mode so we keep history
-        try:
-            while True:
-                event = generate_event()
-                f.write(json.dumps(event) + "\n")
-                f.flush()  # force write immediately
-                logger.info(f"Generated event: {event}")
-                time.sleep(delay)
-        except KeyboardInterrupt:
-            logger.info("Stopped event generation.")
+def zipf_cum_weights(n, s):
+    """Cumulative weights giving rank k (0-based) a probability proportional to 1 / (k + 1) ** s."""
+    return list(itertools.accumulate((k + 1) ** -s for k in range(n)))
+
+def product_info(index):
+    """Name and price of product ``index`` (0-based) without materialising the catalog."""
+    if index < len(PRODUCTS):
+        product = PRODUCTS[index]
+        return product["id"], product["name"], product["price"]
+    # Spread prices over $1-$1000 deterministically so runs are comparable
+    return f"p{index + 1}", f"Product {index + 1}", round(1 + (index * 7919) % 99900 / 100, 2)
+
+
+class LoadGenerator:
+    """Draws events from user and product catalogs with Zipfian popularity.
+
+    Catalogs are identified by index only, so millions of users and products
+    cost a list of cumulative weights each rather than a dict per entry. With
+    ``start_time`` timestamps advance by ``1 / rate`` per event instead of
+    following the wall clock, which makes the output fully reproducible.
+    """
+
+    def __init__(self, users=DEFAULT_USERS, products=DEFAULT_PRODUCTS, zipf_s=DEFAULT_ZIPF_S,
+                 seed=None, start_time=None, rate=DEFAULT_RATE):
+        self.random = random.Random(seed)
+        self.user_ranks = range(users)
+        self.product_ranks = range(products)
+        self.user_weights = zipf_cum_weights(users, zipf_s)
+        self.product_weights = zipf_cum_weights(products, zipf_s)
+        self.products = {}  # product_info cache for the popular head of the catalog
+        self.clock = start_time
+        self.step = timedelta(seconds=1 / rate if rate else 0.001)
+
+    def product(self, index):
+        info = self.products.get(index)
+        if info is None:
+            info = product_info(index)
+            if len(self.products) < 100000:
+                self.products[index] = info
+        return info
+
+    def batch(self, size):
+        """Return ``size`` events as JSON lines."""
+        return self.keyed_batch(size)[0]
+
+    def keyed_batch(self, size):
+        """Return ``size`` events as JSON lines, with the user id of each line for partitioning."""
+        lines, keys = [], []
+        for event_type, user_id, product_id, product_name, price, timestamp in self.draw(size):
+            keys.append(user_id)
+            lines.append(json.dumps({
+                "event_type": event_type,
+                "user_id": user_id,
+                "product_id": product_id,
+                "product_name": product_name,
+                "price": price,
+                "timestamp": timestamp.isoformat(),
+            }) + "\n")
+        return "".join(lines), keys
+
+    def frame(self, size):
+        """Return ``size`` events as a columnar ``FrameBuilder``, without going through JSON."""
+        builder = FrameBuilder()
+        for event_type, user_id, product_id, product_name, price, timestamp in self.draw(size):
+            builder.add(event_type, user_id, product_id, product_name, float(price), datetime_to_micros(timestamp))
+        return builder
+
+    def draw(self, size):
+        """``size`` events as (event_type, user_id, product_id, product_name, price, timestamp) tuples."""
+        choices = self.random.choices
+        event_types = choices(EVENT_TYPES, weights=EVENT_TYPE_WEIGHTS, k=size)
+        users = choices(self.user_ranks, cum_weights=self.user_weights, k=size)
+        products = choices(self.product_ranks, cum_weights=self.product_weights, k=size)
+        now = datetime.utcnow()
+        for event_type, user, product in zip(event_types, users, products):
+            product_id, product_name, price = self.product(product)
+            if self.clock is not None:
+                self.clock += self.step
+                timestamp = self.clock
+            else:
+                timestamp = now
+            yield event_type, f"user_{user + 1}", product_id, product_name, price, timestamp
+
+
+def open_producer(output_file=OUTPUT_FILE, transport=DEFAULT_TRANSPORT, transport_options=None):
+    """A producer for ``transport``; the jsonl transport appends to ``output_file``."""
+    return get_transport(transport, path=output_file, **(transport_options or {})).producer()
+
+def send(producer, data, keys=None):
+    """Send a block of lines in one write so parallel writers never interleave lines."""
+    producer.send(data, keys)
+    EVENTS_WRITTEN.inc(data.count("\n"))
+
+
+def run_event_stream(output_file=OUTPUT_FILE, rate=DEFAULT_RATE, count=None, batch_size=None,
+                     transport=DEFAULT_TRANSPORT, transport_options=None, **catalog):
+    """Send generated events at ``rate`` events per second until ``count`` or Ctrl+C.
+
+    Events are generated and appended in batches, and the pacing is
+    scheduled from the start time so that slow writes are caught up rather
+    than accumulating drift.
+    """
+    generator = LoadGenerator(rate=rate, **catalog)
+    if batch_size is None:
+        batch_size = max(1, min(MAX_BATCH_SIZE, int(rate / WRITES_PER_SECOND))) if rate else MAX_BATCH_SIZE
+    producer = open_producer(output_file, transport, transport_options)
+    binary = hasattr(producer, "send_frame")  # takes generated events without encoding them as JSON
+    sent = 0
+    start = last_report = time.monotonic()
+    reported = 0
+    try:
+        while count is None or sent < count:
+            size = batch_size if count is None else min(batch_size, count - sent)
+            if binary:
+                producer.send_frame(generator.frame(size))
+                EVENTS_WRITTEN.inc(size)
+            else:
+                send(producer, *generator.keyed_batch(size))
+            sent += size
+            now = time.monotonic()
+            if now - last_report >= PROGRESS_INTERVAL:
+                logger.info(f"Generated {sent} events ({(sent - reported) / (now - last_report):.0f} events/s)")
+                last_report, reported = now, sent
+            if rate:
+                delay = start + sent / rate - now
+                if delay > 0:
+                    time.sleep(delay)
+    except KeyboardInterrupt:
+        logger.info("Stopped event generation.")
+    finally:
+        producer.close()
+    elapsed = time.monotonic() - start
+    logger.info(f"Generated {sent} events in {elapsed:.1f}s ({sent / elapsed if elapsed else 0:.0f} events/s)")
+    return sent
+
+def run_parallel(writers, output_file=OUTPUT_FILE, rate=DEFAULT_RATE, count=None, seed=None, start_time=None, **options):
+    """Split the rate and count over ``writers`` processes sending to the same transport.
+
+    Worker ``i`` is seeded with ``seed + i``, so each worker's events are
+    reproducible; how the workers' batches interleave in the file is not.
+    """
+    processes = []
+    for i in range(writers):
+        worker_count = None if count is None else count // writers + (i < count % writers)
+        kwargs = dict(options, output_file=output_file, rate=rate / writers, count=worker_count,
+                      seed=None if seed is None else seed + i, start_time=start_time)
+        process = multiprocessing.Process(target=run_event_stream, kwargs=kwargs, name=f"writer-{i}")
+        process.start()
+        processes.append(process)
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.join()
+
+
+def replay(input_file, output_file=OUTPUT_FILE, speed=1.0, keep_timestamps=False,
+           transport=DEFAULT_TRANSPORT, transport_options=None):
+    """Replay a captured events file, preserving the gaps between events scaled by ``speed``.
+
+    ``speed`` 0 writes as fast as possible. Unless ``keep_timestamps`` is set,
+    timestamps are shifted (and compressed by ``speed``) so the replay looks
+    like live traffic starting now. Lines that aren't a JSON object with an
+    ISO timestamp can't be placed in time; they are skipped and counted.
+    """
+    producer = open_producer(output_file, transport, transport_options)
+    sent = 0
+    skipped = 0
+    start = time.monotonic()
+    first_ts = None
+    started_at = datetime.utcnow()
+    pending = []
+    due = 0.0
+    try:
+        with open(input_file, "rb") as f:
+            for line_number, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    event = json.loads(line)
+                    ts = datetime.fromisoformat(event["timestamp"])
+                    offset = (ts - (first_ts or ts)).total_seconds() / speed if speed else 0.0
+                except (ValueError, TypeError, KeyError) as e:
+                    # Not JSON, not an object, or a missing, unparseable or differently zoned timestamp
+                    skipped += 1
+                    logger.warning("Skipping replay line %d (%s: %s): %r", line_number, type(e).__name__, e, line[:200],
+                                   extra=sampled(100))
+                    continue
+                if first_ts is None:
+                    first_ts = ts
+                if offset - due > REPLAY_TICK and pending:
+                    # Write everything due in the current tick, then wait for the next event
+                    send(producer, "".join(pending))
+                    sent += len(pending)
+                    pending = []
+                if speed:
+                    delay = start + offset - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                due = offset
+                if keep_timestamps:
+                    pending.append(line.decode() if line.endswith(b"\n") else line.decode() + "\n")
+                else:
+                    event["timestamp"] = (started_at + timedelta(seconds=offset)).isoformat()
+                    pending.append(json.dumps(event) + "\n")
+                if len(pending) >= MAX_BATCH_SIZE:
+                    send(producer, "".join(pending))
+                    sent += len(pending)
+                    pending = []
+        if pending:
+            send(producer, "".join(pending))
+            sent += len(pending)
+    except KeyboardInterrupt:
+        logger.info("Stopped replay.")
+    finally:
+        producer.close()
+    elapsed = time.monotonic() - start
+    logger.info(f"Replayed {sent} events in {elapsed:.1f}s ({sent / elapsed if elapsed else 0:.0f} events/s); "
+                f"skipped {skipped} invalid lines")
+    return sent
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic ecommerce events or replay a captured events file")
+    parser.add_argument("--output", default=OUTPUT_FILE, help="File to append events to (jsonl transport)")
+    parser.add_argument("--transport", choices=transport_names(), default=DEFAULT_TRANSPORT, help="Where to send events: events.jsonl, a partitioned segment log or a columnar file")
+    parser.add_argument("--log-dir", default=LOG_DIR, help="Segment log directory (log transport)")
+    parser.add_argument("--topic", default=DEFAULT_TOPIC, help="Segment log topic (log transport)")
+    parser.add_argument("--partitions", type=int, help="Partitions of a new segment log topic (log transport)")
+    parser.add_argument("--columnar-file", default=COLUMNAR_FILE, help="File to append binary event frames to (columnar transport)")
+    parser.add_argument("--rate", type=float, default=DEFAULT_RATE, help="Target events per second across all writers (0 = unthrottled)")
+    parser.add_argument("--count", type=int, help="Stop after this many events (default: run until Ctrl+C)")
+    parser.add_argument("--users", type=int, default=DEFAULT_USERS, help="Number of users in the catalog")
+    parser.add_argument("--products", type=int, default=DEFAULT_PRODUCTS, help="Number of products in the catalog")
+    parser.add_argument("--zipf-s", type=float, default=DEFAULT_ZIPF_S, help="Zipf exponent for user and product popularity (0 = uniform)")
+    parser.add_argument("--batch-size", type=int, help="Events per write (default: about 10 writes per second)")
+    parser.add_argument("--writers", type=int, default=1, help="Parallel writer processes")
+    parser.add_argument("--seed", type=int, help="Random seed for reproducible events")
+    parser.add_argument("--start-time", type=datetime.fromisoformat, help="Synthetic timestamps from this ISO time, 1/rate apart, instead of the wall clock")
+    parser.add_argument("--replay", metavar="FILE", help="Replay a captured events file instead of generating events")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay speed multiplier (0 = as fast as possible)")
+    parser.add_argument("--keep-timestamps", action="store_true", help="Replay events with their original timestamps")
+    args = parser.parse_args()
+
+    transport_options = dict(log_dir=args.log_dir, topic=args.topic, partitions=args.partitions,
+                             columnar_file=args.columnar_file)
+    if args.replay:
+        replay(args.replay, args.output, args.speed, args.keep_timestamps, args.transport, transport_options)
+        return
+
+    options = dict(output_file=args.output, transport=args.transport, transport_options=transport_options,
+                   rate=args.rate, count=args.count, batch_size=args.batch_size, users=args.users, products=args.products, zipf_s=args.zipf_s,
+                   seed=args.seed, start_time=args.start_time)
+    if args.writers > 1:
+        run_parallel(args.writers, **options)
+    else:
+        run_event_stream(**options)
 
 
 if __name__ == "__main__":
-    run_event_stream()
+    main()
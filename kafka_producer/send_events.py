@@ -0,0 +1,72 @@
+import os
+import sys
+import argparse
+from storage.columnar import COLUMNAR_FILE
+from transport.base import DEFAULT_TRANSPORT, get_transport, transport_names
+from transport.jsonl import EVENT_FILE
+from transport.segment_log import DEFAULT_SEGMENT_BYTES, DEFAULT_TOPIC, LOG_DIR
+from utils.logger import get_logger
+
+READ_BYTES = 1 << 20  # input read per send; a send holds complete lines only
+
+logger = get_logger(__name__)
+
+
+def send_stream(producer, fd):
+    """Send the JSON lines read from ``fd`` until EOF, in blocks of complete lines; returns the count sent."""
+    sent = 0
+    partial = b""
+    while True:
+        data = os.read(fd, READ_BYTES)  # From a pipe, returns whatever has arrived so far
+        if not data:
+            break
+        data = partial + data
+        end = data.rfind(b"\n") + 1
+        partial = data[end:]
+        if end:
+            producer.send(data[:end])
+            sent += data.count(b"\n", 0, end)
+    if partial.strip():
+        producer.send(partial + b"\n")  # The input ended without a final newline
+        sent += 1
+    return sent
+
+def send_files(producer, paths):
+    sent = 0
+    for path in paths:
+        if path == "-":
+            sent += send_stream(producer, sys.stdin.fileno())
+            continue
+        with open(path, "rb") as f:
+            sent += send_stream(producer, f.fileno())
+    return sent
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send JSON lines events from files or stdin to a transport")
+    parser.add_argument("files", nargs="*", default=["-"], help="Files of JSON lines to send ('-' or none reads stdin)")
+    parser.add_argument("--transport", choices=transport_names(), default=DEFAULT_TRANSPORT, help="Where to send events: events.jsonl, a partitioned segment log or a columnar file")
+    parser.add_argument("--output", default=EVENT_FILE, help="File to append events to (jsonl transport)")
+    parser.add_argument("--columnar-file", default=COLUMNAR_FILE, help="File to append binary event frames to (columnar transport)")
+    parser.add_argument("--log-dir", default=LOG_DIR, help="Segment log directory (log transport)")
+    parser.add_argument("--topic", default=DEFAULT_TOPIC, help="Segment log topic (log transport)")
+    parser.add_argument("--partitions", type=int, help="Partitions of a new topic (log transport)")
+    parser.add_argument("--segment-bytes", type=int, default=DEFAULT_SEGMENT_BYTES, help="Size at which a partition's active segment rolls over (log transport)")
+    parser.add_argument("--retention-segments", type=int, help="Segments kept per partition, oldest deleted first (log transport; default: keep all)")
+    args = parser.parse_args()
+
+    transport = get_transport(args.transport, path=args.output, columnar_file=args.columnar_file,
+                              log_dir=args.log_dir, topic=args.topic, partitions=args.partitions,
+                              segment_bytes=args.segment_bytes, retention_segments=args.retention_segments)
+    producer = transport.producer()
+    try:
+        sent = send_files(producer, args.files)
+    except KeyboardInterrupt:
+        logger.info("Stopped sending events.")
+        return
+    finally:
+        producer.close()
+    logger.info(f"Sent {sent} events to {transport.describe()}")
+
+if __name__ == "__main__":
+    main()
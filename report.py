@@ -1,7 +1,14 @@
-import sqlite3
 import argparse
+from datetime import datetime
 from tabulate import tabulate
+from bucket_events import DAY
+from sketch_events import distinct_count, heavy_hitters
+from storage.connection import connect_reader
+from storage.schema import datetime_to_micros, iso_to_micros
+from storage.store import range_totals
+from summarize_events import read_summary
 from utils.logger import get_logger
+from utils.metrics import histogram
 
 DB_FILE = "ecommerce.db"
 logger = get_logger(__name__)
@@ -48,49 +55,83 @@ def print_top_users(cur, limit=5):
 
 def print_summary_stats(cur):
     print("\n=== Summary Statistics ===")
-    
-    # Total revenue across all products
-    cur.execute("SELECT printf('$%.2f', SUM(total_revenue)) FROM aggregates")
-    total_revenue = cur.fetchone()[0]
-    
-    # Total number of purchases
-    cur.execute("SELECT SUM(total_sales) FROM aggregates")
-    total_sales = cur.fetchone()[0]
-    
-    # Total number of active users
-    cur.execute("SELECT COUNT(*) FROM top_users")
-    active_users = cur.fetchone()[0]
-    
-    # Average revenue per purchase
-    cur.execute("""
-    SELECT printf('$%.2f', SUM(total_revenue) / SUM(total_sales)) 
-    FROM aggregates
-    """)
-    avg_per_purchase = cur.fetchone()[0]
-    
+
+    # Maintained by the summary rollup; one small table instead of scanning the others
+    summary = read_summary(cur)
+    # The (est.) counts come from the HyperLogLog sketches and include users who never bought
+    day_ago = datetime_to_micros(datetime.utcnow()) - DAY
     stats = [
-        ["Total Revenue", total_revenue],
-        ["Total Purchases", total_sales],
-        ["Active Users", active_users],
-        ["Avg per Purchase", avg_per_purchase]
+        ["Total Revenue", f"${summary['total_revenue']:.2f}"],
+        ["Total Purchases", summary["total_purchases"]],
+        ["Buyers", summary["active_users"]],  # Exact, the dashboard's "Active Users"
+        ["Users (est.)", distinct_count(cur, "users")],
+        ["Users, last 24h (est.)", distinct_count(cur, "users", day_ago)],
+        ["Products Seen (est.)", distinct_count(cur, "products")],
+        ["Avg per Purchase", f"${summary['avg_order_value']:.2f}"],
     ]
+    stats += [[f"{event_type.replace('_', ' ').title()} Events", events] for event_type, events in summary["events_by_type"].items()]
     print(tabulate(stats, headers=['Metric', 'Value'], tablefmt='grid'))
 
+def print_heavy_hitters(cur, limit=5, start=None, end=None):
+    """Most purchased products and most frequent buyers, estimated from the heavy-hitter sketches."""
+    start_ts = iso_to_micros(start) if start else None
+    end_ts = iso_to_micros(end) if end else None
+    print(f"\n=== Most Purchased Products from {start or 'the beginning'} to {end or 'now'} (estimated) ===")
+    products = heavy_hitters(cur, "top_products", limit, start_ts, end_ts)
+    names = dict(cur.execute(
+        f"SELECT product_id, product_name FROM products WHERE product_id IN ({', '.join('?' * len(products))})",
+        [product_id for product_id, _ in products],
+    ).fetchall())
+    print(tabulate([(product_id, names.get(product_id), purchases) for product_id, purchases in products],
+                   headers=['Product ID', 'Product', 'Purchases'], tablefmt='grid'))
+    print(f"\n=== Most Frequent Buyers from {start or 'the beginning'} to {end or 'now'} (estimated) ===")
+    print(tabulate(heavy_hitters(cur, "top_buyers", limit, start_ts, end_ts),
+                   headers=['User', 'Purchases'], tablefmt='grid'))
+
+def print_range_totals(conn, start=None, end=None):
+    """Counts and revenue per product and event type for events in [start, end).
+
+    Read from the raw events (hot table and the partitions overlapping the
+    range) and the compacted daily rollups rather than the running totals.
+    """
+    print(f"\n=== Events from {start or 'the beginning'} to {end or 'now'} ===")
+    rows = range_totals(
+        conn,
+        iso_to_micros(start) if start else None,
+        iso_to_micros(end) if end else None,
+    )
+    print(tabulate([(product_name, event_type, events, f"${revenue:.2f}")
+                    for _, product_name, event_type, events, revenue in rows],
+                   headers=['Product', 'Event Type', 'Events', 'Revenue'], tablefmt='grid'))
+
+REPORT_SECONDS = histogram("report_seconds", "Time to query and print the combined report")
+
+def print_report(conn, top=5, start=None, end=None):
+    with REPORT_SECONDS.time():
+        print_report_sections(conn, top, start, end)
+
+def print_report_sections(conn, top, start, end):
+    cur = conn.cursor()
+
+    print("\n=== E-commerce Analytics Report ===")
+    print_summary_stats(cur)
+    print_product_aggregates(cur)
+    print_event_counts(cur)
+    print_top_users(cur, top)
+    print_heavy_hitters(cur, top, start, end)
+    if start or end:
+        print_range_totals(conn, start, end)
+
 def main():
     parser = argparse.ArgumentParser(description="Generate combined report from all aggregates")
     parser.add_argument("--top", type=int, default=5, help="Number of top users to show")
+    parser.add_argument("--start", help="Also report events from this ISO date/time (UTC)")
+    parser.add_argument("--end", help="Also report events before this ISO date/time (UTC)")
     args = parser.parse_args()
 
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cur = conn.cursor()
-        
-        print("\n=== E-commerce Analytics Report ===")
-        print_summary_stats(cur)
-        print_product_aggregates(cur)
-        print_event_counts(cur)
-        print_top_users(cur, args.top)
-        
+        conn = connect_reader(DB_FILE)
+        print_report(conn, args.top, args.start, args.end)
     except Exception as e:
         logger.error(f"Failed to generate report: {e}")
     finally:
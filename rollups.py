@@ -0,0 +1,351 @@
+import time
+import sqlite3
+import importlib
+from datetime import datetime
+from storage.store import SELECT_EVENTS_SQL, archived_after, iter_archived_events, iter_daily_rollups
+from utils.logger import get_logger
+from utils.metrics import COUNT_BUCKETS, counter, gauge, histogram
+
+CHUNK_SIZE = 50000  # events read and committed per transaction
+
+READ_EVENTS_SQL = SELECT_EVENTS_SQL.format(table="events") + """WHERE events.id > ? AND events.id <= ?
+ORDER BY events.id
+LIMIT ?
+"""
+
+# Modules whose rollups run by default; importing them registers the rollups
+DEFAULT_ROLLUP_MODULES = ["transform_events", "aggregate_event_counts", "track_top_users", "summarize_events", "bucket_events", "sketch_events"]
+
+logger = get_logger(__name__)
+
+TICK_SECONDS = histogram("aggregator_tick_seconds", "Time for one pass over new events, by engine", ["rollups"])
+APPLY_SECONDS = histogram("rollup_apply_seconds", "Time to fold a consumer batch in push mode, by engine", ["rollups"])
+EVENTS_FOLDED = counter("aggregator_events_total", "Events folded into rollups, by engine", ["rollups"])
+TICK_ROWS = histogram("aggregator_tick_rows", "Events scanned in one pass, by engine", ["rollups"], COUNT_BUCKETS)
+EVENTS_MAX_ID = gauge("events_max_id", "Highest event id seen at the start of the last pass")
+HIGH_WATER_MARK = gauge("rollup_high_water_mark", "Last event id folded into each rollup", ["rollup"])
+ROLLUP_SUCCESS = gauge("rollup_last_success_timestamp_seconds",
+                       "Unix time each rollup was last committed or found up to date", ["rollup"])
+ROLLUP_EVENT_TIME = gauge("rollup_newest_event_timestamp_seconds",
+                          "Timestamp of the newest event folded into each rollup", ["rollup"])
+
+ROLLUPS = {}
+
+
+def register_rollup(cls):
+    """Class decorator that makes a rollup selectable by its ``name``."""
+    ROLLUPS[cls.name] = cls
+    return cls
+
+
+class Rollup:
+    """A metric the aggregation engine keeps up to date from the events table.
+
+    The engine reads each new chunk of events once and hands every event to
+    ``fold``, which accumulates deltas in memory. ``flush`` then writes those
+    deltas inside the engine's transaction, together with the rollup's
+    high-water mark in ``aggregation_state``. Events support item access by
+    column name (``event["product_id"]``), so a rollup works the same on
+    ``sqlite3.Row`` objects and on parsed event dicts; ``event["ts"]`` is the
+    timestamp in epoch microseconds.
+    """
+
+    name = None
+
+    def __init__(self, **options):
+        """Rollups receive every engine option and ignore the ones they don't use."""
+
+    def create_table(self, conn):
+        raise NotImplementedError
+
+    def load(self, conn, last_event_id):
+        """Restore in-memory state to continue after ``last_event_id``.
+
+        Also called to drop deltas folded since the last flush when the
+        transaction that would have committed them was rolled back.
+        """
+
+    def reset(self, conn):
+        """Clear the rollup's table so it can be recomputed from the first event."""
+        conn.execute(f"DELETE FROM {self.name}")
+
+    def fold(self, event):
+        raise NotImplementedError
+
+    def fold_daily(self, totals):
+        """Fold one row of compacted history from ``storage.store.iter_daily_rollups``.
+
+        Only rollups that can be derived from daily per-product counts and
+        revenue need to implement this; the others skip compacted days.
+        """
+
+    def flush(self, conn):
+        """Write the deltas accumulated since the last flush and clear them."""
+        raise NotImplementedError
+
+    def backfill(self, conn, history):
+        """Recompute the table from ``backfill.History`` instead of folding every event.
+
+        Called inside a transaction, after ``reset`` and ``load(conn, 0)``.
+        Only rollups that can be derived from the totals ``History`` keeps
+        implement this; backfill.py rebuilds the others by folding events.
+        """
+        raise NotImplementedError
+
+
+def create_aggregation_state_table(conn):
+    # ``version`` goes up on every commit, including rebuilds; see storage.schema._version_rollups
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS aggregation_state (
+        name TEXT PRIMARY KEY,
+        last_event_id INTEGER,
+        updated_at TEXT,
+        version INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    conn.commit()
+
+def get_high_water_mark(conn, name):
+    row = conn.execute("SELECT last_event_id FROM aggregation_state WHERE name = ?", (name,)).fetchone()
+    return None if row is None else row[0]
+
+def set_high_water_mark(conn, name, last_event_id):
+    conn.execute("""
+    INSERT INTO aggregation_state (name, last_event_id, updated_at, version)
+    VALUES (?, ?, ?, 1)
+    ON CONFLICT(name) DO UPDATE SET
+        last_event_id=excluded.last_event_id,
+        updated_at=excluded.updated_at,
+        version=aggregation_state.version + 1
+    """, (name, last_event_id, datetime.utcnow().isoformat()))
+
+
+def advance_high_water_mark(conn, name, expected_event_id, last_event_id):
+    """Move a mark forward only if it still equals ``expected_event_id``.
+
+    Returns False when another process advanced the mark in the meantime, in
+    which case the caller must roll back rather than apply its deltas twice.
+    """
+    cur = conn.execute("""
+    UPDATE aggregation_state
+    SET last_event_id = ?, updated_at = ?, version = version + 1
+    WHERE name = ? AND last_event_id = ?
+    """, (last_event_id, datetime.utcnow().isoformat(), name, expected_event_id))
+    return cur.rowcount == 1
+
+
+class StaleMarkError(Exception):
+    """Another process advanced a rollup's high-water mark during a pass."""
+
+
+class AggregationEngine:
+    """Updates several rollups from a single scan of new events.
+
+    Each rollup has its own high-water mark, so a newly added rollup is built
+    from the first event while the others continue where they left off. Events
+    are read once per chunk in id order and every chunk is committed in one
+    transaction covering all rollup tables and their marks. SQLite has a single
+    writer, so once an id is visible every smaller id is committed too and no
+    event can be skipped.
+
+    Marks are advanced with a compare-and-set, so several engines (the polling
+    aggregator and a consumer pushing rollups) can share the same tables: the
+    one that loses the race rolls back and reloads its state.
+    """
+
+    def __init__(self, conn, rollups, chunk_size=CHUNK_SIZE):
+        self.conn = conn
+        self.rollups = rollups
+        self.chunk_size = chunk_size
+        self.marks = {}
+        label = ",".join(rollup.name for rollup in rollups)
+        self.tick_seconds = TICK_SECONDS.labels(label)
+        self.apply_seconds = APPLY_SECONDS.labels(label)
+        self.events_folded = EVENTS_FOLDED.labels(label)
+        self.tick_rows = TICK_ROWS.labels(label)
+        create_aggregation_state_table(conn)
+        for rollup in rollups:
+            rollup.create_table(conn)
+        with conn:
+            for rollup in rollups:
+                mark = get_high_water_mark(conn, rollup.name)
+                if mark is None:
+                    # No mark yet (new rollup, or a table filled by an older version)
+                    logger.info(f"No high-water mark for {rollup.name}; building it from scratch")
+                    self.reset([rollup])
+                elif archived_after(conn, mark):
+                    # Archiving only waits for registered rollups; this one was away
+                    logger.info(f"Events after the high-water mark of {rollup.name} were archived; building it from scratch")
+                    self.reset([rollup])
+                else:
+                    rollup.load(conn, mark)
+                    self.marks[rollup.name] = mark
+
+    def rebuild(self):
+        """Reset every rollup so the next pass recomputes it from the first event."""
+        with self.conn:
+            self.reset(self.rollups)
+        logger.info(f"Reset {', '.join(r.name for r in self.rollups)} for a full rebuild")
+
+    def reset(self, rollups):
+        """Clear ``rollups`` and fold in the history that left the events table.
+
+        Archived partitions and compacted daily totals are replayed here, so
+        the mark can start at 0 and the next pass only has to read the hot
+        events table. Call inside a transaction.
+        """
+        for rollup in rollups:
+            rollup.reset(self.conn)
+            rollup.load(self.conn, 0)
+        for totals in iter_daily_rollups(self.conn):
+            for rollup in rollups:
+                rollup.fold_daily(totals)
+        for events in iter_archived_events(self.conn, self.chunk_size):
+            for rollup in rollups:
+                fold = rollup.fold
+                for event in events:
+                    fold(event)
+        for rollup in rollups:
+            rollup.flush(self.conn)
+            set_high_water_mark(self.conn, rollup.name, 0)
+            self.marks[rollup.name] = 0
+
+    def refresh(self, force=False):
+        """Re-read the stored marks and reload rollups whose mark moved elsewhere.
+
+        ``force`` reloads every rollup, discarding deltas folded but not
+        committed, e.g. after the transaction that would have written them
+        was rolled back.
+        """
+        for rollup in self.rollups:
+            mark = get_high_water_mark(self.conn, rollup.name) or 0
+            if force or mark != self.marks[rollup.name]:
+                rollup.load(self.conn, mark)
+                self.marks[rollup.name] = mark
+
+    def discard(self):
+        self.refresh(force=True)
+
+    def read_events(self, after_id, up_to_id):
+        """Yield chunks of stored events with ``after_id < id <= up_to_id`` in id order."""
+        cur = self.conn.cursor()
+        cur.row_factory = sqlite3.Row
+        while after_id < up_to_id:
+            cur.execute(READ_EVENTS_SQL, (after_id, up_to_id, self.chunk_size))
+            events = cur.fetchall()
+            if not events:
+                return
+            yield events
+            after_id = events[-1]["id"]
+
+    def fold(self, events, rollups=None):
+        """Fold stored events into the rollups whose mark is below each event's id."""
+        for rollup in rollups or self.rollups:
+            mark = self.marks[rollup.name]
+            fold = rollup.fold
+            for event in events:
+                if event["id"] > mark:
+                    fold(event)
+
+    def flush(self, last_event_id):
+        """Write every rollup's deltas and advance its mark; call inside a transaction.
+
+        Rollups already past ``last_event_id`` (while a newly added one
+        catches up) folded nothing and keep their mark.
+        """
+        for rollup in self.rollups:
+            if self.marks[rollup.name] >= last_event_id:
+                continue
+            if not advance_high_water_mark(self.conn, rollup.name, self.marks[rollup.name], last_event_id):
+                raise StaleMarkError(rollup.name)
+            rollup.flush(self.conn)
+            self.marks[rollup.name] = last_event_id
+
+    def committed(self, newest_ts=None):
+        """Publish each rollup's mark and freshness once the transaction that wrote them committed."""
+        now = time.time()
+        for rollup in self.rollups:
+            HIGH_WATER_MARK.labels(rollup.name).set(self.marks[rollup.name])
+            ROLLUP_SUCCESS.labels(rollup.name).set(now)
+            if newest_ts is not None:
+                ROLLUP_EVENT_TIME.labels(rollup.name).set(newest_ts / 1e6)
+
+    def run_pass(self):
+        """Fold every event added since the last pass; returns the number of events read."""
+        started = time.perf_counter()
+        self.refresh()
+        start = min(self.marks.values())
+        max_event_id = self.conn.execute("SELECT MAX(id) FROM events").fetchone()[0] or 0
+        EVENTS_MAX_ID.set(max(max_event_id, start))  # The hot table is empty after archiving
+        if max_event_id <= start:
+            self.tick_seconds.observe(time.perf_counter() - started)
+            self.tick_rows.observe(0)
+            self.committed()
+            logger.info("No new events since the last update.")
+            return 0
+
+        processed = 0
+        last_id = start
+        try:
+            for events in self.read_events(start, max_event_id):
+                self.fold(events)
+                with self.conn:
+                    self.flush(events[-1]["id"])
+                self.committed(events[-1]["ts"])
+                processed += len(events)
+                last_id = events[-1]["id"]
+        except StaleMarkError as e:
+            logger.info(f"High-water mark for {e} was advanced by another process; reloading")
+            self.discard()
+        except Exception:
+            self.discard()
+            raise
+
+        self.tick_seconds.observe(time.perf_counter() - started)
+        self.tick_rows.observe(processed)
+        self.events_folded.inc(processed)
+        logger.info(f"Updated {', '.join(r.name for r in self.rollups)} from {processed} events ({start + 1}-{last_id}).")
+        return processed
+
+    def apply(self, events, last_event_id):
+        """Fold events that were just inserted in the caller's open transaction.
+
+        ``events`` are the parsed events with ids ``last_event_id - len(events) + 1``
+        through ``last_event_id``. Rollups that are behind are first caught up
+        from the table, then the in-memory events are folded without reading
+        them back, and the deltas and marks are written in the same transaction
+        as the insert. Call ``discard`` if that transaction is rolled back and
+        ``committed`` once it commits.
+        """
+        started = time.perf_counter()
+        self.refresh()
+        first_event_id = last_event_id - len(events) + 1
+        behind = [rollup for rollup in self.rollups if self.marks[rollup.name] < first_event_id - 1]
+        if behind:
+            start = min(self.marks[rollup.name] for rollup in behind)
+            for stored in self.read_events(start, first_event_id - 1):
+                self.fold(stored, behind)
+        for rollup in self.rollups:
+            fold = rollup.fold
+            # Skip the events a rollup that is ahead has already folded
+            for event in events[max(self.marks[rollup.name] - first_event_id + 1, 0):]:
+                fold(event)
+        self.flush(last_event_id)
+        self.apply_seconds.observe(time.perf_counter() - started)
+        self.events_folded.inc(len(events))
+
+
+def registered_rollups(modules=DEFAULT_ROLLUP_MODULES):
+    """Import rollup modules and return the names of every registered rollup."""
+    for module in modules:
+        importlib.import_module(module)
+    return list(ROLLUPS)
+
+def load_rollups(names, modules=DEFAULT_ROLLUP_MODULES, **options):
+    """Import rollup modules and instantiate the named rollups (all when ``names`` is empty)."""
+    available = registered_rollups(modules)
+    names = names or available
+    unknown = [name for name in names if name not in ROLLUPS]
+    if unknown:
+        raise ValueError(f"Unknown rollup(s): {', '.join(unknown)}. Available: {', '.join(ROLLUPS)}")
+    return [ROLLUPS[name](**options) for name in names]
@@ -4,16 +4,17 @@
 source venv/bin/activate
 
 # Kill any existing Python processes
-pkill -f "python consumer/consumer.py"
+pkill -f "python -m consumer.consumer"
 pkill -f "python event_generator.py"
 pkill -f "python transform_events.py"
 pkill -f "python aggregate_event_counts.py"
 pkill -f "python track_top_users.py"
+pkill -f "python aggregator.py"
 
 echo "Starting pipeline components..."
 
 # Start consumer first to ensure no events are missed
-python consumer/consumer.py &
+python -m consumer.consumer &
 CONSUMER_PID=$!
 echo "Started consumer (PID: $CONSUMER_PID)"
 
@@ -25,23 +26,13 @@ python event_generator.py &
 GENERATOR_PID=$!
 echo "Started event generator (PID: $GENERATOR_PID)"
 
-# Start transformer
-python transform_events.py &
-TRANSFORMER_PID=$!
-echo "Started transformer (PID: $TRANSFORMER_PID)"
-
-# Start event count aggregator
-python aggregate_event_counts.py &
+# Start aggregation engine (every registered rollup in one pass; --rollups NAME limits it)
+python aggregator.py &
 AGGREGATOR_PID=$!
-echo "Started event count aggregator (PID: $AGGREGATOR_PID)"
-
-# Start top users tracker
-python track_top_users.py &
-USERS_TRACKER_PID=$!
-echo "Started top users tracker (PID: $USERS_TRACKER_PID)"
+echo "Started aggregation engine (PID: $AGGREGATOR_PID)"
 
 echo "All components started. Press Ctrl+C to stop all processes."
 
 # Wait for Ctrl+C
-trap "kill $CONSUMER_PID $GENERATOR_PID $TRANSFORMER_PID $AGGREGATOR_PID $USERS_TRACKER_PID; exit" SIGINT
+trap "kill $CONSUMER_PID $GENERATOR_PID $AGGREGATOR_PID; exit" SIGINT
 wait
@@ -0,0 +1,210 @@
+import sqlite3
+from bucket_events import DAY, HOUR, bucket_end, bucket_start
+from rollups import Rollup, register_rollup
+from storage.schema import PURCHASE_TYPE, iso_to_micros
+from storage.store import MAX_TS, MIN_TS, iter_daily_rollups, newest_event_ts
+from utils.logger import get_logger
+from utils.sketches import HeavyHitters, HyperLogLog, load_sketch, merge_sketches
+
+HOUR_RETENTION = 2 * DAY  # hour sketches kept behind the newest event; day sketches are kept forever
+BACKFILL_DAYS = 32  # day sketches a backfill holds in memory before writing them
+
+# What each bucket sketches; every bucket has one of each
+SKETCHES = {
+    "users": HyperLogLog,  # distinct users, any event
+    "buyers": HyperLogLog,  # distinct users with a purchase
+    "products": HyperLogLog,  # distinct products, any event
+    "top_products": HeavyHitters,  # purchases per product id
+    "top_buyers": HeavyHitters,  # purchases per user id
+}
+
+logger = get_logger(__name__)
+
+def create_event_sketches_table(conn):
+    # Sketches are up to tens of KB, too big for a WITHOUT ROWID table
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS event_sketches (
+        resolution TEXT,
+        bucket_ts INTEGER,
+        name TEXT,
+        sketch BLOB NOT NULL,
+        PRIMARY KEY (resolution, bucket_ts, name)
+    )
+    """)
+    conn.commit()
+
+def new_sketches():
+    return {name: factory() for name, factory in SKETCHES.items()}
+
+def merge_into(sketches, other):
+    for name, sketch in other.items():
+        sketches[name].merge(sketch)
+
+@register_rollup
+class SketchRollup(Rollup):
+    """Distinct users and products and the most purchased products and buyers, per hour and day.
+
+    Each bucket holds the sketches in ``SKETCHES`` (see utils/sketches.py),
+    stored as BLOBs. Events are sketched per hour; ``flush`` merges each hour
+    into its day and both into the stored sketches. Hour sketches older than
+    ``HOUR_RETENTION`` (from the newest event folded) are only kept in their
+    day, also in memory while replaying history, so memory depends on the
+    number of buckets, not on how many users there are. Compacted history
+    has no users, so it only adds to the product sketches of its day.
+    Maintained by ``aggregator.py``; ``--rollups event_sketches`` runs it alone.
+    """
+
+    name = "event_sketches"
+
+    def __init__(self, **options):
+        self.hours = {}  # hour bucket -> sketches of the events folded since the last flush
+        self.days = {}  # day bucket -> sketches of expired hours and compacted days
+        self.now = None
+
+    def create_table(self, conn):
+        create_event_sketches_table(conn)
+
+    def load(self, conn, last_event_id):
+        self.hours = {}
+        self.days = {}
+        self.now = newest_event_ts(conn, last_event_id)
+
+    def cutoff(self):
+        """Start of the oldest hour bucket kept."""
+        return MIN_TS if self.now is None else bucket_start(self.now, HOUR) - HOUR_RETENTION
+
+    def day(self, ts):
+        sketches = self.days.get(ts)
+        if sketches is None:
+            sketches = self.days[ts] = new_sketches()
+        return sketches
+
+    def expire(self):
+        """Move hours that fell out of the retention into their days."""
+        cutoff = self.cutoff()
+        for hour in [hour for hour in self.hours if hour < cutoff]:
+            merge_into(self.day(bucket_start(hour, DAY)), self.hours.pop(hour))
+
+    def hour(self, hour):
+        """Sketches of ``hour``, or of its day if the hour is no longer kept."""
+        sketches = self.hours.get(hour)
+        if sketches is None:
+            self.expire()
+            if hour < self.cutoff():
+                sketches = self.day(bucket_start(hour, DAY))  # A late event for an hour no longer kept
+            else:
+                sketches = self.hours[hour] = new_sketches()
+        return sketches
+
+    def fold(self, event):
+        ts = event["ts"]
+        if self.now is None or ts > self.now:
+            self.now = ts
+        sketches = self.hour(ts - ts % HOUR)
+        user_id, product_id = event["user_id"], event["product_id"]
+        sketches["users"].add(user_id)
+        sketches["products"].add(product_id)
+        if event["event_type"] == PURCHASE_TYPE:
+            sketches["buyers"].add(user_id)
+            sketches["top_products"].add(product_id)
+            sketches["top_buyers"].add(user_id)
+
+    def fold_daily(self, totals):
+        sketches = self.day(iso_to_micros(totals["day"]))
+        sketches["products"].add(totals["product_id"])
+        if totals["event_type"] == PURCHASE_TYPE:
+            sketches["top_products"].add(totals["product_id"], totals["events"])
+
+    def backfill(self, conn, history):
+        # Hours past the retention go straight into their days, as after a replay
+        self.load(conn, history.up_to_id)
+        for totals in iter_daily_rollups(conn):
+            self.fold_daily(totals)
+            if len(self.days) >= BACKFILL_DAYS:
+                self.flush(conn)
+        for hour, users, products in history.hours():
+            sketches = self.hour(hour)
+            for user_id, purchases in users.items():
+                sketches["users"].add(user_id)
+                if purchases:
+                    sketches["buyers"].add(user_id)
+                    sketches["top_buyers"].add(user_id, purchases)
+            for product_id, purchases in products.items():
+                sketches["products"].add(product_id)
+                if purchases:
+                    sketches["top_products"].add(product_id, purchases)
+            if len(self.days) >= BACKFILL_DAYS:
+                self.flush(conn)
+        self.flush(conn)
+
+    def flush(self, conn):
+        cutoff = self.cutoff()
+        for hour, sketches in self.hours.items():
+            merge_into(self.day(bucket_start(hour, DAY)), sketches)
+        buckets = [("hour", hour, sketches) for hour, sketches in self.hours.items() if hour >= cutoff]
+        buckets += [("day", day, sketches) for day, sketches in self.days.items()]
+        rows = []
+        for resolution, ts, sketches in buckets:
+            for name, data in conn.execute(
+                "SELECT name, sketch FROM event_sketches WHERE resolution = ? AND bucket_ts = ?", (resolution, ts)
+            ):
+                sketches[name].merge(load_sketch(data))
+            rows += [(resolution, ts, name, sketch.to_bytes()) for name, sketch in sketches.items()]
+        conn.executemany("INSERT OR REPLACE INTO event_sketches (resolution, bucket_ts, name, sketch) VALUES (?, ?, ?, ?)", rows)
+        conn.execute("DELETE FROM event_sketches WHERE resolution = 'hour' AND bucket_ts < ?", (cutoff,))
+        logger.debug(f"event_sketches: {len(rows)} sketches written")
+        self.hours = {}
+        self.days = {}
+
+def sketch_ranges(conn, start_ts, end_ts):
+    """Disjoint (resolution, start, end) ranges of buckets that cover ``start_ts <= ts < end_ts``.
+
+    Whole days come from day buckets and the partial days at either end from
+    hour buckets, widened to whole hours; an end older than the hours kept is
+    widened to its whole day instead.
+    """
+    oldest_hour = conn.execute("SELECT MIN(bucket_ts) FROM event_sketches WHERE resolution = 'hour'").fetchone()[0]
+    first_day, last_day = bucket_end(start_ts, DAY), bucket_start(end_ts, DAY)
+    if first_day < last_day:
+        ranges = [("day", first_day, last_day)]
+        edges = [(start_ts, first_day), (last_day, end_ts)]
+    else:
+        ranges = []
+        edges = [(start_ts, end_ts)]
+    for start, end in edges:
+        if start >= end:
+            continue
+        if oldest_hour is not None and bucket_start(start, HOUR) >= oldest_hour:
+            ranges.append(("hour", bucket_start(start, HOUR), bucket_end(end, HOUR)))
+        else:
+            ranges.append(("day", bucket_start(start, DAY), bucket_end(end, DAY)))
+    return ranges
+
+def read_sketch(conn, name, start_ts=None, end_ts=None):
+    """The ``name`` sketch merged over ``start_ts <= ts < end_ts`` (all history by default).
+
+    Returns None if nothing was sketched in the range, or the rollup never ran.
+    """
+    start_ts = MIN_TS if start_ts is None else start_ts
+    end_ts = MAX_TS if end_ts is None else end_ts
+    try:
+        return merge_sketches(
+            load_sketch(data)
+            for resolution, start, end in sketch_ranges(conn, start_ts, end_ts)
+            for data, in conn.execute("""
+            SELECT sketch FROM event_sketches
+            WHERE resolution = ? AND bucket_ts >= ? AND bucket_ts < ? AND name = ?
+            """, (resolution, start, end, name))
+        )
+    except sqlite3.OperationalError:
+        return None
+
+def distinct_count(conn, name, start_ts=None, end_ts=None):
+    """Estimated distinct ``users``, ``buyers`` or ``products`` in the range."""
+    sketch = read_sketch(conn, name, start_ts, end_ts)
+    return 0 if sketch is None else sketch.estimate()
+
+def heavy_hitters(conn, name, n, start_ts=None, end_ts=None):
+    """``(id, estimated purchases)`` of the ``n`` ``top_products`` or ``top_buyers`` in the range."""
+    sketch = read_sketch(conn, name, start_ts, end_ts)
+    return [] if sketch is None else sketch.top(n)
@@ -0,0 +1,95 @@
+import os
+import time
+import argparse
+from consumer.consumer import create_offsets_table, file_id, load_checkpoint, save_checkpoint
+from consumer.dead_letters import DeadLetterQueue
+from storage.columnar import COLUMNAR_FILE, FrameError, SegmentFile
+from storage.connection import connect_writer
+from storage.schema import INSERT_EVENT_SQL, migrate
+from utils.logger import get_logger
+
+DB_FILE = "ecommerce.db"
+DEFAULT_CHUNK_EVENTS = 200000  # events per transaction
+
+logger = get_logger(__name__)
+
+
+def load_file(conn, path, chunk_events=DEFAULT_CHUNK_EVENTS):
+    """Load a columnar file into the events table; returns the number of events loaded.
+
+    Frames are read from a memory map and inserted column-wise: each frame's
+    distinct users and products are resolved once, then its rows go to one
+    executemany. The load keeps the same checkpoint as the columnar consumer
+    (the path is the source), so it starts after what is already stored, and
+    a consumer started afterwards continues where the load ended. Rollups are
+    not pushed; the aggregator picks the events up from its high-water marks.
+    """
+    source = str(path)
+    dead_letters = DeadLetterQueue(source)
+    cache = {}  # user and product keys, as in storage.schema.encode_rows
+    loaded = 0
+    with open(path, "rb") as f:
+        segment = SegmentFile(f)
+        segment.refresh()
+        current = file_id(os.fstat(f.fileno()))
+        checkpoint = load_checkpoint(conn, source)
+        offset = 0
+        if checkpoint is not None and checkpoint[0] == current and checkpoint[1] <= segment.size:
+            offset = checkpoint[1]
+        try:
+            while True:
+                frames, events = [], 0
+                while events < chunk_events:
+                    try:
+                        frame = segment.frame(offset)
+                    except FrameError as e:
+                        dead_letters.add(segment.view[offset:e.end].tobytes(), offset, e)
+                        offset = e.end
+                        continue
+                    if frame is None:
+                        break  # End of the file, or a frame still being written
+                    frames.append(frame)
+                    events += frame.count
+                    offset = frame.end
+                if not frames and not len(dead_letters):
+                    return loaded
+                start = time.perf_counter()
+                try:
+                    with conn:
+                        for frame in frames:
+                            conn.executemany(INSERT_EVENT_SQL, frame.rows(conn, cache))
+                        dead_letters.write(conn)
+                        save_checkpoint(conn, (source, current, offset))
+                except Exception:
+                    cache.clear()  # Keys added by the rolled-back transaction are gone
+                    raise
+                dead_letters.committed()
+                loaded += events
+                logger.info(f"Loaded {events} events from {source} up to offset {offset} "
+                            f"in {time.perf_counter() - start:.2f}s")
+        finally:
+            segment.close()
+            dead_letters.log_summary(force=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk load columnar event files into the events table")
+    parser.add_argument("files", nargs="*", default=[COLUMNAR_FILE], help="Columnar files to load (see storage/columnar.py)")
+    parser.add_argument("--chunk-events", type=int, default=DEFAULT_CHUNK_EVENTS, help="Events committed per transaction")
+    args = parser.parse_args()
+
+    conn = connect_writer(DB_FILE)
+    try:
+        migrate(conn)
+        create_offsets_table(conn)
+        for path in args.files:
+            start = time.monotonic()
+            loaded = load_file(conn, path, args.chunk_events)
+            elapsed = time.monotonic() - start
+            logger.info(f"Loaded {loaded} events from {path} in {elapsed:.1f}s "
+                        f"({loaded / elapsed if elapsed else 0:.0f} events/s)")
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    main()
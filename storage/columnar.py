@@ -0,0 +1,320 @@
+import os
+import sys
+import mmap
+import zlib
+import struct
+import argparse
+import itertools
+from array import array
+from storage.schema import event_fields, event_type_code, resolve_keys
+from utils.logger import get_logger
+from utils.schema import DECODERS, Event, get_decoder, parse_event
+
+COLUMNAR_FILE = "events.col"
+MAX_FRAME_EVENTS = 65536  # events per frame written by producers and the converter
+MAX_FRAME_BYTES = 1 << 30  # larger lengths can only come from a corrupt header
+ALIGN = 8  # every section starts on a multiple of this, so columns can be cast in place
+
+FRAME_MAGIC = b"EVC1"
+# magic, body bytes, events, crc32 of the counts and body
+FRAME_HEADER = struct.Struct("<4sIII")
+# timestamp base, dictionary sizes (event types, users, products), raw payloads,
+# typecodes of the timestamp, user and product columns
+BODY_HEADER = struct.Struct("<qIIII3s5x")
+NATIVE_ORDER = sys.byteorder == "little"  # the format is little-endian
+
+logger = get_logger(__name__)
+
+# A columnar file is a sequence of frames, each one self-contained:
+#
+#   header   FRAME_HEADER: magic, body length, event count, crc32
+#   body     BODY_HEADER
+#            string tables: event types, user ids, product ids, product names
+#            columns: ts, price, event_type, user, product
+#            raw payloads: event indexes, then a string table
+#
+# A string table is n + 1 uint32 offsets followed by the UTF-8 bytes of the n
+# strings. The event_type, user and product columns hold indexes into the
+# frame's tables, as uint8, uint16 or uint32 depending on the table size.
+# Timestamps are int64 epoch micros, or uint32 deltas from the frame's base
+# when the frame spans less than about 71 minutes. Prices are float64. Raw
+# payloads are kept only for events with fields beyond the typed columns, as
+# in the events table. Every section is padded to 8 bytes, so readers view
+# the columns of a memory-mapped file in place instead of parsing them.
+
+
+class FrameError(ValueError):
+    """A frame that can't be decoded; ``end`` is where reading resumes."""
+
+    def __init__(self, message, end):
+        super().__init__(message)
+        self.end = end
+
+
+def index_typecode(size):
+    """Narrowest array typecode able to index a table of ``size`` entries."""
+    if size <= 1 << 8:
+        return "B"
+    if size <= 1 << 16:
+        return "H"
+    return "I"
+
+def padded(data):
+    return data + bytes(-len(data) % ALIGN)
+
+def column_bytes(column):
+    if not NATIVE_ORDER:
+        column = array(column.typecode, column)
+        column.byteswap()
+    return padded(column.tobytes())
+
+def string_table(strings):
+    encoded = [s if isinstance(s, bytes) else s.encode() for s in strings]
+    offsets = array("I", itertools.accumulate(map(len, encoded), initial=0))
+    return column_bytes(offsets) + padded(b"".join(encoded))
+
+def checksum(size, count, body):
+    return zlib.crc32(body, zlib.crc32(struct.pack("<II", size, count)))
+
+def write_frame(fd, builder):
+    """Append a frame with a single write, so frames of parallel writers never interleave."""
+    view = memoryview(builder.encode())
+    while view:
+        view = view[os.write(fd, view):]
+
+
+class FrameBuilder:
+    """Collects events column by column and encodes them as one frame."""
+
+    def __init__(self):
+        self.types = {}  # name -> index in the frame's table
+        self.users = {}
+        self.products = {}  # (product_id, product_name) -> index
+        self.type_column = array("I")
+        self.user_column = array("I")
+        self.product_column = array("I")
+        self.price_column = array("d")
+        self.ts_column = array("q")
+        self.raw = []  # (event index, payload) for events with extra fields
+
+    def __len__(self):
+        return len(self.ts_column)
+
+    def add(self, event_type, user_id, product_id, product_name, price, ts, raw=None):
+        if raw is not None:
+            self.raw.append((len(self), raw))
+        self.type_column.append(self.types.setdefault(event_type, len(self.types)))
+        self.user_column.append(self.users.setdefault(user_id, len(self.users)))
+        self.product_column.append(self.products.setdefault((product_id, product_name), len(self.products)))
+        self.price_column.append(price)
+        self.ts_column.append(ts)
+
+    def add_event(self, event):
+        """Add an event as validated by ``utils.schema.parse_event``."""
+        self.add(*event_fields(event))
+
+    def encode(self):
+        """The frame as bytes, ready to be appended with a single write."""
+        count = len(self)
+        ts = self.ts_column
+        base = min(ts) if count else 0
+        if count and max(ts) - base < 1 << 32:
+            ts = array("I", [t - base for t in ts])
+        else:
+            base = 0
+        user_code = index_typecode(len(self.users))
+        product_code = index_typecode(len(self.products))
+        parts = [
+            BODY_HEADER.pack(base, len(self.types), len(self.users), len(self.products), len(self.raw),
+                             f"{ts.typecode}{user_code}{product_code}".encode()),
+            string_table(self.types),
+            string_table(self.users),
+            string_table(product_id for product_id, _ in self.products),
+            string_table(product_name for _, product_name in self.products),
+            column_bytes(ts),
+            column_bytes(self.price_column),
+            column_bytes(array(index_typecode(len(self.types)), self.type_column)),
+            column_bytes(array(user_code, self.user_column)),
+            column_bytes(array(product_code, self.product_column)),
+            column_bytes(array("I", [index for index, _ in self.raw])),
+            string_table(payload for _, payload in self.raw),
+        ]
+        body = b"".join(parts)
+        return FRAME_HEADER.pack(FRAME_MAGIC, len(body), count, checksum(len(body), count, body)) + body
+
+
+class Frame:
+    """One decoded frame; its columns are views of the buffer it was read from, not copies."""
+
+    def __init__(self, view, start, end, count, body):
+        self.start = start
+        self.end = end
+        self.count = count
+        self.pos = body
+        self.view = view
+        self.ts_base, types, users, products, raws, codes = BODY_HEADER.unpack_from(view, body)
+        ts_code, user_code, product_code = codes.decode()
+        self.pos += BODY_HEADER.size
+        self.types = [s.decode() for s in self.strings(types)]
+        self.users = [s.decode() for s in self.strings(users)]
+        product_ids = [s.decode() for s in self.strings(products)]
+        self.products = list(zip(product_ids, [s.decode() for s in self.strings(products)]))
+        self.ts_column = self.column(ts_code, count)
+        self.price_column = self.column("d", count)
+        self.type_column = self.column(index_typecode(types), count)
+        self.user_column = self.column(user_code, count)
+        self.product_column = self.column(product_code, count)
+        self.raw = dict(zip(self.column("I", raws), self.strings(raws)))
+        del self.view
+
+    def column(self, typecode, count):
+        size = array(typecode).itemsize * count
+        column = self.view[self.pos:self.pos + size].cast(typecode)
+        if not NATIVE_ORDER:
+            swapped = array(typecode)
+            swapped.frombytes(column)
+            swapped.byteswap()
+            column = swapped
+        self.pos += size + -size % ALIGN
+        return column
+
+    def strings(self, count):
+        offsets = self.column("I", count + 1)
+        blob = self.view[self.pos:self.pos + offsets[count]].tobytes()
+        self.pos += offsets[count] + -offsets[count] % ALIGN
+        return [blob[offsets[i]:offsets[i + 1]] for i in range(count)]
+
+    def timestamps(self):
+        return map(self.ts_base.__add__, self.ts_column) if self.ts_base else self.ts_column
+
+    def events(self):
+        """The frame's events as ``Event`` dicts, like parse_event returns but with ``ts`` only, no ISO timestamp."""
+        events = []
+        columns = zip(self.type_column, self.user_column, self.product_column, self.price_column, self.timestamps())
+        for event_type, user, product, price, ts in columns:
+            product_id, product_name = self.products[product]
+            event = Event(event_type=self.types[event_type], user_id=self.users[user], product_id=product_id,
+                          product_name=product_name, price=price, ts=ts)
+            events.append(event)
+        loads = get_decoder()
+        for index, payload in self.raw.items():
+            # Extra fields come back from the payload, which is then stored as-is like a parsed line
+            event = events[index] = Event(loads(payload), **events[index])
+            event.line = payload
+        return events
+
+    def rows(self, conn, cache=None):
+        """The frame as INSERT_EVENT_SQL rows, resolving each distinct user and product once.
+
+        ``cache`` works as in ``storage.schema.encode_rows``.
+        """
+        users, products = resolve_keys(conn, self.users, self.products, cache)
+        type_keys = [event_type_code(conn, name) for name in self.types]
+        user_keys = [users[(user_id,)] for user_id in self.users]
+        product_keys = [products[product] for product in self.products]
+        raw = [None] * self.count
+        for index, payload in self.raw.items():
+            raw[index] = payload.decode()
+        return zip(map(type_keys.__getitem__, self.type_column), map(user_keys.__getitem__, self.user_column),
+                   map(product_keys.__getitem__, self.product_column), self.price_column, self.timestamps(), raw)
+
+
+def read_frame(data, offset, view=None):
+    """The frame at ``offset`` of ``data`` (bytes or an mmap), or None if it isn't complete yet.
+
+    Raises FrameError for a corrupt frame; its ``end`` is the offset of the
+    next frame, or of the next candidate when the framing itself is damaged.
+    """
+    view = memoryview(data) if view is None else view
+    if len(data) - offset < FRAME_HEADER.size:
+        return None
+    magic, size, count, crc = FRAME_HEADER.unpack_from(view, offset)
+    if magic != FRAME_MAGIC or size > MAX_FRAME_BYTES:
+        following = data.find(FRAME_MAGIC, offset + 1)
+        # Without a following frame, keep the last bytes: they may start one being written
+        end = following if following != -1 else max(offset + 1, len(data) - len(FRAME_MAGIC) + 1)
+        raise FrameError(f"no frame at offset {offset}", end)
+    body = offset + FRAME_HEADER.size
+    end = body + size
+    if len(data) < end:
+        return None
+    if checksum(size, count, view[body:end]) != crc:
+        raise FrameError(f"checksum mismatch in the frame at offset {offset}", end)
+    return Frame(view, offset, end, count, body)
+
+
+class SegmentFile:
+    """A memory map of a columnar file that follows the file as it grows."""
+
+    def __init__(self, f):
+        self.f = f
+        self.data = b""
+        self.view = memoryview(self.data)
+
+    @property
+    def size(self):
+        return len(self.data)
+
+    def refresh(self):
+        """Map the file again if it changed size; frames already read keep the old map alive."""
+        size = os.fstat(self.f.fileno()).st_size
+        if size != len(self.data):
+            self.data = mmap.mmap(self.f.fileno(), size, access=mmap.ACCESS_READ) if size else b""
+            self.view = memoryview(self.data)
+
+    def frame(self, offset):
+        return read_frame(self.data, offset, self.view)
+
+    def close(self):
+        # The map is unmapped once the last frame viewing it is gone
+        self.data = b""
+        self.view = memoryview(self.data)
+
+
+def convert(input_file, output_file=COLUMNAR_FILE, frame_events=MAX_FRAME_EVENTS, decoder=None):
+    """Append the valid events of a JSON lines file to a columnar file; returns (converted, rejected)."""
+    loads = get_decoder(decoder)
+    converted = rejected = 0
+    fd = os.open(output_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        with open(input_file, "rb") as f:
+            builder = FrameBuilder()
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    builder.add_event(parse_event(line, loads))
+                except ValueError:
+                    rejected += 1
+                    continue
+                if len(builder) >= frame_events:
+                    write_frame(fd, builder)
+                    converted += len(builder)
+                    builder = FrameBuilder()
+            if len(builder):
+                write_frame(fd, builder)
+                converted += len(builder)
+    finally:
+        os.close(fd)
+    return converted, rejected
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a JSON lines events file into the columnar event format")
+    parser.add_argument("input", help="JSON lines file to convert, e.g. events.jsonl")
+    parser.add_argument("-o", "--output", default=COLUMNAR_FILE, help="Columnar file to append the events to")
+    parser.add_argument("--frame-events", type=int, default=MAX_FRAME_EVENTS, help="Events per frame")
+    parser.add_argument("--decoder", choices=sorted(DECODERS), help="JSON decoder for event lines (default: fastest available, or $EVENT_DECODER)")
+    args = parser.parse_args()
+
+    before = os.path.getsize(args.output) if os.path.exists(args.output) else 0
+    converted, rejected = convert(args.input, args.output, args.frame_events, args.decoder)
+    written = os.path.getsize(args.output) - before
+    size = os.path.getsize(args.input)
+    logger.info(f"Converted {converted} events from {args.input} ({size} bytes) to {args.output} ({written} bytes, "
+                f"{written / converted if converted else 0:.1f} bytes per event, {size / written if written else 0:.1f}x smaller)")
+    if rejected:
+        logger.warning(f"Skipped {rejected} lines that are not valid events; the consumer dead-letters them from the JSON file")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import time
+import sqlite3
+import threading
+from utils.logger import get_logger
+from utils.metrics import gauge, histogram
+
+DB_FILE = "ecommerce.db"
+BUSY_TIMEOUT = 10  # seconds a connection waits for a lock before "database is locked"
+CHECKPOINT_INTERVAL = 30  # seconds between background WAL checkpoints
+# Backstop if no checkpointer runs: the writer that commits past this many
+# pages checkpoints inline (SQLite's default is 1000)
+WAL_AUTOCHECKPOINT_PAGES = 10000
+
+logger = get_logger(__name__)
+
+CHECKPOINT_SECONDS = histogram("sqlite_checkpoint_seconds", "Time spent in WAL checkpoints", ["mode"])
+WAL_PAGES = gauge("sqlite_wal_pages", "Pages in the WAL at the last checkpoint")
+CHECKPOINTED_PAGES = gauge("sqlite_wal_checkpointed_pages", "WAL pages copied into the database at the last checkpoint")
+
+# The profile every connection gets, the dashboard's included (see init_command)
+PRAGMAS = {
+    "busy_timeout": BUSY_TIMEOUT * 1000,
+    # Safe with WAL: a power cut can lose the last commits, never corrupt the file.
+    # The consumer's offset commits with its batch, so lost batches are read again.
+    "synchronous": "NORMAL",
+    "cache_size": -64000,  # negative means KiB: 64 MB of page cache per connection
+    "mmap_size": 256 * 1024 * 1024,  # read pages through the OS page cache instead of copying them
+    "temp_store": "MEMORY",  # sorts and temp indexes for GROUP BY stay off disk
+}
+WRITER_PRAGMAS = {
+    "journal_mode": "WAL",  # persistent in the file; readers never block the writer
+    "wal_autocheckpoint": WAL_AUTOCHECKPOINT_PAGES,
+}
+READER_PRAGMAS = {
+    "query_only": "ON",
+}
+
+
+def apply_pragmas(conn, pragmas):
+    for name, value in pragmas.items():
+        conn.execute(f"PRAGMA {name}={value}")
+
+def connect_writer(db_file=DB_FILE, **kwargs):
+    """A connection for a component that writes: WAL plus the shared profile.
+
+    ``kwargs`` go to ``sqlite3.connect``, e.g. ``check_same_thread=False``.
+    Long-running writers should also ``start_checkpointer``.
+    """
+    conn = sqlite3.connect(db_file, timeout=BUSY_TIMEOUT, **kwargs)
+    apply_pragmas(conn, WRITER_PRAGMAS)
+    apply_pragmas(conn, PRAGMAS)
+    return conn
+
+def connect_reader(db_file=DB_FILE, **kwargs):
+    """A connection that can only read, with the shared profile; writes raise sqlite3.OperationalError."""
+    conn = sqlite3.connect(db_file, timeout=BUSY_TIMEOUT, **kwargs)
+    apply_pragmas(conn, PRAGMAS)
+    apply_pragmas(conn, READER_PRAGMAS)
+    return conn
+
+def init_command():
+    """The shared profile as one statement, for Django's sqlite ``OPTIONS["init_command"]``."""
+    return ";".join(f"PRAGMA {name}={value}" for name, value in PRAGMAS.items())
+
+
+def checkpoint(conn, mode="PASSIVE"):
+    """Copy WAL pages into the database; returns SQLite's ``(busy, wal pages, checkpointed pages)``.
+
+    PASSIVE never waits for readers or writers; TRUNCATE waits (up to the
+    busy timeout) and then empties the WAL file.
+    """
+    with CHECKPOINT_SECONDS.labels(mode).time():
+        busy, log, checkpointed = conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+    WAL_PAGES.set(log)
+    CHECKPOINTED_PAGES.set(checkpointed)
+    return busy, log, checkpointed
+
+def start_checkpointer(db_file=DB_FILE, interval=CHECKPOINT_INTERVAL):
+    """Checkpoint the WAL every ``interval`` seconds from a daemon thread with its own connection.
+
+    Commits then rarely pay for a checkpoint themselves, and the WAL stays
+    small even while readers keep the dashboard busy. Several processes may
+    run one; PASSIVE checkpoints just skip pages another one is copying.
+    """
+    def run():
+        conn = connect_writer(db_file)
+        try:
+            while True:
+                time.sleep(interval)
+                try:
+                    busy, log, checkpointed = checkpoint(conn)
+                except sqlite3.Error as e:
+                    logger.warning(f"WAL checkpoint failed: {e}")
+                    continue
+                if log > WAL_AUTOCHECKPOINT_PAGES:
+                    logger.warning(f"WAL is {log} pages; only {checkpointed} could be checkpointed past open readers")
+        finally:
+            conn.close()
+
+    thread = threading.Thread(target=run, name="wal-checkpoint", daemon=True)
+    thread.start()
+    return thread
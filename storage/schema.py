@@ -0,0 +1,445 @@
+import json
+import time
+import argparse
+from datetime import datetime, timedelta, timezone
+from storage.connection import connect_writer
+from utils.logger import get_logger
+
+DB_FILE = "ecommerce.db"
+
+logger = get_logger(__name__)
+
+# Fixed codes for the event types the generator produces. Other names get the
+# next free code the first time they are seen (see event_type_code).
+EVENT_TYPE_CODES = {
+    "user_signup": 1,
+    "product_view": 2,
+    "add_to_cart": 3,
+    "purchase": 4,
+}
+PURCHASE_TYPE = "purchase"
+PURCHASE = EVENT_TYPE_CODES[PURCHASE_TYPE]
+
+# Fields stored in typed columns; raw is only needed for anything beyond these
+EVENT_FIELDS = {"event_type", "user_id", "product_id", "product_name", "price", "timestamp"}
+EPOCH = datetime(1970, 1, 1)
+MAX_LOOKUP_PARAMS = 500  # values per IN (...) when resolving dictionary keys
+# Dictionary entry the migrations give rows stored with a NULL event type, user or product
+UNKNOWN = "unknown"
+
+
+def iso_to_micros(timestamp):
+    """Convert an ISO-8601 timestamp (naive means UTC) to integer epoch microseconds."""
+    return datetime_to_micros(datetime.fromisoformat(timestamp))
+
+def datetime_to_micros(dt):
+    """Convert a datetime (naive means UTC) to integer epoch microseconds."""
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    # Integer arithmetic on the timedelta is several times faster than dividing timedeltas
+    delta = dt - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+def micros_to_iso(micros):
+    """Inverse of iso_to_micros, in the naive UTC format the event generator writes."""
+    return (EPOCH + timedelta(microseconds=micros)).isoformat()
+
+def try_iso_to_micros(timestamp):
+    """iso_to_micros, or None for a missing or unparseable timestamp."""
+    try:
+        return iso_to_micros(timestamp)
+    except (TypeError, ValueError):
+        return None
+
+def compact_raw(raw):
+    """Keep a raw JSON payload only if it carries fields the typed columns don't."""
+    try:
+        return raw if set(json.loads(raw)) - EVENT_FIELDS else None
+    except (TypeError, ValueError):
+        return raw
+
+
+def _create_events_table(conn):
+    """Create the original events table."""
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        event_type TEXT,
+        user_id TEXT,
+        product_id TEXT,
+        product_name TEXT,
+        price REAL,
+        timestamp TEXT,
+        raw TEXT
+    )
+    """)
+
+def _encode_event_types(conn):
+    """Store events.event_type as a small integer code into event_types."""
+    conn.execute("""
+    CREATE TABLE event_types (
+        code INTEGER PRIMARY KEY,
+        name TEXT UNIQUE NOT NULL
+    )
+    """)
+    conn.executemany("INSERT INTO event_types (code, name) VALUES (?, ?)",
+                     [(code, name) for name, code in EVENT_TYPE_CODES.items()])
+    conn.execute("""
+    INSERT OR IGNORE INTO event_types (name)
+    SELECT DISTINCT COALESCE(event_type, ?) FROM events
+    """, (UNKNOWN,))
+    conn.execute("""
+    CREATE TABLE events_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        event_type INTEGER NOT NULL REFERENCES event_types(code),
+        user_id TEXT,
+        product_id TEXT,
+        product_name TEXT,
+        price REAL,
+        timestamp TEXT,
+        raw TEXT
+    )
+    """)
+    # Rows without an event type are kept under the UNKNOWN type rather than dropped
+    carried = conn.execute("""
+    INSERT INTO events_new (id, event_type, user_id, product_id, product_name, price, timestamp, raw)
+    SELECT e.id, t.code, e.user_id, e.product_id, e.product_name, e.price, e.timestamp, e.raw
+    FROM events e
+    JOIN event_types t ON t.name = COALESCE(e.event_type, ?)
+    """, (UNKNOWN,)).rowcount
+    untyped = conn.execute("SELECT COUNT(*) FROM events WHERE event_type IS NULL").fetchone()[0]
+    logger.info(f"Carried over {carried} events, {untyped} of them without an event type (stored as {UNKNOWN!r})")
+    conn.execute("DROP TABLE events")
+    conn.execute("ALTER TABLE events_new RENAME TO events")
+
+def _create_aggregator_indexes(conn):
+    """Index events for the aggregator queries."""
+    # Rowid order within each type: the "last N purchases" scans walk it backwards without sorting
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_events_type ON events (event_type)")
+    # Covers per-product purchase totals without touching the table
+    conn.execute("""
+    CREATE INDEX IF NOT EXISTS idx_events_type_product
+    ON events (event_type, product_id, product_name, price)
+    """)
+
+def _compact_events(conn):
+    """Dictionary-encode users and products, store epoch micros and drop redundant raw payloads."""
+    from utils.schema import BAD_TIMESTAMP
+    conn.create_function("try_iso_to_micros", 1, try_iso_to_micros, deterministic=True)
+    conn.create_function("compact_raw", 1, compact_raw, deterministic=True)
+    conn.execute("""
+    CREATE TABLE users (
+        id INTEGER PRIMARY KEY,
+        user_id TEXT UNIQUE NOT NULL
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE products (
+        id INTEGER PRIMARY KEY,
+        product_id TEXT NOT NULL,
+        product_name TEXT NOT NULL,
+        UNIQUE(product_id, product_name)
+    )
+    """)
+    # NULL users and products get the UNKNOWN entry, so every row has its keys
+    conn.execute("INSERT INTO users (user_id) SELECT DISTINCT COALESCE(user_id, ?) FROM events", (UNKNOWN,))
+    conn.execute("""
+    INSERT INTO products (product_id, product_name)
+    SELECT DISTINCT COALESCE(product_id, ?), COALESCE(product_name, ?) FROM events
+    """, (UNKNOWN, UNKNOWN))
+    conn.execute("""
+    CREATE TABLE events_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        event_type INTEGER NOT NULL REFERENCES event_types(code),
+        user_key INTEGER NOT NULL REFERENCES users(id),
+        product_key INTEGER NOT NULL REFERENCES products(id),
+        price REAL,
+        ts INTEGER NOT NULL,
+        raw TEXT
+    )
+    """)
+    carried = conn.execute("""
+    INSERT INTO events_new (id, event_type, user_key, product_key, price, ts, raw)
+    SELECT e.id, e.event_type, u.id, p.id, e.price, try_iso_to_micros(e.timestamp), compact_raw(e.raw)
+    FROM events e
+    JOIN users u ON u.user_id = COALESCE(e.user_id, ?1)
+    JOIN products p ON p.product_id = COALESCE(e.product_id, ?1) AND p.product_name = COALESCE(e.product_name, ?1)
+    WHERE try_iso_to_micros(e.timestamp) IS NOT NULL
+    """, (UNKNOWN,)).rowcount
+    # An event can't be placed in time without its timestamp: keep it as a dead letter instead
+    skipped = conn.execute("""
+    SELECT
+        e.id,
+        e.timestamp,
+        COALESCE(e.raw, json_object(
+            'event_type', t.name, 'user_id', e.user_id, 'product_id', e.product_id,
+            'product_name', e.product_name, 'price', e.price, 'timestamp', e.timestamp
+        ))
+    FROM events e
+    JOIN event_types t ON t.code = e.event_type
+    WHERE try_iso_to_micros(e.timestamp) IS NULL
+    """).fetchall()
+    if skipped:
+        _create_dead_letters(conn)
+        received_at = time.time_ns() // 1000
+        conn.executemany("""
+        INSERT INTO dead_letters (source, byte_offset, reason, detail, line, received_at)
+        VALUES ('events', NULL, ?, ?, ?, ?)
+        """, [(BAD_TIMESTAMP, f"events row {event_id} has unparseable timestamp {timestamp!r}", line, received_at)
+              for event_id, timestamp, line in skipped])
+    placeholders = conn.execute(
+        "SELECT COUNT(*) FROM events WHERE user_id IS NULL OR product_id IS NULL OR product_name IS NULL"
+    ).fetchone()[0]
+    logger.info(f"Carried over {carried} events ({placeholders} with a NULL user or product, stored as {UNKNOWN!r}); "
+                f"moved {len(skipped)} with unparseable timestamps to dead_letters")
+    conn.execute("DROP TABLE events")
+    conn.execute("ALTER TABLE events_new RENAME TO events")
+    conn.execute("CREATE INDEX idx_events_type ON events (event_type)")
+    conn.execute("CREATE INDEX idx_events_type_product ON events (event_type, product_key, price)")
+    # The pre-compaction row shape, for ad-hoc queries and tools that want it
+    conn.execute("""
+    CREATE VIEW events_expanded AS
+    SELECT
+        events.id,
+        event_types.name AS event_type,
+        users.user_id,
+        products.product_id,
+        products.product_name,
+        events.price,
+        strftime('%Y-%m-%dT%H:%M:%S', events.ts / 1000000, 'unixepoch')
+            || printf('.%06d', events.ts % 1000000) AS timestamp,
+        events.raw
+    FROM events
+    JOIN event_types ON event_types.code = events.event_type
+    JOIN users ON users.id = events.user_key
+    JOIN products ON products.id = events.product_key
+    """)
+
+def _create_partition_catalog(conn):
+    """Track per-day event partitions and the daily rollups they are compacted into."""
+    conn.execute("""
+    CREATE TABLE event_partitions (
+        name TEXT PRIMARY KEY,
+        day TEXT UNIQUE NOT NULL,
+        min_ts INTEGER,
+        max_ts INTEGER,
+        max_id INTEGER,
+        row_count INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE daily_rollups (
+        day TEXT NOT NULL,
+        event_type INTEGER NOT NULL REFERENCES event_types(code),
+        product_key INTEGER NOT NULL REFERENCES products(id),
+        events INTEGER NOT NULL,
+        revenue REAL NOT NULL,
+        PRIMARY KEY (day, event_type, product_key)
+    )
+    """)
+
+def _create_dead_letters(conn):
+    """Keep lines the consumer could not store, with the reason, for re-driving."""
+    # Already there if _compact_events had rows to dead-letter
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS dead_letters (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        source TEXT NOT NULL,
+        byte_offset INTEGER,
+        reason TEXT NOT NULL,
+        detail TEXT,
+        line BLOB NOT NULL,
+        received_at INTEGER NOT NULL
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_dead_letters_reason ON dead_letters(reason)")
+
+def _version_rollups(conn):
+    """Count commits to each rollup so readers can tell whether it changed."""
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS aggregation_state (
+        name TEXT PRIMARY KEY,
+        last_event_id INTEGER,
+        updated_at TEXT
+    )
+    """)
+    # rollups.create_aggregation_state_table already includes it in tables it creates
+    if "version" not in {row[1] for row in conn.execute("PRAGMA table_info(aggregation_state)")}:
+        conn.execute("ALTER TABLE aggregation_state ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+
+# Applied in order; PRAGMA user_version records how many have run
+MIGRATIONS = [
+    _create_events_table,
+    _encode_event_types,
+    _create_aggregator_indexes,
+    _compact_events,
+    _create_partition_catalog,
+    _create_dead_letters,
+    _version_rollups,
+]
+
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(conn, target=None):
+    """Bring the database schema up to date; safe to call from every component.
+
+    ``target`` stops at an older version, which is only useful for testing
+    migrations and for measuring older layouts.
+    """
+    target = len(MIGRATIONS) if target is None else target
+    if schema_version(conn) >= target:
+        return
+    # IMMEDIATE takes the write lock up front so concurrent starters run each migration once
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        version = schema_version(conn)
+        for number, migration in enumerate(MIGRATIONS[version:target], start=version + 1):
+            logger.info(f"Applying schema migration {number}: {migration.__doc__ or migration.__name__}")
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {number}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def event_type_code(conn, name):
+    """Return the code for an event type name, registering unknown names."""
+    code = EVENT_TYPE_CODES.get(name)
+    if code is None:
+        conn.execute("INSERT OR IGNORE INTO event_types (name) VALUES (?)", (name,))
+        code = conn.execute("SELECT code FROM event_types WHERE name = ?", (name,)).fetchone()[0]
+    return code
+
+def lookup_keys(conn, table, columns, values):
+    """Map each tuple in ``values`` to its key in a dictionary table, adding missing ones."""
+    where = " AND ".join(f"{column} = ?" for column in columns)
+    keys = {}
+    values = list(values)
+    first = columns[0]
+    for start in range(0, len(values), MAX_LOOKUP_PARAMS):
+        chunk = values[start:start + MAX_LOOKUP_PARAMS]
+        placeholders = ", ".join("?" * len(chunk))
+        wanted = set(chunk)
+        for key, *found in conn.execute(
+            f"SELECT id, {', '.join(columns)} FROM {table} WHERE {first} IN ({placeholders})",
+            [value[0] for value in chunk],
+        ):
+            if tuple(found) in wanted:
+                keys[tuple(found)] = key
+    missing = [value for value in values if value not in keys]
+    if missing:
+        conn.executemany(
+            f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})", missing
+        )
+        for value in missing:
+            keys[value] = conn.execute(f"SELECT id FROM {table} WHERE {where}", value).fetchone()[0]
+    return keys
+
+def event_fields(event, store_raw=False):
+    """The columns of one event that need no database lookup.
+
+    Returns ``(event_type, user_id, product_id, product_name, price, ts, raw)``
+    with the ids as text; ``encode_rows`` turns them into an events row. This
+    half of the encoding is pure, so it can run in worker processes.
+    """
+    ts = event["ts"] if "ts" in event else iso_to_micros(event["timestamp"])
+    raw = None
+    if store_raw or set(event) - EVENT_FIELDS - {"ts"}:
+        # Events parsed by utils.schema keep the line they came from; store it as-is
+        line = getattr(event, "line", None)
+        if line is not None:
+            raw = line.decode().rstrip("\r\n")
+        else:
+            raw = json.dumps({key: value for key, value in event.items() if key != "ts"})
+    # Keys are compared as text, matching the TEXT columns they were stored in
+    return (event["event_type"], str(event["user_id"]), str(event["product_id"]), str(event["product_name"]),
+            event["price"], ts, raw)
+
+def resolve_keys(conn, user_ids, products, cache=None):
+    """Key maps covering ``user_ids`` and ``(product_id, product_name)`` pairs, adding unseen ones.
+
+    Returns ``(users, products)`` dicts keyed by ``(user_id,)`` and by the
+    product pair. ``cache`` works as in ``encode_rows``.
+    """
+    cache = {} if cache is None else cache
+    user_cache = cache.setdefault("users", {})
+    product_cache = cache.setdefault("products", {})
+    user_cache.update(lookup_keys(conn, "users", ("user_id",),
+                                  {(user_id,) for user_id in user_ids if (user_id,) not in user_cache}))
+    product_cache.update(lookup_keys(conn, "products", ("product_id", "product_name"),
+                                     {product for product in products if product not in product_cache}))
+    return user_cache, product_cache
+
+def encode_rows(conn, fields, cache=None):
+    """Turn ``event_fields`` tuples into rows for INSERT_EVENT_SQL, adding unseen users and products.
+
+    ``cache`` is an optional dict that keeps looked-up keys between calls. The
+    caller must clear it when a transaction that added keys is rolled back.
+    """
+    user_cache, product_cache = resolve_keys(conn, (f[1] for f in fields), ((f[2], f[3]) for f in fields), cache)
+    return [
+        (event_type_code(conn, event_type), user_cache[(user_id,)], product_cache[(product_id, product_name)], price, ts, raw)
+        for event_type, user_id, product_id, product_name, price, ts, raw in fields
+    ]
+
+def encode_events(conn, events, store_raw=False):
+    """Build compact events rows, adding unseen users and products to their lookup tables.
+
+    Each event gets an integer ``ts`` (epoch micros) if it doesn't have one.
+    ``raw`` is only kept for events with fields beyond the typed columns,
+    unless ``store_raw`` asks for every payload. Rows match INSERT_EVENT_SQL.
+    """
+    for event in events:
+        if "ts" not in event:
+            event["ts"] = iso_to_micros(event["timestamp"])
+    return encode_rows(conn, [event_fields(event, store_raw) for event in events])
+
+INSERT_EVENT_SQL = """
+    INSERT INTO events (event_type, user_key, product_key, price, ts, raw)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+
+def aggregator_queries():
+    """The recurring queries aggregators run against events, as (name, sql, params)."""
+    from rollups import READ_EVENTS_SQL
+    from track_top_users import RECENT_PURCHASES_SQL
+    from transform_events import VERIFY_AGGREGATES_SQL
+    return [
+        ("rollups.read_events", READ_EVENTS_SQL, (0, 1, 1)),
+        ("track_top_users.recent_purchases", RECENT_PURCHASES_SQL.format(table="events"), (PURCHASE, 1, 1)),
+        ("transform_events.verify_aggregates", VERIFY_AGGREGATES_SQL, (1, PURCHASE)),
+    ]
+
+def check_query_plans(conn):
+    """Return the aggregator queries whose plan contains a full scan of events."""
+    regressions = []
+    for name, sql, params in aggregator_queries():
+        plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+        scans = [detail for detail in plan if detail.startswith("SCAN events")]
+        if scans:
+            regressions.append((name, scans))
+            logger.error(f"{name} does a full scan: {'; '.join(scans)}")
+        else:
+            logger.info(f"{name}: {'; '.join(plan)}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate the events schema and check aggregator query plans")
+    parser.add_argument("--check-plans", action="store_true", help="Fail if any aggregator query plan scans the whole events table")
+    args = parser.parse_args()
+
+    conn = connect_writer(DB_FILE)
+    try:
+        migrate(conn)
+        logger.info(f"Schema is at version {schema_version(conn)}")
+        if args.check_plans and check_query_plans(conn):
+            raise SystemExit(1)
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,314 @@
+import sqlite3
+import argparse
+from datetime import date, datetime, timedelta
+from storage.connection import checkpoint, connect_writer
+from storage.schema import EPOCH, iso_to_micros, micros_to_iso, migrate
+from utils.logger import get_logger
+from utils.metrics import histogram
+
+DB_FILE = "ecommerce.db"
+DEFAULT_RETENTION_DAYS = 30
+PARTITION_PREFIX = "events_p"
+CHUNK_SIZE = 50000  # rows per read when replaying partitions
+MICROS_PER_DAY = 86400 * 10 ** 6
+
+# Columns shared by the hot events table and its partitions
+EVENT_COLUMNS = "id, event_type, user_key, product_key, price, ts, raw"
+
+# Event rows the way rollups see them; {table} is the hot table or a partition.
+# CROSS JOIN pins the event table as the outer loop so lookups stay primary-key searches.
+SELECT_EVENTS_SQL = """
+SELECT
+    {table}.id,
+    event_types.name AS event_type,
+    users.user_id,
+    products.product_id,
+    products.product_name,
+    {table}.price,
+    {table}.ts
+FROM {table}
+CROSS JOIN event_types ON event_types.code = {table}.event_type
+CROSS JOIN users ON users.id = {table}.user_key
+CROSS JOIN products ON products.id = {table}.product_key
+"""
+
+# Unbounded ends of a time range, in epoch micros
+MIN_TS = -(2 ** 62)
+MAX_TS = 2 ** 62
+
+logger = get_logger(__name__)
+
+MAINTENANCE_SECONDS = histogram("maintenance_seconds", "Time to archive and compact partitions")
+
+# The events table is the hot partition: the consumer appends to it and the
+# incremental aggregators read it by id. Once every rollup has folded an event
+# and its day (UTC, by event timestamp) is over, archive_events moves it into a
+# per-day table events_pYYYYMMDD listed in event_partitions. Partitions past the
+# retention period are compacted into daily_rollups (counts and revenue per
+# day, event type and product) and dropped, so the database stops growing with
+# history. Readers that need history (rebuilds, verification, reports over a
+# time range) go through the functions below, which prune partitions by range.
+
+
+def partition_name(day):
+    return f"{PARTITION_PREFIX}{day:%Y%m%d}"
+
+def day_bounds(day):
+    """Epoch-micros range [start, end) covering one UTC day."""
+    return iso_to_micros(day.isoformat()), iso_to_micros((day + timedelta(days=1)).isoformat())
+
+def day_of(ts):
+    return date.fromisoformat(micros_to_iso(ts)[:10])
+
+def aggregated_up_to(conn):
+    """Highest event id that every registered rollup has folded; later events must stay hot.
+
+    Marks left behind by rollups that are no longer registered don't hold
+    archiving back. Such a rollup is rebuilt if it comes back (see
+    ``archived_after``).
+    """
+    if conn.execute("SELECT 1 FROM sqlite_schema WHERE name = 'aggregation_state'").fetchone() is None:
+        return 0
+    from rollups import registered_rollups  # rollups imports this module
+    names = registered_rollups()
+    return conn.execute(
+        f"SELECT MIN(last_event_id) FROM aggregation_state WHERE name IN ({', '.join('?' * len(names))})", names
+    ).fetchone()[0] or 0
+
+def archived_after(conn, event_id):
+    """Whether events with ids above ``event_id`` have left the hot table.
+
+    Ids are handed out in order, so any id up to the newest that the events
+    table doesn't hold was archived (or was never stored, which only costs a
+    needless rebuild).
+    """
+    hot = conn.execute("SELECT COUNT(*) FROM events WHERE id > ?", (event_id,)).fetchone()[0]
+    return hot < last_event_id(conn) - event_id
+
+def create_partition(conn, day):
+    name = partition_name(day)
+    conn.execute(f"""
+    CREATE TABLE IF NOT EXISTS {name} (
+        id INTEGER PRIMARY KEY,
+        event_type INTEGER NOT NULL,
+        user_key INTEGER NOT NULL,
+        product_key INTEGER NOT NULL,
+        price REAL,
+        ts INTEGER NOT NULL,
+        raw TEXT
+    )
+    """)
+    conn.execute("INSERT OR IGNORE INTO event_partitions (name, day) VALUES (?, ?)", (name, day.isoformat()))
+    return name
+
+def archive_events(conn, before=None):
+    """Move aggregated events from days before ``before`` (default: today, UTC) into partitions."""
+    before = before or datetime.utcnow().date()
+    up_to_id = aggregated_up_to(conn)
+    cutoff = iso_to_micros(before.isoformat())
+    # ts has no index; one pass finds every day to archive and the id range it spans,
+    # so moving a day only reads that range. The day is floor(ts / MICROS_PER_DAY).
+    days = conn.execute(f"""
+    SELECT ts / {MICROS_PER_DAY} - (ts % {MICROS_PER_DAY} < 0) AS day, MIN(id), MAX(id)
+    FROM events
+    WHERE id <= ? AND ts < ?
+    GROUP BY day
+    ORDER BY day
+    """, (up_to_id, cutoff)).fetchall()
+    moved = 0
+    for day_number, first_id, last_id in days:
+        day = EPOCH.date() + timedelta(days=day_number)
+        start, end = day_bounds(day)
+        with conn:
+            name = create_partition(conn, day)
+            count = conn.execute(f"""
+            INSERT INTO {name} ({EVENT_COLUMNS})
+            SELECT {EVENT_COLUMNS} FROM events WHERE id >= ? AND id <= ? AND ts >= ? AND ts < ?
+            """, (first_id, last_id, start, end)).rowcount
+            conn.execute(
+                "DELETE FROM events WHERE id >= ? AND id <= ? AND ts >= ? AND ts < ?", (first_id, last_id, start, end)
+            )
+            conn.execute(f"""
+            UPDATE event_partitions
+            SET (min_ts, max_ts, max_id, row_count) = (SELECT MIN(ts), MAX(ts), MAX(id), COUNT(*) FROM {name})
+            WHERE name = ?
+            """, (name,))
+        logger.info(f"Archived {count} events from {day} into {name}")
+        moved += count
+    return moved
+
+def compact_partitions(conn, retention_days=DEFAULT_RETENTION_DAYS, today=None):
+    """Fold partitions older than ``retention_days`` into daily_rollups and drop them."""
+    today = today or datetime.utcnow().date()
+    cutoff = (today - timedelta(days=retention_days)).isoformat()
+    expired = conn.execute(
+        "SELECT name, day FROM event_partitions WHERE day < ? ORDER BY day", (cutoff,)
+    ).fetchall()
+    for name, day in expired:
+        with conn:
+            conn.execute(f"""
+            INSERT INTO daily_rollups (day, event_type, product_key, events, revenue)
+            SELECT ?, event_type, product_key, COUNT(*), TOTAL(price)
+            FROM {name}
+            WHERE true
+            GROUP BY event_type, product_key
+            ON CONFLICT(day, event_type, product_key) DO UPDATE SET
+                events=events + excluded.events,
+                revenue=revenue + excluded.revenue
+            """, (day,))
+            conn.execute(f"DROP TABLE {name}")
+            conn.execute("DELETE FROM event_partitions WHERE name = ?", (name,))
+        logger.info(f"Compacted partition {name} into daily rollups")
+    return len(expired)
+
+def run_maintenance(conn, retention_days=DEFAULT_RETENTION_DAYS):
+    """Archive finished days and, unless ``retention_days`` is None, compact expired ones."""
+    with MAINTENANCE_SECONDS.time():
+        moved = archive_events(conn)
+        compacted = compact_partitions(conn, retention_days) if retention_days is not None else 0
+    return moved, compacted
+
+
+def event_partitions(conn, start_ts=None, end_ts=None):
+    """Partitions that may hold events with ``start_ts <= ts < end_ts``, oldest first."""
+    return [name for name, in conn.execute("""
+    SELECT name FROM event_partitions
+    WHERE max_ts >= ? AND min_ts < ?
+    ORDER BY day
+    """, (MIN_TS if start_ts is None else start_ts, MAX_TS if end_ts is None else end_ts))]
+
+def event_tables(conn, start_ts=None, end_ts=None):
+    """Every table holding raw events in the range: the pruned partitions, then the hot table."""
+    return event_partitions(conn, start_ts, end_ts) + ["events"]
+
+def iter_archived_events(conn, chunk_size=CHUNK_SIZE):
+    """Yield chunks of partitioned events, shaped like rollups.READ_EVENTS_SQL rows."""
+    cur = conn.cursor()
+    cur.row_factory = sqlite3.Row
+    for name in event_partitions(conn):
+        last_id = 0
+        while True:
+            cur.execute(SELECT_EVENTS_SQL.format(table=name) + f"""
+            WHERE {name}.id > ?
+            ORDER BY {name}.id
+            LIMIT ?
+            """, (last_id, chunk_size))
+            events = cur.fetchall()
+            if not events:
+                break
+            yield events
+            last_id = events[-1]["id"]
+
+def iter_daily_rollups(conn):
+    """Yield compacted daily totals with event type and product names resolved."""
+    cur = conn.cursor()
+    cur.row_factory = sqlite3.Row
+    yield from cur.execute("""
+    SELECT daily_rollups.day, event_types.name AS event_type, products.product_id, products.product_name,
+           daily_rollups.events, daily_rollups.revenue
+    FROM daily_rollups
+    CROSS JOIN event_types ON event_types.code = daily_rollups.event_type
+    CROSS JOIN products ON products.id = daily_rollups.product_key
+    ORDER BY daily_rollups.day
+    """)
+
+def last_event_id(conn):
+    """Id of the newest event ever inserted, even if it has since been archived."""
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'events'").fetchone()
+    return 0 if row is None else row[0]
+
+def newest_event_ts(conn, up_to_id):
+    """Timestamp of the newest event with ``id <= up_to_id``, or None if there is none."""
+    for table in reversed(event_tables(conn)):
+        row = conn.execute(f"SELECT ts FROM {table} WHERE id <= ? ORDER BY id DESC LIMIT 1", (up_to_id,)).fetchone()
+        if row is not None:
+            return row[0]
+    return None
+
+def recent_events(conn, sql, event_type, up_to_id, limit=None, since_ts=None):
+    """The last ``limit`` events of one type with ``id <= up_to_id``, newest id first.
+
+    ``sql`` is a query template over ``{table}`` taking (event_type, up_to_id,
+    limit) and selecting ``ts`` last, e.g. ``track_top_users.RECENT_PURCHASES_SQL``.
+    The hot table is read first and partitions are only walked back, newest
+    day first, while more rows are wanted. With ``since_ts`` only events at or
+    after it are returned; partitions entirely older than it are skipped, but
+    each table read is read to the end, since replayed and backfilled events
+    don't get timestamps in id order.
+    """
+    rows = []
+    for table in reversed(event_tables(conn, since_ts)):
+        # Rows older than since_ts are dropped here, so the query itself can't stop at the limit
+        remaining = -1 if limit is None or since_ts is not None else limit - len(rows)
+        for row in conn.execute(sql.format(table=table), (event_type, up_to_id, remaining)):
+            if since_ts is not None and row[-1] < since_ts:
+                continue
+            rows.append(row)
+            if limit is not None and len(rows) >= limit:
+                return rows
+    return rows
+
+def range_totals(conn, start_ts=None, end_ts=None):
+    """Event counts and revenue per product and event type with ``start_ts <= ts < end_ts``.
+
+    Raw events come from the hot table and the partitions overlapping the
+    range. Compacted history only has daily resolution, so a compacted day is
+    counted whole when it begins inside the range.
+    """
+    start_ts = MIN_TS if start_ts is None else start_ts
+    end_ts = MAX_TS if end_ts is None else end_ts
+    parts, params = [], []
+    for table in event_tables(conn, start_ts, end_ts):
+        parts.append(f"""
+        SELECT event_type, product_key, COUNT(*) AS events, TOTAL(price) AS revenue
+        FROM {table}
+        WHERE ts >= ? AND ts < ?
+        GROUP BY event_type, product_key
+        """)
+        params += [start_ts, end_ts]
+    parts.append("""
+    SELECT event_type, product_key, events, revenue
+    FROM daily_rollups
+    WHERE day >= ? AND day <= ?
+    """)
+    first_day = day_of(max(start_ts, 0))
+    if day_bounds(first_day)[0] < start_ts:
+        first_day += timedelta(days=1)
+    last_day = day_of(min(end_ts, iso_to_micros("9999-12-31")) - 1)
+    params += [first_day.isoformat(), last_day.isoformat()]
+    return conn.execute(f"""
+    SELECT products.product_id, products.product_name, event_types.name, SUM(totals.events), SUM(totals.revenue)
+    FROM ({" UNION ALL ".join(parts)}) AS totals
+    JOIN products ON products.id = totals.product_key
+    JOIN event_types ON event_types.code = totals.event_type
+    GROUP BY products.product_id, products.product_name, event_types.name
+    ORDER BY products.product_name, event_types.name
+    """, params).fetchall()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive events into daily partitions and compact expired ones")
+    parser.add_argument("--retention-days", type=int, default=DEFAULT_RETENTION_DAYS, help="Days of raw events to keep before compacting into daily rollups")
+    parser.add_argument("--list", action="store_true", help="List partitions instead of running maintenance")
+    parser.add_argument("--plugin", action="append", default=[], help="Extra module whose rollups must fold events before they are archived")
+    args = parser.parse_args()
+
+    conn = connect_writer(DB_FILE)
+    try:
+        migrate(conn)
+        if args.list:
+            for name, day, row_count in conn.execute("SELECT name, day, row_count FROM event_partitions ORDER BY day"):
+                print(f"{day}  {name}  {row_count} events")
+            return
+        # Archiving waits for the marks of registered rollups only; register the plugins' too
+        from rollups import DEFAULT_ROLLUP_MODULES, registered_rollups
+        registered_rollups(DEFAULT_ROLLUP_MODULES + args.plugin)
+        moved, compacted = run_maintenance(conn, args.retention_days)
+        logger.info(f"Archived {moved} events, compacted {compacted} partitions.")
+        # Archiving rewrites many pages; wait for readers once and shrink the WAL back
+        checkpoint(conn, "TRUNCATE")
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    main()
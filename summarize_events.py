@@ -0,0 +1,121 @@
+import sqlite3
+from collections import defaultdict
+from rollups import Rollup, register_rollup
+from storage.schema import PURCHASE_TYPE
+
+# One row per event type; the report and the dashboard read the whole table at once
+SELECT_SUMMARY_SQL = "SELECT event_type, events, revenue, users FROM summary ORDER BY event_type"
+
+def create_summary_tables(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS summary (
+        event_type TEXT PRIMARY KEY,
+        events INTEGER NOT NULL,
+        revenue REAL NOT NULL,
+        users INTEGER NOT NULL
+    )
+    """)
+    # Users seen per event type, so ``users`` only counts each one once
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS summary_users (
+        event_type TEXT,
+        user_id TEXT,
+        PRIMARY KEY (event_type, user_id)
+    ) WITHOUT ROWID
+    """)
+    conn.commit()
+
+@register_rollup
+class SummaryRollup(Rollup):
+    """Store-wide totals per event type: events, revenue and distinct users.
+
+    Revenue only counts purchases, like the aggregates table. A user is
+    counted the first time they appear with an event type; ``summary_users``
+    remembers who was seen. Compacted daily history has no users, so after
+    a rebuild ``users`` only covers events still kept raw (hot or archived).
+    Maintained by ``aggregator.py``; ``--rollups summary`` runs it alone.
+    """
+
+    name = "summary"
+
+    def __init__(self, **options):
+        self.deltas = {}  # event_type -> [events, revenue]
+        self.seen = defaultdict(set)  # event_type -> user ids in the deltas
+
+    def create_table(self, conn):
+        create_summary_tables(conn)
+
+    def load(self, conn, last_event_id):
+        self.deltas = {}
+        self.seen = defaultdict(set)
+
+    def reset(self, conn):
+        conn.execute("DELETE FROM summary")
+        conn.execute("DELETE FROM summary_users")
+
+    def fold(self, event):
+        event_type = event["event_type"]
+        delta = self.deltas.get(event_type)
+        if delta is None:
+            delta = self.deltas[event_type] = [0, 0.0]
+        delta[0] += 1
+        if event_type == PURCHASE_TYPE:
+            delta[1] += event["price"]
+        self.seen[event_type].add(event["user_id"])
+
+    def fold_daily(self, totals):
+        delta = self.deltas.setdefault(totals["event_type"], [0, 0.0])
+        delta[0] += totals["events"]
+        if totals["event_type"] == PURCHASE_TYPE:
+            delta[1] += totals["revenue"]
+
+    def flush(self, conn):
+        rows = []
+        for event_type, (events, revenue) in self.deltas.items():
+            # rowcount adds up the users that weren't stored yet
+            new_users = conn.executemany(
+                "INSERT OR IGNORE INTO summary_users (event_type, user_id) VALUES (?, ?)",
+                [(event_type, user_id) for user_id in self.seen[event_type]],
+            ).rowcount
+            rows.append((event_type, events, revenue, max(new_users, 0)))
+        conn.executemany("""
+        INSERT INTO summary (event_type, events, revenue, users)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(event_type) DO UPDATE SET
+            events=events + excluded.events,
+            revenue=revenue + excluded.revenue,
+            users=users + excluded.users
+        """, rows)
+        self.deltas = {}
+        self.seen = defaultdict(set)
+
+    def backfill(self, conn, history):
+        for totals in history.products():
+            self.fold_daily(totals)
+        for event_type, user_ids in history.users():
+            self.seen[event_type].update(user_ids)
+        self.flush(conn)
+
+def summary_totals(rows):
+    """Purchases, revenue, active users, average order value and events per type from summary rows.
+
+    ``rows`` are (event_type, events, revenue, users), as in the table.
+    Active users are the distinct buyers.
+    """
+    by_type = {event_type: (events, revenue, users) for event_type, events, revenue, users in rows}
+    purchases, revenue, buyers = by_type.get(PURCHASE_TYPE, (0, 0.0, 0))
+    return {
+        "total_revenue": revenue,
+        "total_purchases": purchases,
+        "active_users": buyers,
+        "avg_order_value": revenue / purchases if purchases else 0.0,
+        "events_by_type": {event_type: events for event_type, (events, _, _) in by_type.items()},
+    }
+
+def read_summary(conn):
+    """``summary_totals`` of the summary table in one query; all zero until the summary rollup first ran."""
+    try:
+        rows = conn.execute(SELECT_SUMMARY_SQL).fetchall()
+    except sqlite3.OperationalError:
+        rows = []
+    return summary_totals(rows)
@@ -1,15 +1,34 @@
-import sqlite3
 import time
 import logging
 import argparse
+import heapq
+from collections import deque
+from datetime import timedelta
+from rollups import AggregationEngine, Rollup, register_rollup
+from storage.connection import connect_writer
+from storage.schema import PURCHASE, PURCHASE_TYPE, micros_to_iso, migrate
+from storage.store import last_event_id, newest_event_ts, recent_events
 from utils.logger import get_logger
 
 DB_FILE = "ecommerce.db"
 AGGREGATION_INTERVAL = 15  # seconds
 DEFAULT_EVENT_WINDOW = 1000  # last N events to consider
+DEFAULT_TOP_K = 100  # users kept in the top_users table
+WINDOW_UNITS = {"s": "seconds", "m": "minutes", "h": "hours", "d": "days"}
 
 logger = get_logger(__name__)
 
+# {table} is the hot events table or a partition; see storage.store.recent_events.
+# ts must stay the last column.
+RECENT_PURCHASES_SQL = """
+SELECT users.user_id, {table}.price, {table}.ts
+FROM {table}
+CROSS JOIN users ON users.id = {table}.user_key
+WHERE {table}.event_type = ? AND {table}.id <= ?
+ORDER BY {table}.id DESC
+LIMIT ?
+"""
+
 def create_top_users_table(conn):
     conn.execute("""
     CREATE TABLE IF NOT EXISTS top_users (
@@ -22,62 +41,199 @@ def create_top_users_table(conn):
     """)
     conn.commit()
 
-def update_top_users(conn, event_window):
-    cur = conn.cursor()
-    
-    # Get the latest events within our window and compute user metrics
-    cur.execute("""
-    WITH recent_events AS (
-        SELECT *
-        FROM events
-        WHERE event_type = 'purchase'
-        ORDER BY id DESC
-        LIMIT ?
-    )
-    SELECT 
-        user_id,
-        COUNT(*) as total_purchases,
-        SUM(price) as total_spent,
-        MAX(timestamp) as last_purchase_time
-    FROM recent_events
-    GROUP BY user_id
-    ORDER BY total_purchases DESC, total_spent DESC
-    """, (event_window,))
-    
-    rows = cur.fetchall()
-    
-    # Clear existing data and insert new rankings
-    cur.execute("DELETE FROM top_users")
-    
-    for user_id, total_purchases, total_spent, last_purchase_time in rows:
-        cur.execute("""
+def parse_window(value):
+    """Parse ``--window``: a number of purchases ("1000") or a duration ("90s", "15m", "1h", "7d")."""
+    if value[-1:] in WINDOW_UNITS:
+        window = timedelta(**{WINDOW_UNITS[value[-1]]: float(value[:-1])})
+    else:
+        window = int(value)
+    if window <= (timedelta(0) if isinstance(window, timedelta) else 0):
+        raise argparse.ArgumentTypeError(f"window must be positive: {value}")
+    return window
+
+def describe_window(window):
+    return f"last {window}" if isinstance(window, timedelta) else f"last {window} purchases"
+
+def update_top_users(conn, event_window, top_k=DEFAULT_TOP_K):
+    """Recompute the top_users table from the purchases in ``event_window``."""
+    rollup = TopUsersRollup(window=event_window, top_k=top_k)
+    rollup.create_table(conn)
+    rollup.load(conn, last_event_id(conn))
+    with conn:
+        rollup.flush(conn)
+    rows = conn.execute(
+        "SELECT user_id, total_purchases, total_spent FROM top_users ORDER BY total_purchases DESC, total_spent DESC"
+    ).fetchall()
+    if logger.isEnabledFor(logging.DEBUG):
+        for user_id, total_purchases, total_spent in rows:
+            logger.debug("User %s -> Purchases: %d, Spent: $%.2f", user_id, total_purchases, total_spent)
+    logger.info(f"Top users updated based on {describe_window(event_window)}. Ranked {len(rows)} of {len(rollup.users)} active users.")
+
+@register_rollup
+class TopUsersRollup(Rollup):
+    """The ``top_k`` users by purchases (then spend) within a sliding window.
+
+    ``window`` is either a number of purchases or a ``timedelta``. A time
+    window ends at the newest event timestamp folded so far, so replaying
+    history ranks it the way it looked at the time. Purchases leave a count
+    window in id order and a time window in timestamp order, since replayed
+    events can arrive out of time order. Per-user counters are updated as
+    purchases enter and leave the window, the top ``top_k`` are picked with
+    a bounded heap, and only rows that changed are written, so readers never
+    see the table half rewritten.
+    """
+
+    name = "top_users"
+
+    def __init__(self, window=DEFAULT_EVENT_WINDOW, top_k=DEFAULT_TOP_K, **options):
+        self.window = window
+        self.top_k = top_k
+        self.load_state([], {})
+
+    def load_state(self, purchases, published, now=None):
+        # Purchases in the window: (user_id, price, ts) in id order for a count
+        # window, a heap of (ts, user_id, price) for a time window
+        self.recent = [] if isinstance(self.window, timedelta) else deque()
+        self.users = {}  # user_id -> [purchases, spent, last purchase ts]
+        self.published = published  # user_id -> row as stored in top_users
+        self.touched = set()  # users whose counters went up since the last flush
+        self.rerank = False  # a published user went down; rank every user again
+        self.now = now
+        for user_id, price, ts in purchases:
+            self.add(user_id, price, ts)
+        # The stored rows may predate this window or top_k; rank everyone once
+        self.touched = set()
+        self.rerank = True
+
+    def create_table(self, conn):
+        create_top_users_table(conn)
+
+    def load(self, conn, last_event_id):
+        now = newest_event_ts(conn, last_event_id)
+        if now is None:
+            rows = []
+        elif isinstance(self.window, timedelta):
+            since_ts = now - self.window // timedelta(microseconds=1)
+            rows = recent_events(conn, RECENT_PURCHASES_SQL, PURCHASE, last_event_id, since_ts=since_ts)
+        else:
+            rows = recent_events(conn, RECENT_PURCHASES_SQL, PURCHASE, last_event_id, self.window)
+        published = {
+            user_id: (total_purchases, total_spent, last_purchase_time)
+            for user_id, total_purchases, total_spent, last_purchase_time in conn.execute(
+                "SELECT user_id, total_purchases, total_spent, last_purchase_time FROM top_users"
+            )
+        }
+        self.load_state(reversed(rows), published, now)
+
+    def add(self, user_id, price, ts):
+        if isinstance(self.window, timedelta):
+            heapq.heappush(self.recent, (ts, user_id, price))
+        else:
+            self.recent.append((user_id, price, ts))
+        user = self.users.get(user_id)
+        if user is None:
+            self.users[user_id] = [1, price, ts]
+        else:
+            user[0] += 1
+            user[1] += price
+            user[2] = max(user[2], ts)
+        self.touched.add(user_id)
+        self.advance(ts)
+
+    def advance(self, ts):
+        """Move the end of the window to ``ts`` and expire purchases that fell out."""
+        if self.now is None or ts > self.now:
+            self.now = ts
+        if isinstance(self.window, timedelta):
+            cutoff = self.now - self.window // timedelta(microseconds=1)
+            while self.recent and self.recent[0][0] < cutoff:
+                ts, user_id, price = heapq.heappop(self.recent)
+                self.expire(user_id, price)
+        else:
+            while len(self.recent) > self.window:
+                user_id, price, ts = self.recent.popleft()
+                self.expire(user_id, price)
+
+    def expire(self, user_id, price):
+        user = self.users[user_id]
+        user[0] -= 1
+        user[1] -= price
+        if user[0] == 0:
+            del self.users[user_id]
+        if user_id in self.published:
+            self.rerank = True
+
+    def fold(self, event):
+        if event["event_type"] == PURCHASE_TYPE:
+            self.add(event["user_id"], event["price"], event["ts"])
+        elif isinstance(self.window, timedelta):
+            self.advance(event["ts"])
+
+    def rank_key(self, user_id):
+        purchases, spent, last_ts = self.users[user_id]
+        return purchases, round(spent, 2), last_ts, user_id
+
+    def flush(self, conn):
+        if not (self.touched or self.rerank):
+            return
+        # Users outside the published top only climb when their own counters
+        # went up, so unless a published user went down the candidates are the
+        # published users plus the touched ones.
+        if self.rerank:
+            candidates = self.users.keys()
+        else:
+            candidates = (self.published.keys() | self.touched) & self.users.keys()
+        # Ties go to the most recent buyer, then the user id, so the ranking does
+        # not depend on which users happened to be candidates
+        ranked = heapq.nlargest(self.top_k, candidates, key=self.rank_key)
+        top = {}
+        for user_id in ranked:
+            purchases, spent, last_ts = self.users[user_id]
+            top[user_id] = (purchases, round(spent, 2), micros_to_iso(last_ts))
+
+        removed = [(user_id,) for user_id in self.published if user_id not in top]
+        changed = [(user_id, *row) for user_id, row in top.items() if self.published.get(user_id) != row]
+        conn.executemany("DELETE FROM top_users WHERE user_id = ?", removed)
+        conn.executemany("""
         INSERT INTO top_users (user_id, total_purchases, total_spent, last_purchase_time)
         VALUES (?, ?, ?, ?)
-        """, (user_id, total_purchases, total_spent, last_purchase_time))
-        logger.info(f"User {user_id} -> Purchases: {total_purchases}, Spent: ${total_spent:.2f}")
-    
-    conn.commit()
-    logger.info(f"Top users updated based on last {event_window} events. Found {len(rows)} active users.")
+        ON CONFLICT(user_id) DO UPDATE SET
+            total_purchases=excluded.total_purchases,
+            total_spent=excluded.total_spent,
+            last_purchase_time=excluded.last_purchase_time
+        """, changed)
+        logger.debug("top_users: %d rows written, %d removed", len(changed), len(removed))
+        self.published = top
+        self.touched = set()
+        self.rerank = False
+
+    def backfill(self, conn, history):
+        # Only the window matters, and load already reads just that from the tables
+        self.load(conn, history.up_to_id)
+        self.flush(conn)
 
 def main():
     parser = argparse.ArgumentParser(description="Track top users by purchase activity")
     parser.add_argument("--once", action="store_true", help="Run a single update and exit")
     parser.add_argument("--interval", type=int, default=AGGREGATION_INTERVAL, help="Seconds between updates in loop mode")
-    parser.add_argument("--window", type=int, default=DEFAULT_EVENT_WINDOW, help="Number of recent events to consider")
+    parser.add_argument("--window", type=parse_window, default=DEFAULT_EVENT_WINDOW, help="Recent purchases to consider: a count (1000) or a duration (30m, 1h, 7d)")
+    parser.add_argument("--top-k", type=int, default=DEFAULT_TOP_K, help="Number of users kept in the top_users table")
     args = parser.parse_args()
 
     # Allow concurrent reading while consumer writes
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-    conn.execute("PRAGMA journal_mode=WAL;")
+    conn = connect_writer(DB_FILE, check_same_thread=False)
+    migrate(conn)
     create_top_users_table(conn)
     
     try:
         if args.once:
-            update_top_users(conn, args.window)
+            update_top_users(conn, args.window, args.top_k)
             return
-        
+
+        # Keep the window in memory and fold only new events on each tick
+        engine = AggregationEngine(conn, [TopUsersRollup(window=args.window, top_k=args.top_k)])
         while True:
-            update_top_users(conn, args.window)
+            engine.run_pass()
             time.sleep(args.interval)
     except KeyboardInterrupt:
         logger.info("Stopping top users tracker...")
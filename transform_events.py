@@ -1,14 +1,39 @@
-import sqlite3
 import time
 import logging
 import argparse
+from rollups import AggregationEngine, Rollup, create_aggregation_state_table, get_high_water_mark, register_rollup
+from storage.connection import connect_writer
+from storage.schema import PURCHASE, PURCHASE_TYPE, migrate
+from storage.store import event_partitions
 from utils.logger import get_logger
 
 DB_FILE = "ecommerce.db"
 AGGREGATION_INTERVAL = 15  # seconds
+STATE_NAME = "aggregates"  # row in aggregation_state holding our high-water mark
 
 logger = get_logger(__name__)
 
+VERIFY_AGGREGATES_SQL = """
+SELECT product_key, COUNT(*) AS sales, TOTAL(price) AS revenue
+FROM events INDEXED BY idx_events_type_product
+WHERE id <= ? AND event_type = ?
+GROUP BY product_key
+"""
+
+# Partitions have no secondary indexes; they are only read in full
+VERIFY_PARTITION_SQL = """
+SELECT product_key, COUNT(*), TOTAL(price)
+FROM {table}
+WHERE id <= ? AND event_type = ?
+GROUP BY product_key
+"""
+
+VERIFY_DAILY_SQL = """
+SELECT product_key, events, revenue
+FROM daily_rollups
+WHERE event_type = ?
+"""
+
 def create_aggregates_table(conn):
     conn.execute("""
     CREATE TABLE IF NOT EXISTS aggregates (
@@ -21,45 +46,132 @@ def create_aggregates_table(conn):
     """)
     conn.commit()
 
-def update_aggregates(conn):
-    cur = conn.cursor()
-    
-    # Compute per-product aggregates from the raw events table
-    cur.execute("""
-    SELECT product_id, product_name, COUNT(*) as total_sales, SUM(price) as total_revenue
-    FROM events 
-    WHERE event_type = 'purchase'
-    GROUP BY product_id, product_name
-    """)
-    
-    rows = cur.fetchall()
-    
-    # Upsert the computed aggregates
-    for product_id, product_name, total_sales, total_revenue in rows:
-        cur.execute("""
+@register_rollup
+class ProductSalesRollup(Rollup):
+    """Per-product purchase count and revenue, folded in as deltas."""
+
+    name = STATE_NAME
+
+    def __init__(self, **options):
+        self.deltas = {}
+
+    def load(self, conn, last_event_id):
+        self.deltas = {}
+
+    def create_table(self, conn):
+        create_aggregates_table(conn)
+
+    def fold(self, event):
+        if event["event_type"] != PURCHASE_TYPE:
+            return
+        delta = self.deltas.get(event["product_id"])
+        if delta is None:
+            self.deltas[event["product_id"]] = [event["product_name"], 1, event["price"]]
+        else:
+            delta[1] += 1
+            delta[2] += event["price"]
+
+    def fold_daily(self, totals):
+        if totals["event_type"] != PURCHASE_TYPE:
+            return
+        delta = self.deltas.setdefault(totals["product_id"], [totals["product_name"], 0, 0.0])
+        delta[1] += totals["events"]
+        delta[2] += totals["revenue"]
+
+    def flush(self, conn):
+        # Add the deltas onto the stored totals
+        conn.executemany("""
         INSERT INTO aggregates (product_id, product_name, total_sales, total_revenue)
         VALUES (?, ?, ?, ?)
         ON CONFLICT(product_id) DO UPDATE SET
-            total_sales=excluded.total_sales,
-            total_revenue=excluded.total_revenue
-        """, (product_id, product_name, total_sales, total_revenue))
-        logger.info(f"Product {product_name} (ID: {product_id}) -> Sales: {total_sales}, Revenue: {total_revenue}")
-    
-    conn.commit()
-    logger.info(f"Aggregates updated for {len(rows)} products.")
+            total_sales=total_sales + excluded.total_sales,
+            total_revenue=total_revenue + excluded.total_revenue
+        """, [(product_id, *delta) for product_id, delta in self.deltas.items()])
+        if logger.isEnabledFor(logging.DEBUG):
+            for product_id, (product_name, total_sales, total_revenue) in self.deltas.items():
+                logger.debug("Product %s (ID: %s) -> Sales: +%d, Revenue: +%s", product_name, product_id, total_sales, total_revenue)
+        self.deltas = {}
+
+    def backfill(self, conn, history):
+        # A product keeps the name it was first stored with
+        for totals in history.products(order="first"):
+            self.fold_daily(totals)
+        self.flush(conn)
+
+def update_aggregates(conn):
+    """Fold purchases added since the last run into the aggregates table.
+
+    Only events after the high-water mark stored in ``aggregation_state`` are
+    read; see ``rollups.AggregationEngine``. Without a stored mark (first run,
+    or a table filled by an older version) the table is rebuilt instead.
+    """
+    AggregationEngine(conn, [ProductSalesRollup()]).run_pass()
+
+def rebuild_aggregates(conn):
+    """Recompute the aggregates table from every event."""
+    engine = AggregationEngine(conn, [ProductSalesRollup()])
+    engine.rebuild()
+    engine.run_pass()
+
+def verify_aggregates(conn):
+    """Compare the stored aggregates with a full recompute up to the high-water mark.
+
+    The recompute covers the hot events table, the archived partitions and
+    the compacted daily rollups (see ``storage.store``).
+
+    Revenue is compared to the cent, since a float sum depends on the order in
+    which it was added up. Returns the list of mismatched product ids.
+    """
+    last_event_id = get_high_water_mark(conn, STATE_NAME) or 0
+    parts = [VERIFY_AGGREGATES_SQL] + [VERIFY_PARTITION_SQL.format(table=name) for name in event_partitions(conn)]
+    params = [last_event_id, PURCHASE] * len(parts) + [PURCHASE]
+    expected = {
+        product_id: (total_sales, round(total_revenue, 2))
+        for product_id, total_sales, total_revenue in conn.execute(f"""
+        SELECT products.product_id, SUM(totals.sales), SUM(totals.revenue)
+        FROM ({" UNION ALL ".join(parts + [VERIFY_DAILY_SQL])}) AS totals
+        JOIN products ON products.id = totals.product_key
+        GROUP BY products.product_id
+        """, params)
+    }
+    actual = {
+        product_id: (total_sales, round(total_revenue, 2))
+        for product_id, total_sales, total_revenue in conn.execute(
+            "SELECT product_id, total_sales, total_revenue FROM aggregates"
+        )
+    }
+    mismatched = sorted(
+        product_id for product_id in expected.keys() | actual.keys()
+        if expected.get(product_id) != actual.get(product_id)
+    )
+    for product_id in mismatched:
+        logger.warning(f"Product {product_id}: stored {actual.get(product_id)}, recomputed {expected.get(product_id)}")
+    logger.info(f"Verified aggregates up to event {last_event_id}: {len(mismatched)} mismatched products.")
+    return mismatched
 
 def main():
     parser = argparse.ArgumentParser(description="Update aggregates from events table")
     parser.add_argument("--once", action="store_true", help="Run a single update and exit")
     parser.add_argument("--interval", type=int, default=AGGREGATION_INTERVAL, help="Seconds between updates in loop mode")
+    parser.add_argument("--rebuild", action="store_true", help="Recompute aggregates from all events before updating incrementally")
+    parser.add_argument("--verify", action="store_true", help="Check the stored aggregates against a full recompute and exit")
     args = parser.parse_args()
 
     # Allow concurrent reading while consumer writes
-    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-    conn.execute("PRAGMA journal_mode=WAL;")
+    conn = connect_writer(DB_FILE, check_same_thread=False)
+    migrate(conn)
     create_aggregates_table(conn)
+    create_aggregation_state_table(conn)
     
     try:
+        if args.verify:
+            if verify_aggregates(conn):
+                raise SystemExit(1)
+            return
+
+        if args.rebuild:
+            rebuild_aggregates(conn)
+
         if args.once:
             update_aggregates(conn)
             return
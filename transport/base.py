@@ -0,0 +1,56 @@
+import importlib
+
+DEFAULT_TRANSPORT = "jsonl"
+# Modules whose transports are available; importing them registers the transports
+TRANSPORT_MODULES = ["transport.jsonl", "transport.segment_log", "transport.columnar"]
+
+TRANSPORTS = {}
+
+
+def register_transport(cls):
+    """Class decorator that makes a transport selectable by its ``name``."""
+    TRANSPORTS[cls.name] = cls
+    return cls
+
+
+class Transport:
+    """How events get from the producers to the consumers.
+
+    ``producer()`` returns an object with ``send(data, keys=None)``, which
+    appends a block of complete JSON lines (``keys`` optionally gives the
+    partition key of each line, the user id), and ``close()``. Producers of
+    binary formats may also offer ``send_frame(builder)``, which takes events
+    already laid out in a ``storage.columnar.FrameBuilder``.
+    ``consumer(conn, **options)`` returns a tailer with ``open(skip_backlog)``,
+    ``run(once)`` and ``close()`` that commits what it reads into ``conn``
+    with the options of ``consumer.consumer.EventTailer`` (batch_size,
+    max_linger, catch_up_batch_size, engine, store_raw, decoder).
+    """
+
+    name = None
+
+    def __init__(self, **options):
+        """Transports receive every transport option and ignore the ones they don't use."""
+
+    def producer(self):
+        raise NotImplementedError
+
+    def consumer(self, conn, **options):
+        raise NotImplementedError
+
+    def describe(self):
+        return self.name
+
+
+def get_transport(name=DEFAULT_TRANSPORT, **options):
+    """The transport registered as ``name``, configured with ``options``."""
+    for module in TRANSPORT_MODULES:
+        importlib.import_module(module)
+    if name not in TRANSPORTS:
+        raise ValueError(f"Unknown transport {name}. Available: {', '.join(TRANSPORTS)}")
+    return TRANSPORTS[name](**options)
+
+def transport_names():
+    for module in TRANSPORT_MODULES:
+        importlib.import_module(module)
+    return sorted(TRANSPORTS)
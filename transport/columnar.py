@@ -0,0 +1,69 @@
+import os
+from storage.columnar import COLUMNAR_FILE, MAX_FRAME_EVENTS, FrameBuilder, write_frame
+from transport.base import Transport, register_transport
+from transport.jsonl import open_output
+from utils.logger import get_logger, sampled
+from utils.schema import get_decoder, parse_event
+
+logger = get_logger(__name__)
+
+
+class ColumnarProducer:
+    """Appends events as columnar frames, one write per frame.
+
+    ``send_frame`` takes a ``storage.columnar.FrameBuilder`` filled without
+    any JSON. ``send`` accepts JSON lines like the other producers; lines
+    that aren't valid events can't be framed and are dropped with a warning.
+    """
+
+    def __init__(self, path):
+        self.fd = open_output(path)
+        self.loads = get_decoder()
+
+    def send(self, data, keys=None):
+        if isinstance(data, str):
+            data = data.encode()
+        builder = FrameBuilder()
+        for line in data.splitlines(keepends=True):
+            if not line.strip():
+                continue
+            try:
+                builder.add_event(parse_event(line, self.loads))
+            except ValueError as e:
+                logger.warning("Dropping invalid event %s: %r", e, line, extra=sampled(100))
+                continue
+            if len(builder) >= MAX_FRAME_EVENTS:
+                self.send_frame(builder)
+                builder = FrameBuilder()
+        if len(builder):
+            self.send_frame(builder)
+
+    def send_frame(self, builder):
+        write_frame(self.fd, builder)
+
+    def close(self):
+        os.close(self.fd)
+
+
+@register_transport
+class ColumnarTransport(Transport):
+    """Binary columnar frames in one append-only file, read by a single consumer.
+
+    About a tenth of the bytes of JSON lines, and read through mmap without
+    parsing text; see storage/columnar.py for the format.
+    """
+
+    name = "columnar"
+
+    def __init__(self, columnar_file=COLUMNAR_FILE, **options):
+        self.columnar_file = columnar_file
+
+    def producer(self):
+        return ColumnarProducer(self.columnar_file)
+
+    def consumer(self, conn, **options):
+        from consumer.columnar import ColumnarTailer
+        return ColumnarTailer(conn, self.columnar_file, **options)
+
+    def describe(self):
+        return self.columnar_file
@@ -0,0 +1,51 @@
+import os
+from transport.base import Transport, register_transport
+
+EVENT_FILE = "events.jsonl"
+
+
+def append_lines(fd, data):
+    """Append a block of lines with a single write so parallel writers never interleave lines."""
+    if isinstance(data, str):
+        data = data.encode()
+    while data:
+        written = os.write(fd, data)
+        data = data[written:]
+
+def open_output(output_file):
+    return os.open(output_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+
+class JsonlProducer:
+    def __init__(self, path):
+        self.fd = open_output(path)  # append mode so we keep history
+
+    def send(self, data, keys=None):
+        append_lines(self.fd, data)
+
+    def close(self):
+        os.close(self.fd)
+
+
+@register_transport
+class JsonlTransport(Transport):
+    """One append-only JSON lines file, read by a single consumer.
+
+    Any number of producers can append to the file; only one consumer may
+    tail it, since the whole file shares one committed offset.
+    """
+
+    name = "jsonl"
+
+    def __init__(self, path=EVENT_FILE, **options):
+        self.path = path
+
+    def producer(self):
+        return JsonlProducer(self.path)
+
+    def consumer(self, conn, **options):
+        from consumer.consumer import EventTailer
+        return EventTailer(conn, self.path, **options)
+
+    def describe(self):
+        return self.path
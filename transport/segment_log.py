@@ -0,0 +1,349 @@
+import os
+import json
+import time
+import uuid
+import zlib
+import fcntl
+import bisect
+from collections import defaultdict
+from pathlib import Path
+from transport.base import Transport, register_transport
+from utils.logger import get_logger
+from utils.schema import get_decoder
+
+LOG_DIR = "eventlog"
+DEFAULT_TOPIC = "events"
+DEFAULT_PARTITIONS = 8
+DEFAULT_SEGMENT_BYTES = 64 << 20  # the active segment rolls over past this size
+DEFAULT_GROUP = "consumers"
+SEGMENT_SUFFIX = ".log"
+OFFSET_DIGITS = 20  # segment files are named by their zero-padded base offset, as in Kafka
+
+logger = get_logger(__name__)
+
+
+def partition_for(key, partitions):
+    """Partition of a record key; the same in every process and run, unlike hash()."""
+    return zlib.crc32(key.encode()) % partitions
+
+
+class SegmentLog:
+    """A topic stored as partitioned, append-only segment files: a Kafka topic on one disk.
+
+    ``<log_dir>/<topic>/meta.json`` holds the partition count and an id that
+    changes if the topic is deleted and created again. Each partition is a
+    directory of segment files named after the offset of their first byte.
+    Offsets are byte positions within the partition, so a reader seeks
+    straight to any of them. Appends hold the partition's lock file and write
+    whole lines in one call, so any number of producers can share a
+    partition. The active segment rolls over once it reaches
+    ``segment_bytes``; with ``retention_segments`` only that many segments
+    are kept per partition.
+    """
+
+    def __init__(self, log_dir=LOG_DIR, topic=DEFAULT_TOPIC, partitions=None,
+                 segment_bytes=DEFAULT_SEGMENT_BYTES, retention_segments=None):
+        self.path = Path(log_dir) / topic
+        self.topic = topic
+        self.segment_bytes = segment_bytes
+        self.retention_segments = retention_segments
+        self.locks = {}  # partition -> fd of its append lock
+        meta = self.load_meta() or self.create(partitions or DEFAULT_PARTITIONS)
+        if partitions and partitions != meta["partitions"]:
+            raise ValueError(f"Topic {self.path} has {meta['partitions']} partitions, not {partitions}")
+        self.partitions = meta["partitions"]
+        self.id = meta["id"]
+
+    def load_meta(self):
+        try:
+            with open(self.path / "meta.json") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def create(self, partitions):
+        for partition in range(partitions):
+            self.partition_path(partition).mkdir(parents=True, exist_ok=True)
+        tmp = self.path / f".meta.json.{os.getpid()}"
+        tmp.write_text(json.dumps({"partitions": partitions, "id": uuid.uuid4().hex}))
+        try:
+            os.link(tmp, self.path / "meta.json")
+        except FileExistsError:
+            pass  # Another process created the topic first; its settings win
+        finally:
+            tmp.unlink()
+        return self.load_meta()
+
+    def partition_path(self, partition):
+        return self.path / str(partition)
+
+    def segment_path(self, partition, base):
+        return self.partition_path(partition) / f"{base:0{OFFSET_DIGITS}d}{SEGMENT_SUFFIX}"
+
+    def segments(self, partition):
+        """Base offsets of the partition's segments, oldest first."""
+        return sorted(
+            int(name[:-len(SEGMENT_SUFFIX)])
+            for name in os.listdir(self.partition_path(partition)) if name.endswith(SEGMENT_SUFFIX)
+        )
+
+    def end_offset(self, partition):
+        """Offset just past the last byte written to the partition."""
+        segments = self.segments(partition)
+        if not segments:
+            return 0
+        return segments[-1] + os.path.getsize(self.segment_path(partition, segments[-1]))
+
+    def lock(self, partition):
+        fd = self.locks.get(partition)
+        if fd is None:
+            fd = self.locks[partition] = os.open(self.partition_path(partition) / ".append.lock", os.O_RDWR | os.O_CREAT, 0o644)
+        return fd
+
+    def append(self, partition, data):
+        """Append complete lines to a partition; returns the offset just past them."""
+        lock = self.lock(partition)
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            segments = self.segments(partition)
+            base = segments[-1] if segments else 0
+            size = os.path.getsize(self.segment_path(partition, base)) if segments else 0
+            if size >= self.segment_bytes:
+                # Segments before the active one are never written again
+                base += size
+                size = 0
+                segments.append(base)
+                self.retain(partition, segments)
+            fd = os.open(self.segment_path(partition, base), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(fd, view):]
+            finally:
+                os.close(fd)
+            return base + size + len(data)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def retain(self, partition, segments):
+        if self.retention_segments:
+            for base in segments[:-self.retention_segments]:
+                self.segment_path(partition, base).unlink(missing_ok=True)
+
+    def close(self):
+        for fd in self.locks.values():
+            os.close(fd)
+        self.locks = {}
+
+
+class PartitionReader:
+    """Reads one partition line by line from an offset, moving on to newer segments.
+
+    An offset that was deleted by retention moves to the oldest segment kept.
+    """
+
+    def __init__(self, log, partition, offset):
+        self.log = log
+        self.partition = partition
+        self.f = None
+        self.base = 0
+        self.offset = offset
+        self.seek(offset)
+
+    def seek(self, offset):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+        segments = self.log.segments(self.partition)
+        self.offset = offset
+        if not segments:
+            return
+        index = bisect.bisect_right(segments, offset) - 1
+        if index < 0:
+            logger.warning(f"{self.log.path}/{self.partition}: offset {offset} was deleted by retention; "
+                           f"skipping to {segments[0]}")
+            index = 0
+            self.offset = segments[0]
+        self.base = segments[index]
+        self.f = open(self.log.segment_path(self.partition, self.base), "rb")
+        self.f.seek(self.offset - self.base)
+
+    def readline(self):
+        """The next complete line, or b"" if there is none yet."""
+        if self.f is None:
+            self.seek(self.offset)
+            if self.f is None:
+                return b""
+        line = self.f.readline()
+        if line.endswith(b"\n"):
+            self.offset += len(line)
+            return line
+        self.f.seek(self.offset - self.base)  # EOF, or a line still being written
+        if not line and self.next_segment():
+            return self.readline()
+        return b""
+
+    def next_segment(self):
+        """Switch to the following segment once one exists; the current one is then complete."""
+        later = [base for base in self.log.segments(self.partition) if base > self.base]
+        if not later:
+            return False
+        if os.fstat(self.f.fileno()).st_size > self.offset - self.base:
+            return True  # The last lines landed just before the roll; read them first
+        if later[0] != self.offset:
+            logger.warning(f"{self.log.path}/{self.partition}: offsets {self.offset}-{later[0]} were deleted by retention")
+        self.f.close()
+        self.f = open(self.log.segment_path(self.partition, later[0]), "rb")
+        self.base = self.offset = later[0]
+        return True
+
+    def end_offset(self):
+        return self.log.end_offset(self.partition)
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
+class GroupMembership:
+    """This process's membership in a consumer group of a topic.
+
+    Members are files under ``<topic>/groups/<group>/members``, each locked
+    with flock by its process, so a member that dies drops out with its
+    process. Partitions are split over the live members in member order
+    (partition ``p`` goes to member ``p % n``). A member only reads a
+    partition while it holds that partition's lock file, so two members never
+    consume the same partition, even while they briefly disagree about who
+    is in the group.
+    """
+
+    def __init__(self, log, group=DEFAULT_GROUP):
+        self.log = log
+        self.group = group
+        self.path = log.path / "groups" / group
+        members = self.path / "members"
+        members.mkdir(parents=True, exist_ok=True)
+        # Ids sort by join time. The file is locked before it gets its visible
+        # name, so no other member can mistake it for a dead one.
+        self.member_id = f"{time.time_ns():020d}-{os.getpid()}"
+        tmp = members / f".{self.member_id}"
+        self.member_fd = os.open(tmp, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self.member_fd, fcntl.LOCK_EX)
+        os.rename(tmp, members / self.member_id)
+        self.claimed = {}  # partition -> fd of its lock file
+
+    def members(self):
+        """Ids of the live members, removing the files of dead ones."""
+        alive = []
+        for name in sorted(os.listdir(self.path / "members")):
+            if name.startswith("."):
+                continue
+            if name == self.member_id:
+                alive.append(name)
+                continue
+            path = self.path / "members" / name
+            try:
+                fd = os.open(path, os.O_RDWR)
+            except FileNotFoundError:
+                continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                alive.append(name)
+            else:
+                path.unlink(missing_ok=True)  # Its process is gone
+            finally:
+                os.close(fd)
+        return alive
+
+    def assignment(self):
+        """Partitions this member should read with the current members."""
+        members = self.members()
+        index = members.index(self.member_id)
+        return [partition for partition in range(self.log.partitions) if partition % len(members) == index]
+
+    def claim(self, partition):
+        """Take the partition's lock; False while its previous owner still holds it."""
+        fd = os.open(self.path / f"partition-{partition}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self.claimed[partition] = fd
+        return True
+
+    def release(self, partition):
+        os.close(self.claimed.pop(partition))  # Closing the last descriptor drops the lock
+
+    def leave(self):
+        for partition in list(self.claimed):
+            self.release(partition)
+        (self.path / "members" / self.member_id).unlink(missing_ok=True)
+        os.close(self.member_fd)
+
+
+class LogProducer:
+    """Appends lines to the partition of their key, one write per partition and batch."""
+
+    def __init__(self, log):
+        self.log = log
+        self.loads = get_decoder()
+
+    def key(self, line):
+        try:
+            return str(self.loads(line).get("user_id", ""))
+        except (ValueError, AttributeError):
+            return ""  # Unparseable lines still go through, for the consumer to dead-letter
+
+    def send(self, data, keys=None):
+        if isinstance(data, str):
+            data = data.encode()
+        lines = data.splitlines(keepends=True)
+        if keys is None:
+            keys = [self.key(line) for line in lines]
+        partitions = defaultdict(list)
+        for key, line in zip(keys, lines):
+            partitions[partition_for(key, self.log.partitions)].append(line)
+        for partition, lines in partitions.items():
+            self.log.append(partition, b"".join(lines))
+
+    def close(self):
+        self.log.close()
+
+
+@register_transport
+class SegmentLogTransport(Transport):
+    """A partitioned segment log keyed by user id, read by a consumer group.
+
+    Events of one user always land in the same partition, in order. Every
+    consumer started with the same ``group`` takes a share of the
+    partitions, so N consumer processes split the load; see
+    ``consumer/group.py``. No broker is involved: producers and consumers
+    coordinate through files and flock.
+    """
+
+    name = "log"
+
+    def __init__(self, log_dir=LOG_DIR, topic=DEFAULT_TOPIC, partitions=None, segment_bytes=DEFAULT_SEGMENT_BYTES,
+                 retention_segments=None, group=DEFAULT_GROUP, **options):
+        self.log_dir = log_dir
+        self.topic = topic
+        self.partitions = partitions
+        self.segment_bytes = segment_bytes
+        self.retention_segments = retention_segments
+        self.group = group
+
+    def open_log(self):
+        return SegmentLog(self.log_dir, self.topic, self.partitions, self.segment_bytes, self.retention_segments)
+
+    def producer(self):
+        return LogProducer(self.open_log())
+
+    def consumer(self, conn, **options):
+        from consumer.group import GroupTailer
+        return GroupTailer(conn, self.open_log(), self.group, **options)
+
+    def describe(self):
+        return f"{Path(self.log_dir) / self.topic} (group {self.group})"
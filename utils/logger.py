@@ -1,22 +1,152 @@
-
-import logging
 import os
+import json
+import queue
+import atexit
+import logging
+import threading
+import logging.handlers
+
+LOG_FORMAT = "[%(asctime)s] [%(levelname)s] %(name)s: %(message)s"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Shared by every logger from get_logger; created on first use
+_handler = None
+_listener = None
+_lock = threading.Lock()
+
+
+def fields(**values):
+    """Structured fields for a log call: ``logger.info("Committed batch", extra=fields(events=500))``.
+
+    The text format appends them as ``key=value``; with ``LOG_FORMAT=json``
+    each becomes a key of the JSON record.
+    """
+    return {"fields": values}
+
+def sampled(every, **values):
+    """``extra`` for a per-event message: only one in ``every`` records with the same template is written."""
+    return {"sample_every": every, "fields": values}
+
+
+class KeyValueFormatter(logging.Formatter):
+    """The usual text format, followed by the record's structured fields."""
+
+    def formatMessage(self, record):
+        message = super().formatMessage(record)
+        values = getattr(record, "fields", None)
+        if values:
+            message += " " + " ".join(f"{key}={value}" for key, value in values.items())
+        return message
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, for log shippers."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, DATE_FORMAT),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class SamplingLogger(logging.Logger):
+    """A logger that writes one in ``n`` records logged with ``extra=sampled(n)``.
+
+    Calls are counted per message template before a record is built, so the
+    ones dropped cost little more than a disabled level. The record that is
+    written notes the rate it was sampled at.
+    """
+
+    def __init__(self, name, level=logging.NOTSET):
+        super().__init__(name, level)
+        self.sample_counts = {}
+
+    def _log(self, level, msg, args, exc_info=None, extra=None, stack_info=False, stacklevel=1):
+        every = extra.get("sample_every") if extra else None
+        if every and every > 1:
+            seen = self.sample_counts.get(msg, 0)
+            self.sample_counts[msg] = seen + 1
+            if seen % every:
+                return
+            extra = {"fields": dict(extra.get("fields") or {}, sampled=f"1/{every}")}
+        super()._log(level, msg, args, exc_info, extra, stack_info, stacklevel + 1)
+
+# Loggers created from here on can sample; it only changes calls that pass sampled()
+logging.setLoggerClass(SamplingLogger)
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Render the message in the caller; the writer thread formats the line and writes it.
+
+    Arguments are merged into the message before the record is queued, so a
+    mutable argument (an event dict the validator coerces in place) is logged
+    as it was at the call. The stock QueueHandler also formats the whole line
+    and flattens the record so it can be pickled; this queue never leaves the
+    process, so that and the I/O are left to the writer thread.
+    """
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def _formatter():
+    if os.getenv("LOG_FORMAT", "text").lower() == "json":
+        return JsonFormatter()
+    return KeyValueFormatter(fmt=LOG_FORMAT, datefmt=DATE_FORMAT)
+
+def _start_writer(use_thread=True):
+    """Route records through a queue to a writer thread (``LOG_ASYNC=0`` writes inline instead)."""
+    global _handler, _listener
+    stream = logging.StreamHandler()
+    stream.setFormatter(_formatter())
+    if not use_thread or os.getenv("LOG_ASYNC", "1") == "0":
+        _handler = stream
+    else:
+        _handler = DeferredQueueHandler(queue.SimpleQueue())
+        _listener = logging.handlers.QueueListener(_handler.queue, stream, respect_handler_level=True)
+        _listener.start()
+
+def _write_inline_after_fork():
+    # The writer thread doesn't survive fork, and multiprocessing children skip
+    # atexit, so forked children write their records inline
+    global _listener
+    if _listener is not None:
+        _listener = None
+        handler = _handler
+        _start_writer(use_thread=False)
+        for logger in list(logging.Logger.manager.loggerDict.values()):
+            if isinstance(logger, logging.Logger) and handler in logger.handlers:
+                logger.removeHandler(handler)
+                logger.addHandler(_handler)
+
+def flush_logs():
+    """Write every queued record; called at exit."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+atexit.register(flush_logs)
+os.register_at_fork(after_in_child=_write_inline_after_fork)
+
 
 def get_logger(name: str):
     logger = logging.getLogger(name)
     if not logger.handlers:
-        handler = logging.StreamHandler()
-        
-        # Create a clear, informative format
-        formatter = logging.Formatter(
-            fmt='[%(asctime)s] [%(levelname)s] %(name)s: %(message)s',
-            datefmt='%Y-%m-%d %H:%M:%S'
-        )
-        handler.setFormatter(formatter)
-        logger.addHandler(handler)
-        
+        with _lock:
+            if _handler is None:
+                _start_writer()
+        logger.addHandler(_handler)
+        # Our handler is the only one; don't let a root handler print records twice
+        logger.propagate = False
+
         # Default log level from ENV (default: INFO)
         level = os.getenv("LOG_LEVEL", "INFO").upper()
         logger.setLevel(level)
-        
+
     return logger
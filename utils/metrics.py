@@ -0,0 +1,277 @@
+import os
+import json
+import math
+import time
+import atexit
+import bisect
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds; sized for batch commits and aggregation ticks
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# For sizes such as rows per tick
+COUNT_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Metric:
+    """A named metric with optional labels; ``labels(*values)`` returns the series for those values."""
+
+    kind = None
+
+    def __init__(self, name, help="", labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        series = self.series.get(values)
+        if series is None:
+            with self.lock:
+                series = self.series.setdefault(values, self.new_series())
+        return series
+
+    def new_series(self):
+        raise NotImplementedError
+
+    def samples(self):
+        """``(label values, series)`` pairs, unlabelled series included."""
+        with self.lock:
+            return sorted(self.series.items())
+
+class CounterSeries:
+    __slots__ = ("value", "lock")
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def read(self):
+        return self.value
+
+class GaugeSeries(CounterSeries):
+    __slots__ = ("function",)
+
+    def __init__(self):
+        super().__init__()
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        """Compute the value when it is read, e.g. a lag that grows while the process is stuck."""
+        self.function = function
+
+    def read(self):
+        if self.function is None:
+            return self.value
+        try:
+            return self.function()
+        except Exception:
+            return math.nan
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+class HistogramSeries:
+    __slots__ = ("buckets", "counts", "sum", "count", "lock")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def quantile(self, q):
+        """Estimate a quantile by linear interpolation inside its bucket."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for upper, count in zip(self.buckets, self.counts):
+            if count and seen + count >= rank:
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+            lower = upper
+        return self.buckets[-1]  # in the +Inf bucket; the largest finite bound is a floor
+
+class Counter(Metric):
+    kind = "counter"
+
+    def new_series(self):
+        return CounterSeries()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def new_series(self):
+        return GaugeSeries()
+
+    def set(self, value):
+        self.labels().set(value)
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help="", labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def new_series(self):
+        return HistogramSeries(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+
+class Registry:
+    """Process-wide metrics by name; asking for an existing name returns the same metric."""
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, cls, name, *args, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, *args, **kwargs)
+            elif type(metric) is not cls:
+                raise ValueError(f"Metric {name} is already registered as a {metric.kind}")
+            return metric
+
+    def snapshot(self):
+        """Current values as plain data: counters and gauges by label, histograms with count, sum and p50/p95/p99."""
+        result = {}
+        for name, metric in sorted(self.metrics.items()):
+            values = {}
+            for label_values, series in metric.samples():
+                key = ",".join(f"{label}={value}" for label, value in zip(metric.labelnames, label_values))
+                if metric.kind == "histogram":
+                    values[key] = {
+                        "count": series.count,
+                        "sum": round(series.sum, 6),
+                        **{f"p{int(q * 100)}": series.quantile(q) for q in (0.5, 0.95, 0.99)},
+                    }
+                else:
+                    values[key] = series.read()
+            result[name] = {"type": metric.kind, "help": metric.help, "values": values}
+        return result
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            for label_values, series in metric.samples():
+                labels = list(zip(metric.labelnames, label_values))
+                if metric.kind == "histogram":
+                    cumulative = 0
+                    for bound, count in zip((*series.buckets, math.inf), series.counts):
+                        cumulative += count
+                        le = "+Inf" if bound == math.inf else repr(float(bound))
+                        lines.append(f"{name}_bucket{format_labels(labels + [('le', le)])} {cumulative}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {series.sum!r}")
+                    lines.append(f"{name}_count{format_labels(labels)} {series.count}")
+                else:
+                    lines.append(f"{name}{format_labels(labels)} {format_value(series.read())}")
+        return "\n".join(lines) + "\n"
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{label}="{value}"' for (label, _), value in zip(labels, escaped)) + "}"
+
+def format_value(value):
+    if value is None:
+        return "NaN"
+    if isinstance(value, float) and math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+REGISTRY = Registry()
+
+def counter(name, help="", labelnames=()):
+    return REGISTRY.register(Counter, name, help, labelnames)
+
+def gauge(name, help="", labelnames=()):
+    return REGISTRY.register(Gauge, name, help, labelnames)
+
+def histogram(name, help="", labelnames=(), buckets=LATENCY_BUCKETS):
+    return REGISTRY.register(Histogram, name, help, labelnames, buckets)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # scrapes every few seconds would drown the component's own log
+
+def serve(port, host=""):
+    """Serve ``/metrics`` for Prometheus from a daemon thread; returns the server."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+
+def dump_every(path, interval):
+    """Rewrite the snapshot at ``path`` every ``interval`` seconds from a daemon thread."""
+    def run():
+        while True:
+            time.sleep(interval)
+            REGISTRY.dump(path)
+    threading.Thread(target=run, name="metrics-dump", daemon=True).start()
+
+# METRICS_FILE=path makes any script write a JSON snapshot there at exit, and
+# every METRICS_INTERVAL seconds (default 60) while it runs
+if os.getenv("METRICS_FILE"):
+    atexit.register(REGISTRY.dump, os.environ["METRICS_FILE"])
+    dump_every(os.environ["METRICS_FILE"], float(os.getenv("METRICS_INTERVAL", "60")))
@@ -0,0 +1,147 @@
+import json
+import math
+import os
+from storage.schema import EVENT_TYPE_CODES, iso_to_micros
+
+try:
+    import orjson
+except ImportError:  # optional; the stdlib decoder is used instead
+    orjson = None
+
+
+# Reason codes for lines that can't be stored; see consumer/dead_letters.py
+MALFORMED = "malformed"  # not valid JSON
+NOT_OBJECT = "not_object"
+MISSING_FIELD = "missing_field"
+NULL_FIELD = "null_field"
+BAD_TYPE = "bad_type"
+UNKNOWN_EVENT_TYPE = "unknown_event_type"
+EMPTY_ID = "empty_id"
+BAD_PRICE = "bad_price"
+BAD_TIMESTAMP = "bad_timestamp"
+
+
+class SchemaError(ValueError):
+    """An event that decoded but doesn't match the schema; the message says why
+    and ``reason`` is one of the reason codes above."""
+
+    def __init__(self, message, reason=BAD_TYPE):
+        super().__init__(message)
+        self.reason = reason
+
+def error_reason(error):
+    """Reason code for an exception raised by parse_event."""
+    return getattr(error, "reason", MALFORMED)
+
+
+class Event(dict):
+    """A validated event. ``line`` holds the bytes it was decoded from, so
+    storing the raw payload never needs to re-serialize the dict."""
+
+    __slots__ = ("line",)
+
+
+# Decoders turn one line (bytes) into Python objects; pick one with
+# get_decoder(name) or the EVENT_DECODER environment variable.
+DECODERS = {"json": json.loads}
+if orjson is not None:
+    DECODERS["orjson"] = orjson.loads
+DEFAULT_DECODER = "orjson" if orjson is not None else "json"
+
+def register_decoder(name, loads):
+    DECODERS[name] = loads
+
+def get_decoder(name=None):
+    name = name or os.getenv("EVENT_DECODER") or DEFAULT_DECODER
+    try:
+        return DECODERS[name]
+    except KeyError:
+        raise ValueError(f"Unknown decoder {name!r}. Available: {', '.join(DECODERS)}") from None
+
+
+def _identifier(value):
+    # Ids are stored as text; integer ids from other producers are accepted
+    if type(value) is int:
+        return str(value)
+    raise SchemaError(f"with invalid id {value!r}", BAD_TYPE)
+
+def _text(value):
+    raise SchemaError(f"with invalid text {value!r}", BAD_TYPE)
+
+def _price(value):
+    if type(value) is int:
+        return float(value)
+    if type(value) is str:
+        try:
+            return float(value)
+        except ValueError:
+            pass
+    raise SchemaError("with a price that is not a number", BAD_PRICE)
+
+def _timestamp_micros(value):
+    try:
+        return iso_to_micros(value)
+    except (TypeError, ValueError):
+        raise SchemaError(f"with unparseable timestamp {value!r}", BAD_TIMESTAMP) from None
+
+# Required fields: (key, expected type, coercion for values of any other type).
+# Values of the expected type are taken as-is, so valid events never call out.
+EVENT_SCHEMA = (
+    ("event_type", str, _text),
+    ("user_id", str, _identifier),
+    ("product_id", str, _identifier),
+    ("product_name", str, _text),
+    ("price", float, _price),
+    ("timestamp", str, _text),
+)
+
+
+def compile_validator(schema=EVENT_SCHEMA, event_types=frozenset(EVENT_TYPE_CODES)):
+    """Build a function that validates and coerces an event dict in place.
+
+    The returned function raises SchemaError naming the first bad field,
+    and on success sets ``event["ts"]`` to the timestamp in epoch
+    microseconds. The schema is bound once, so each call is a flat loop
+    over (key, type, coerce) entries with no per-event setup.
+    """
+    fields = tuple(schema)
+
+    def validate(event):
+        if not isinstance(event, dict):
+            raise SchemaError("that is not a JSON object", NOT_OBJECT)
+        for key, kind, coerce in fields:
+            value = event.get(key)
+            if type(value) is not kind:
+                if value is None:
+                    if key not in event:
+                        raise SchemaError(f"missing '{key}'", MISSING_FIELD)
+                    raise SchemaError(f"with null '{key}'", NULL_FIELD)
+                event[key] = coerce(value)
+        if event["event_type"] not in event_types:
+            raise SchemaError(f"with unknown event_type {event['event_type']!r}", UNKNOWN_EVENT_TYPE)
+        if not event["user_id"] or not event["product_id"]:
+            raise SchemaError("with an empty id", EMPTY_ID)
+        price = event["price"]
+        if not 0 <= price < math.inf:  # also rejects NaN
+            raise SchemaError(f"with invalid price {price!r}", BAD_PRICE)
+        event["ts"] = _timestamp_micros(event["timestamp"])
+        return event
+
+    return validate
+
+validate_event = compile_validator()
+
+def parse_event(line, decoder=None):
+    """Decode one line and validate it; returns an ``Event`` that remembers ``line``.
+
+    Raises SchemaError for events that don't match the schema and ValueError
+    (which it subclasses) for lines that aren't JSON at all.
+    """
+    decoded = (decoder or _default_decoder)(line)
+    if type(decoded) is not dict:
+        raise SchemaError("that is not a JSON object", NOT_OBJECT)
+    event = Event(decoded)
+    event.line = line
+    return validate_event(event)
+
+_default_decoder = get_decoder()
@@ -0,0 +1,277 @@
+"""Mergeable probabilistic sketches in fixed memory.
+
+HyperLogLog estimates how many distinct items were seen, CountMinSketch how
+often one item was seen, and SpaceSaving which items were seen most;
+HeavyHitters pairs the last two. Memory depends only on each sketch's shape,
+never on how many distinct items go in. Sketches of the same shape merge
+into the sketch of both streams, so sketches kept per time bucket or built
+by separate processes can be added up, and ``to_bytes`` gives a compact
+BLOB that ``load_sketch`` reads back.
+"""
+import sys
+import json
+import math
+import heapq
+import struct
+import zlib
+from array import array
+from functools import lru_cache
+from hashlib import blake2b
+
+DEFAULT_PRECISION = 14  # 16384 registers, about 0.8% standard error
+DEFAULT_WIDTH = 1024  # Count-Min counters per row
+DEFAULT_DEPTH = 4  # Count-Min rows
+DEFAULT_CAPACITY = 64  # items tracked by Space-Saving
+HASH_CACHE_SIZE = 65536  # recently hashed items, so hot users and products skip blake2b
+
+# 2 ** -rank for every possible HyperLogLog register value
+INVERSE_POWERS = [2.0 ** -rank for rank in range(66)]
+
+
+@lru_cache(maxsize=HASH_CACHE_SIZE)
+def hash64(item):
+    """A 64-bit hash of a string that is the same in every process, unlike ``hash()``."""
+    return int.from_bytes(blake2b(item.encode(), digest_size=8).digest(), "little")
+
+def little_endian(counts):
+    """``counts`` as little-endian bytes, whatever the machine's byte order."""
+    if sys.byteorder == "big":
+        counts = array(counts.typecode, counts)
+        counts.byteswap()
+    return counts.tobytes()
+
+def check_shape(sketch, other, *attributes):
+    for attribute in attributes:
+        if getattr(sketch, attribute) != getattr(other, attribute):
+            raise ValueError(f"Can't merge {type(sketch).__name__} sketches with different {attribute}")
+
+
+class HyperLogLog:
+    """Distinct count estimate from ``2 ** precision`` one-byte registers.
+
+    The standard error is about ``1.04 / sqrt(2 ** precision)``; small counts
+    fall back to linear counting over the empty registers.
+    """
+
+    MAGIC = b"HLL1"
+
+    def __init__(self, precision=DEFAULT_PRECISION, registers=None):
+        if not 4 <= precision <= 18:
+            raise ValueError(f"precision must be between 4 and 18: {precision}")
+        self.precision = precision
+        self.registers = bytearray(1 << precision) if registers is None else registers
+        self.bits = 64 - precision  # hash bits left after the register index
+        self.mask = (1 << self.bits) - 1
+
+    def add(self, item):
+        h = hash64(item)
+        index = h >> self.bits
+        # Position of the first 1 bit in what's left of the hash
+        rank = self.bits + 1 - (h & self.mask).bit_length()
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        check_shape(self, other, "precision")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def estimate(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(map(INVERSE_POWERS.__getitem__, self.registers))
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
+
+    def to_bytes(self):
+        return self.MAGIC + struct.pack("<B", self.precision) + zlib.compress(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data):
+        precision, = struct.unpack_from("<B", data, 4)
+        return cls(precision, bytearray(zlib.decompress(data[5:])))
+
+
+class CountMinSketch:
+    """How often each item was seen, from ``depth`` rows of ``width`` counters.
+
+    Estimates are never too low, and with probability ``1 - exp(-depth)`` too
+    high by at most ``e / width`` of the total count.
+    """
+
+    MAGIC = b"CMS1"
+    HEADER = struct.Struct("<IIQ")  # width, depth, total
+
+    def __init__(self, width=DEFAULT_WIDTH, depth=DEFAULT_DEPTH, counts=None, total=0):
+        self.width = width
+        self.depth = depth
+        self.counts = array("Q", bytes(8 * width * depth)) if counts is None else counts
+        self.total = total
+
+    def cells(self, item):
+        # Double hashing: row i uses h1 + i * h2
+        h = hash64(item)
+        h1, h2 = h & 0xFFFFFFFF, (h >> 32) | 1
+        return [row * self.width + (h1 + row * h2) % self.width for row in range(self.depth)]
+
+    def add(self, item, count=1):
+        counts = self.counts
+        for cell in self.cells(item):
+            counts[cell] += count
+        self.total += count
+
+    def estimate(self, item):
+        return min(self.counts[cell] for cell in self.cells(item))
+
+    def merge(self, other):
+        check_shape(self, other, "width", "depth")
+        self.counts = array("Q", map(int.__add__, self.counts, other.counts))
+        self.total += other.total
+        return self
+
+    def to_bytes(self):
+        return self.MAGIC + self.HEADER.pack(self.width, self.depth, self.total) + zlib.compress(little_endian(self.counts))
+
+    @classmethod
+    def from_bytes(cls, data):
+        width, depth, total = cls.HEADER.unpack_from(data, 4)
+        counts = array("Q", zlib.decompress(data[4 + cls.HEADER.size:]))
+        if sys.byteorder == "big":
+            counts.byteswap()
+        return cls(width, depth, counts, total)
+
+
+class SpaceSaving:
+    """The ``capacity`` most frequent items (Metwally et al.).
+
+    Each tracked item has a count and the most that count may be too high
+    by. An untracked item replaces the smallest counter and inherits its
+    count as error, so any item seen more than ``total / capacity`` times is
+    tracked. Merging adds the counters of both sides, counting an item one
+    side doesn't track as that side's smallest count, and keeps the largest.
+    """
+
+    MAGIC = b"SSV1"
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, counters=None):
+        self.capacity = capacity
+        self.counters = {} if counters is None else counters  # item -> [count, error]
+        self.index_counters()
+
+    def index_counters(self):
+        # A min-heap with one (count, item) entry per counter. Counts only go
+        # up, so an entry is at most its counter's count and gets refreshed
+        # when it surfaces; evicting is then O(log capacity) instead of a scan.
+        self.heap = [(count, item) for item, (count, _) in self.counters.items()]
+        heapq.heapify(self.heap)
+
+    def add(self, item, count=1):
+        counter = self.counters.get(item)
+        if counter is not None:
+            counter[0] += count
+        elif len(self.counters) < self.capacity:
+            self.counters[item] = [count, 0]
+            heapq.heappush(self.heap, (count, item))
+        else:
+            while True:
+                floor, smallest = self.heap[0]
+                current = self.counters[smallest][0]
+                if current == floor:
+                    break
+                heapq.heapreplace(self.heap, (current, smallest))
+            del self.counters[smallest]
+            self.counters[item] = [floor + count, floor]
+            heapq.heapreplace(self.heap, (floor + count, item))
+
+    def floor(self):
+        """The count an untracked item may have had: the smallest counter once full."""
+        if len(self.counters) < self.capacity:
+            return 0
+        return min(count for count, _ in self.counters.values())
+
+    def merge(self, other):
+        check_shape(self, other, "capacity")
+        floor, other_floor = self.floor(), other.floor()
+        merged = {}
+        for item in self.counters.keys() | other.counters.keys():
+            count, error = self.counters.get(item, (floor, floor))
+            other_count, other_error = other.counters.get(item, (other_floor, other_floor))
+            merged[item] = [count + other_count, error + other_error]
+        self.counters = dict(heapq.nlargest(self.capacity, merged.items(), key=lambda entry: entry[1][0]))
+        self.index_counters()
+        return self
+
+    def top(self, n=None):
+        """``(item, count, error)`` for the ``n`` largest counters (all of them by default), largest first."""
+        ranked = sorted(self.counters.items(), key=lambda entry: (-entry[1][0], entry[0]))
+        return [(item, count, error) for item, (count, error) in ranked[:n]]
+
+    def to_bytes(self):
+        return self.MAGIC + json.dumps([self.capacity, self.top()], separators=(",", ":")).encode()
+
+    @classmethod
+    def from_bytes(cls, data):
+        capacity, counters = json.loads(data[4:])
+        return cls(capacity, {item: [count, error] for item, count, error in counters})
+
+
+class HeavyHitters:
+    """The most frequent items: Space-Saving candidates checked against a Count-Min sketch.
+
+    Space-Saving knows which items are frequent but only counts the ones it
+    kept; Count-Min counts any item but can't list them. Both only ever
+    overestimate, so ``top`` reports each candidate with the smaller of the
+    two counts, and ``estimate`` answers for any item.
+    """
+
+    MAGIC = b"HHS1"
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, width=DEFAULT_WIDTH, depth=DEFAULT_DEPTH, candidates=None, counts=None):
+        self.candidates = SpaceSaving(capacity) if candidates is None else candidates
+        self.counts = CountMinSketch(width, depth) if counts is None else counts
+
+    def add(self, item, count=1):
+        self.candidates.add(item, count)
+        self.counts.add(item, count)
+
+    def estimate(self, item):
+        return self.counts.estimate(item)
+
+    def merge(self, other):
+        self.candidates.merge(other.candidates)
+        self.counts.merge(other.counts)
+        return self
+
+    def top(self, n=None):
+        """``(item, estimated count)`` for the ``n`` most frequent items, most frequent first."""
+        ranked = sorted(((item, min(count, self.counts.estimate(item))) for item, count, _ in self.candidates.top()),
+                        key=lambda entry: (-entry[1], entry[0]))
+        return ranked[:n]
+
+    def to_bytes(self):
+        counts = self.counts.to_bytes()
+        return self.MAGIC + struct.pack("<I", len(counts)) + counts + self.candidates.to_bytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        size, = struct.unpack_from("<I", data, 4)
+        return cls(counts=CountMinSketch.from_bytes(data[8:8 + size]), candidates=SpaceSaving.from_bytes(data[8 + size:]))
+
+
+SKETCH_TYPES = {cls.MAGIC: cls for cls in [HyperLogLog, CountMinSketch, SpaceSaving, HeavyHitters]}
+
+def load_sketch(data):
+    """Read back any sketch's ``to_bytes``."""
+    cls = SKETCH_TYPES.get(bytes(data[:4]))
+    if cls is None:
+        raise ValueError(f"Not a sketch: {bytes(data[:4])!r}")
+    return cls.from_bytes(data)
+
+def merge_sketches(sketches):
+    """Merge sketches of one type and shape into the first; returns None for none."""
+    merged = None
+    for sketch in sketches:
+        merged = sketch if merged is None else merged.merge(sketch)
+    return merged